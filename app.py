@@ -19,6 +19,8 @@ from src.pdf_processor import PDFProcessor
 from src.deepseek_client import DeepSeekClient
 from src.qa_generator import QAGenerator
 from src.excel_writer import ExcelWriter
+from src.batch_journal import BatchJournal
+from src.ocr_batcher import preload_latex_ocr
 from dotenv import load_dotenv
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -51,6 +53,18 @@ os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 tasks = {}
 TASKS_FILE = 'tasks_status.json'
 
+# 批处理日志目录，按批次ID记录每个文件的结果，用于恢复中断的批处理
+BATCH_JOURNAL_DIR = '.cache/batches'
+
+# 缓存目录只由服务端配置（环境变量）决定，不接受请求参数，避免客户端让服务器在任意路径创建目录和数据库文件
+FORMULA_CACHE_DIR = os.environ.get('FORMULA_CACHE_DIR', '.cache/formulas')
+LLM_CACHE_DIR = os.environ.get('LLM_CACHE_DIR') or None
+
+# 客户端可设置的并行度上限，避免单个请求启动大量进程或线程：提取进程和页面并行数不超过CPU核数
+CPU_WORKERS_LIMIT = os.cpu_count() or 1
+MAX_WORKERS_LIMIT = 16
+API_CONCURRENCY_LIMIT = 32
+
 # 加载已有任务状态(如果存在)
 def load_tasks():
     global tasks
@@ -71,6 +85,147 @@ def save_tasks():
     except Exception as e:
         logger.error(f"保存任务状态失败: {str(e)}")
 
+# 创建实时更新任务进度的问答对回调
+def make_qa_progress_callback(task_id, start, end, expected):
+    """
+    每收到一个问答对就按已收到数量把进度从start推进到end，状态文件最多每秒写一次
+    
+    回调在API客户端的事件循环线程中执行，只做计数和少量写盘。
+    """
+    received = [0]
+    last_saved = [0.0]
+    
+    def on_qa_pair(qa):
+        received[0] += 1
+        ratio = min(1.0, received[0] / max(1, expected))
+        tasks[task_id]["progress"] = max(tasks[task_id].get("progress", 0), start + int((end - start) * ratio))
+        tasks[task_id]["message"] = f"正在生成问答对... 已生成 {received[0]}/{expected} 个"
+        now = time.monotonic()
+        if now - last_saved[0] >= 1.0:
+            last_saved[0] = now
+            save_tasks()
+    
+    return on_qa_pair
+
+# 解析有上下限的整数参数
+def bounded_int(data, key, default, minimum, maximum):
+    """
+    读取整数参数，小于下限时报错，超过上限时截断到上限
+    
+    Args:
+        data (dict): 请求参数
+        key (str): 参数名
+        default (int): 默认值
+        minimum (int): 下限
+        maximum (int): 上限
+        
+    Returns:
+        int: 参数值
+    """
+    value = int(data.get(key, default))
+    if value < minimum:
+        raise ValueError(f"参数 {key} 不能小于 {minimum}")
+    if value > maximum:
+        logger.warning(f"参数 {key}={value} 超过服务端上限，按 {maximum} 处理")
+        value = maximum
+    return value
+
+# 解析生成参数
+def parse_generation_params(data):
+    """
+    从请求JSON中解析单文件和批量处理共用的生成参数
+    
+    Args:
+        data (dict): 请求参数
+        
+    Returns:
+        dict: 处理参数
+        
+    Raises:
+        ValueError: 参数格式错误或超出允许范围
+    """
+    return {
+        'num_qa': int(data.get('num_qa', 10)),
+        'qa_level': data.get('qa_level', 'all'),
+        'use_latex_ocr': data.get('use_latex_ocr', False),
+        'use_extract_cache': data.get('use_extract_cache', True),
+        'max_workers': bounded_int(data, 'max_workers', 3, 1, MAX_WORKERS_LIMIT),
+        'page_workers': bounded_int(data, 'page_workers', 1, 1, CPU_WORKERS_LIMIT),
+        'ocr_batch_size': int(data.get('ocr_batch_size', 8)),
+        'ocr_max_wait': float(data.get('ocr_max_wait', 0.05)),
+        'api_retries': int(data.get('api_retries', 3)),
+        'api_concurrency': bounded_int(data, 'api_concurrency', 8, 1, API_CONCURRENCY_LIMIT),
+        'api_rpm': int(data['api_rpm']) if data.get('api_rpm') else None,
+        'api_tpm': int(data['api_tpm']) if data.get('api_tpm') else None,
+        'llm_cache_ttl': float(data['llm_cache_ttl']) * 3600 if data.get('llm_cache_ttl') else None,
+        'cache_only': data.get('cache_only', False),
+        'chunk_tokens': int(data.get('chunk_tokens', 0)) or None,
+        'stream': data.get('stream', True),
+        'min_recovery_ratio': float(data.get('min_recovery_ratio', 0.6)),
+        'top_up_rounds': int(data.get('top_up_rounds', 2)),
+        'split_levels': data.get('split_levels', False),
+        'api_timeout': float(data.get('api_timeout', 300)),
+        'hedge_requests': data.get('hedge_requests', False),
+        'breaker_error_rate': float(data.get('breaker_error_rate', 0.5)),
+        'breaker_cooldown': float(data.get('breaker_cooldown', 30)),
+        # 默认在服务进程内提取，复用进程内共享（可预加载）的LatexOCR模型；提取进程池每个批次都会重新加载模型
+        'extract_workers': bounded_int(data, 'extract_workers', 0, 0, CPU_WORKERS_LIMIT),
+        'pipeline_queue_size': int(data.get('pipeline_queue_size', 4)),
+        'schedule': data.get('schedule', 'lpt'),
+        'pack_tokens': int(data.get('pack_tokens', 0)) or None,
+        'pack_max_docs': int(data.get('pack_max_docs', 8)),
+        'context_tokens': int(data.get('context_tokens', 0)) or None,
+        'context_compression': data.get('context_compression', True),
+        'retry_delay': int(data.get('retry_delay', 2)),
+        'model': data.get('model', None)
+    }
+
+# 问答生成器的共用构造参数
+def qa_generator_options(params):
+    """
+    将处理参数转换为QAGenerator的构造参数（不含pdf_dir、num_qa_pairs、max_workers和on_qa_pair），
+    缓存目录使用服务端配置
+    
+    Args:
+        params (dict): 处理参数
+        
+    Returns:
+        dict: 构造参数
+    """
+    return {
+        'api_max_retries': params['api_retries'],
+        'api_retry_delay': params['retry_delay'],
+        'qa_level': None if params['qa_level'] == 'all' else params['qa_level'],
+        'use_latex_ocr': params['use_latex_ocr'],
+        'use_extract_cache': params.get('use_extract_cache', True),
+        'page_workers': params.get('page_workers', 1),
+        'ocr_batch_size': params.get('ocr_batch_size', 8),
+        'ocr_max_wait': params.get('ocr_max_wait', 0.05),
+        'formula_cache_dir': FORMULA_CACHE_DIR,
+        'api_concurrency': params.get('api_concurrency', 8),
+        'api_rpm': params.get('api_rpm'),
+        'api_tpm': params.get('api_tpm'),
+        'llm_cache_dir': LLM_CACHE_DIR,
+        'llm_cache_ttl': params.get('llm_cache_ttl'),
+        'cache_only': params.get('cache_only', False),
+        'chunk_tokens': params.get('chunk_tokens'),
+        'stream': params.get('stream', True),
+        'min_recovery_ratio': params.get('min_recovery_ratio', 0.6),
+        'top_up_rounds': params.get('top_up_rounds', 2),
+        'split_levels': params.get('split_levels', False),
+        'api_timeout': params.get('api_timeout', 300),
+        'hedge_requests': params.get('hedge_requests', False),
+        'breaker_error_rate': params.get('breaker_error_rate', 0.5),
+        'breaker_cooldown': params.get('breaker_cooldown', 30),
+        'extract_workers': params.get('extract_workers', 0),
+        'pipeline_queue_size': params.get('pipeline_queue_size', 4),
+        'schedule': params.get('schedule', 'lpt'),
+        'pack_tokens': params.get('pack_tokens'),
+        'pack_max_docs': params.get('pack_max_docs', 8),
+        'context_tokens': params.get('context_tokens'),
+        'context_compression': params.get('context_compression', True)
+    }
+
 # 在应用启动时加载任务状态
 load_tasks()
 
@@ -198,15 +353,10 @@ def process_file():
     """处理PDF生成问答对"""
     data = request.json
     filename = data.get('filename')
-    params = {
-        'num_qa': int(data.get('num_qa', 10)),
-        'qa_level': data.get('qa_level', 'all'),
-        'use_latex_ocr': data.get('use_latex_ocr', False),
-        'max_workers': int(data.get('max_workers', 3)),
-        'api_retries': int(data.get('api_retries', 3)),
-        'retry_delay': int(data.get('retry_delay', 2)),
-        'model': data.get('model', None)
-    }
+    try:
+        params = parse_generation_params(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"参数错误: {str(e)}"}), 400
     
     # 处理自定义API配置
     api_key = data.get('api_key')
@@ -253,7 +403,21 @@ def process_file():
 @app.route('/process_batch', methods=['POST'])
 def process_batch():
     """处理批量PDF生成问答对"""
-    data = request.json
+    return start_batch_task(request.json, resume=False)
+
+@app.route('/resume_batch', methods=['POST'])
+def resume_batch():
+    """从批处理日志恢复中断的批量任务，跳过已成功完成的文件（参数与/process_batch相同）"""
+    return start_batch_task(request.json, resume=True)
+
+def start_batch_task(data, resume):
+    """
+    校验批次并启动后台批处理线程
+    
+    Args:
+        data (dict): 请求参数
+        resume (bool): 是否从批处理日志恢复
+    """
     batch_id = data.get('batch_id')
     
     if not batch_id:
@@ -264,23 +428,20 @@ def process_batch():
     if not os.path.exists(batch_dir) or not os.path.isdir(batch_dir):
         return jsonify({"status": "error", "message": "批次不存在或已过期"}), 404
     
+    if resume and not BatchJournal.exists(batch_id, BATCH_JOURNAL_DIR):
+        return jsonify({"status": "error", "message": "该批次没有可恢复的批处理日志"}), 404
+    
     # 检查目录中是否有PDF文件
     pdf_files = [f for f in os.listdir(batch_dir) if f.lower().endswith('.pdf')]
     if not pdf_files:
         return jsonify({"status": "error", "message": "批次中没有PDF文件"}), 400
     
     # 准备参数
-    params = {
-        'num_qa': int(data.get('num_qa', 10)),
-        'qa_level': data.get('qa_level', 'all'),
-        'use_latex_ocr': data.get('use_latex_ocr', False),
-        'max_workers': int(data.get('max_workers', 3)),
-        'api_retries': int(data.get('api_retries', 3)),
-        'retry_delay': int(data.get('retry_delay', 2)),
-        'model': data.get('model', None),
-        'batch_id': batch_id,
-        'batch_dir': batch_dir
-    }
+    try:
+        params = parse_generation_params(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"参数错误: {str(e)}"}), 400
+    params.update({'batch_id': batch_id, 'batch_dir': batch_dir, 'resume': resume})
     
     # 处理自定义API配置
     if data.get('model'):
@@ -295,7 +456,7 @@ def process_batch():
     tasks[task_id] = {
         "status": "processing",
         "progress": 0,
-        "message": f"初始化批处理 ({len(pdf_files)} 个文件)...",
+        "message": f"{'恢复' if resume else '初始化'}批处理 ({len(pdf_files)} 个文件)...",
         "result": None
     }
     
@@ -309,7 +470,7 @@ def process_batch():
     
     return jsonify({
         "status": "success", 
-        "message": "批处理已开始", 
+        "message": "批处理已恢复" if resume else "批处理已开始", 
         "task_id": task_id,
         "file_count": len(pdf_files)
     })
@@ -356,9 +517,6 @@ def process_pdf_task(task_id, filepath, params):
             if 'api_url' in params and params['api_url']:
                 os.environ["DEEPSEEK_API_URL"] = params['api_url']
         
-        # 处理qa_level参数
-        qa_level = None if params['qa_level'] == 'all' else params['qa_level']
-        
         # 创建临时目录存放单个PDF
         temp_dir = os.path.join(app.config['UPLOAD_FOLDER'], task_id)
         os.makedirs(temp_dir, exist_ok=True)
@@ -377,15 +535,13 @@ def process_pdf_task(task_id, filepath, params):
             pdf_dir=temp_dir, 
             num_qa_pairs=params['num_qa'],
             max_workers=1,  # 只处理一个文件不需要并行
-            api_max_retries=params['api_retries'],
-            api_retry_delay=params['retry_delay'],
-            qa_level=qa_level,
-            use_latex_ocr=params['use_latex_ocr']
+            on_qa_pair=make_qa_progress_callback(task_id, 50, 80, params['num_qa']),
+            **qa_generator_options(params)
         )
         
         # 添加Monkey Patch来记录提示词构建过程
         original_prepare_prompt = qa_generator._prepare_qa_prompt
-        def patched_prepare_prompt(content, level, num_pairs, metadata=None):
+        def patched_prepare_prompt(content, level, num_pairs, metadata=None, truncate=True):
             # 记录原始内容信息
             logger.info(f"PDF内容长度: {len(content)} 字符")
             if content:
@@ -398,10 +554,9 @@ def process_pdf_task(task_id, filepath, params):
             template = qa_generator._get_prompt_template(level, num_pairs, metadata)
             # 记录模板信息
             logger.info(f"使用模板级别: {level or '混合'}, 模板长度: {len(template)} 字符")
-            logger.info(f"模板中的占位符: {'{{content[:50000]}}' in template}")
             
             # 调用原始方法
-            prompt = original_prepare_prompt(content, level, num_pairs, metadata)
+            prompt = original_prepare_prompt(content, level, num_pairs, metadata, truncate)
             
             # 记录最终提示词
             logger.info(f"最终提示词长度: {len(prompt)} 字符")
@@ -418,12 +573,12 @@ def process_pdf_task(task_id, filepath, params):
         qa_generator._prepare_qa_prompt = patched_prepare_prompt
         
         # 同样记录DeepSeekClient的调用
-        original_generate_qa = qa_generator.deepseek_client.generate_qa_pairs
-        def patched_generate_qa(prompt, num_pairs):
+        original_submit_qa = qa_generator.deepseek_client.submit_qa_pairs
+        def patched_submit_qa(prompt, num_pairs, on_pair=None, max_tokens=None):
             logger.info(f"调用DeepSeek API, 提示词长度: {len(prompt)}, 请求生成 {num_pairs} 个问答对")
-            return original_generate_qa(prompt, num_pairs)
+            return original_submit_qa(prompt, num_pairs, on_pair, max_tokens)
         
-        qa_generator.deepseek_client.generate_qa_pairs = patched_generate_qa
+        qa_generator.deepseek_client.submit_qa_pairs = patched_submit_qa
         
         tasks[task_id]["progress"] = 50
         tasks[task_id]["message"] = "正在生成问答对..."
@@ -499,6 +654,7 @@ def process_pdf_task(task_id, filepath, params):
                 "processed_files": len(qa_results),
                 "failed_files_count": 0
             },
+            "run_stats": qa_generator.get_run_stats(),
             "pdf_filepath": temp_filepath  # 添加PDF文件路径信息
         }
         
@@ -551,9 +707,6 @@ def process_pdf_batch_task(task_id, params):
             if 'api_url' in params and params['api_url']:
                 os.environ["DEEPSEEK_API_URL"] = params['api_url']
         
-        # 处理qa_level参数
-        qa_level = None if params['qa_level'] == 'all' else params['qa_level']
-        
         tasks[task_id]["progress"] = 30
         tasks[task_id]["message"] = "正在初始化问答生成器..."
         save_tasks()  # 保存任务状态更新
@@ -563,17 +716,15 @@ def process_pdf_batch_task(task_id, params):
             pdf_dir=batch_dir, 
             num_qa_pairs=params['num_qa'],
             max_workers=params['max_workers'],
-            api_max_retries=params['api_retries'],
-            api_retry_delay=params['retry_delay'],
-            qa_level=qa_level,
-            use_latex_ocr=params['use_latex_ocr']
+            on_qa_pair=make_qa_progress_callback(task_id, 40, 80, params['num_qa'] * total_files),
+            **qa_generator_options(params)
         )
         
-        # 添加Monkey Patch来记录PDF处理过程
-        original_process_pdf = qa_generator.process_pdf
-        def patched_process_pdf(pdf_path):
-            logger.info(f"开始处理单个PDF文件: {pdf_path}")
-            result = original_process_pdf(pdf_path)
+        # 添加Monkey Patch来记录PDF处理过程（批量处理时提取和生成分阶段进行，记录生成阶段的每个文件）
+        original_process_content = qa_generator.process_content
+        def patched_process_content(content, filename, metadata):
+            logger.info(f"开始为PDF文件生成问答对: {filename}")
+            result = original_process_content(content, filename, metadata)
             qa_pairs, filename, content, metadata, success = result
             
             if content:
@@ -592,15 +743,18 @@ def process_pdf_batch_task(task_id, params):
             return result
         
         # 替换方法以添加日志
-        qa_generator.process_pdf = patched_process_pdf
+        qa_generator.process_content = patched_process_content
         
         tasks[task_id]["progress"] = 40
         tasks[task_id]["message"] = f"正在处理 {total_files} 个PDF文件..."
         save_tasks()  # 保存任务状态更新
         
+        # 批处理日志：每个文件完成后立即落盘，任务中断后可通过/resume_batch恢复
+        journal = BatchJournal(params['batch_id'], BATCH_JOURNAL_DIR, resume=params.get('resume', False))
+        
         # 使用QAGenerator的generate_qa_from_pdfs方法处理PDF文件
         logger.info(f"调用generate_qa_from_pdfs开始批量处理PDF文件")
-        qa_results, failed_files = qa_generator.generate_qa_from_pdfs()
+        qa_results, failed_files = qa_generator.generate_qa_from_pdfs(journal=journal)
         
         # 记录处理结果
         logger.info(f"批量处理完成: 成功处理 {len(qa_results)} 个文件, 失败 {len(failed_files)} 个文件")
@@ -678,6 +832,7 @@ def process_pdf_batch_task(task_id, params):
                 "failed_files_count": len(failed_files),
                 "total_files": total_files
             },
+            "run_stats": qa_generator.get_run_stats(),
             "pdf_directory": batch_dir,  # 添加批次目录信息
             "pdf_files": pdf_file_paths  # 添加所有PDF文件路径
         }
@@ -744,4 +899,10 @@ def process_pdf_batch_task(task_id, params):
         logger.error(f"批处理出错，但保留PDF文件目录: {params['batch_dir'] if 'batch_dir' in params else '未知'}")
 
 if __name__ == "__main__":
+    # 可选：在后台预加载进程内共享的LatexOCR模型，避免第一个启用OCR的任务等待模型加载
+    # debug模式下只在实际处理请求的重载子进程中加载
+    if os.environ.get('PRELOAD_LATEX_OCR', '').lower() in ('1', 'true', 'yes') \
+            and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=preload_latex_ocr, daemon=True).start()
+    
     app.run(debug=True, host='0.0.0.0', port=8080) 
\ No newline at end of file
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+启动导入耗时基准测试
+
+在独立子进程中用 `python -X importtime` 导入 main.py 和 app.py，
+报告总导入耗时、最耗时的顶层模块，以及重量级依赖（torch、pix2tex、pandas、openpyxl、openai）是否在启动时被加载。
+同时测量 `python main.py --help` 的端到端耗时。
+
+用法:
+    python benchmarks/bench_import_time.py [--repeat 3] [--top 10]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 只应在对应处理阶段才加载的重量级依赖
+HEAVY_MODULES = ["torch", "pix2tex", "transformers", "pandas", "openpyxl", "openai"]
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def measure_import(module, repeat):
+    """
+    在子进程中导入模块并解析 -X importtime 输出
+
+    Args:
+        module (str): 要导入的模块名
+        repeat (int): 重复次数，取最快一次
+
+    Returns:
+        tuple: (总耗时秒数, 顶层模块耗时列表[(模块, 秒)], 已加载的重量级依赖列表)
+    """
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=REPO_ROOT, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"导入 {module} 失败:\n{result.stderr[-2000:]}")
+
+        cumulative = {}
+        total_us = 0
+        for line in result.stderr.splitlines():
+            match = IMPORT_LINE.match(line)
+            if not match:
+                continue
+            _, cumulative_us, indent, name = match.groups()
+            cumulative[name] = int(cumulative_us)
+            # 缩进最小（一个空格）的是顶层导入
+            if len(indent) == 1:
+                total_us += int(cumulative_us)
+
+        if best is None or total_us < best[0]:
+            best = (total_us, cumulative)
+
+    total_us, cumulative = best
+    top_level = sorted(
+        ((name, us / 1e6) for name, us in cumulative.items() if "." not in name),
+        key=lambda item: item[1], reverse=True
+    )
+    loaded_heavy = [name for name in HEAVY_MODULES if name in cumulative]
+    return total_us / 1e6, top_level, loaded_heavy
+
+def measure_help(repeat):
+    """
+    测量 `python main.py --help` 的端到端耗时
+
+    Args:
+        repeat (int): 重复次数，取最快一次
+
+    Returns:
+        float: 耗时秒数
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "main.py", "--help"], cwd=REPO_ROOT,
+                       capture_output=True, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="测量main.py和app.py的启动导入耗时")
+    parser.add_argument("--repeat", type=int, default=3, help="每项测量的重复次数 (默认: 3)")
+    parser.add_argument("--top", type=int, default=10, help="显示最耗时的顶层模块数量 (默认: 10)")
+    args = parser.parse_args()
+
+    for module in ["main", "app"]:
+        try:
+            total, top_level, loaded_heavy = measure_import(module, args.repeat)
+        except RuntimeError as e:
+            print(str(e))
+            continue
+
+        print(f"== import {module}: {total:.3f}s")
+        for name, seconds in top_level[:args.top]:
+            print(f"   {seconds:8.3f}s  {name}")
+        print(f"   启动时加载的重量级依赖: {', '.join(loaded_heavy) if loaded_heavy else '无'}")
+        print()
+
+    print(f"== python main.py --help: {measure_help(args.repeat):.3f}s")
+
+if __name__ == "__main__":
+    main()
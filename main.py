@@ -8,12 +8,9 @@
 """
 
 import os
+import time
 import argparse
 import logging
-from src.pdf_processor import PDFProcessor
-from src.deepseek_client import DeepSeekClient
-from src.qa_generator import QAGenerator
-from src.excel_writer import ExcelWriter
 from dotenv import load_dotenv
 
 # 配置日志
@@ -43,18 +40,111 @@ def parse_arguments():
     parser.add_argument('--max_workers', type=int, default=3,
                         help='最大并行处理的文件数 (默认: 3)')
     
+    parser.add_argument('--page_workers', type=int, default=1,
+                        help='大文档(>=100页)按页范围分片提取时使用的进程数 (默认: 1 - 不分片)')
+    
+    parser.add_argument('--extract_workers', type=int, default=1,
+                        help='批量处理时提取阶段的进程数，与生成阶段(--max_workers)流水线并行 (默认: 1，0表示在主进程中提取)')
+    
+    parser.add_argument('--pipeline_queue_size', type=int, default=4,
+                        help='提取阶段与生成阶段之间的队列容量，限制同时驻留内存的已提取文档数 (默认: 4)')
+    
+    parser.add_argument('--schedule', type=str, choices=['lpt', 'fifo'], default='lpt',
+                        help='批量处理的文件顺序: lpt(按页数、大小和文本层抽样估算成本，最长作业优先), fifo(目录顺序) (默认: lpt)')
+    
+    parser.add_argument('--pack_tokens', type=int, default=0,
+                        help='把内容不超过该预算一半的小文档打包，一次请求为组内每篇文档分别生成问答对 (默认: 0 - 不打包)')
+    
+    parser.add_argument('--pack_max_docs', type=int, default=8,
+                        help='每组最多打包的文档数 (默认: 8)')
+    
+    parser.add_argument('--api_concurrency', type=int, default=8,
+                        help='同时在途的API请求数上限，与文件并行数无关 (默认: 8)')
+    
+    parser.add_argument('--api_rpm', type=int, default=None,
+                        help='每分钟API请求数上限 (默认: 不限制)')
+    
+    parser.add_argument('--api_tpm', type=int, default=None,
+                        help='每分钟API token数上限 (默认: 不限制)')
+    
+    parser.add_argument('--api_timeout', type=float, default=300,
+                        help='单次API调用的截止时间(秒)，超时按失败重试 (默认: 300)')
+    
+    parser.add_argument('--hedge_requests', action='store_true',
+                        help='启用对冲请求：耗时超过历史p95后再发送一个相同请求，取先完成的结果 (默认: 不启用)')
+    
+    parser.add_argument('--breaker_error_rate', type=float, default=0.5,
+                        help='最近API请求的错误率达到该值时熔断，冷却期内快速失败 (默认: 0.5，0表示不熔断)')
+    
+    parser.add_argument('--breaker_cooldown', type=float, default=30,
+                        help='熔断后的冷却时间(秒) (默认: 30)')
+    
     parser.add_argument('--api_retries', type=int, default=3,
                         help='API调用失败时的最大重试次数 (默认: 3)')
     
     parser.add_argument('--retry_delay', type=int, default=2,
-                        help='API重试间隔时间(秒) (默认: 2)')
+                        help='API重试退避的基础时间(秒)，实际为带抖动的指数退避 (默认: 2)')
+    
+    parser.add_argument('--context_tokens', type=int, default=0,
+                        help='上下文压缩的token预算，超过预算的文档按BM25段落重要性选取段落压缩到预算内 (默认: 0 - 只压缩超过50000字符的文档)')
+    
+    parser.add_argument('--no_context_compression', '--no-context-compression', dest='no_context_compression',
+                        action='store_true', help='禁用上下文压缩，超长文档截断到前50000字符 (默认: 启用)')
+    
+    parser.add_argument('--no_stream', '--no-stream', dest='no_stream', action='store_true',
+                        help='禁用流式输出，等待完整响应后再解析 (默认: 流式输出，收到足够问答对后提前结束)')
+    
+    parser.add_argument('--min_recovery_ratio', type=float, default=0.6,
+                        help='响应JSON格式有误时，修复取回的问答对达到期望数量的该比例即接受，不足时才重试 (默认: 0.6)')
+    
+    parser.add_argument('--top_up_rounds', type=int, default=2,
+                        help='问答对数量不足时按各级别缺少的数量发送补充请求的最多轮数 (默认: 2，0表示不补充)')
+    
+    parser.add_argument('--chunk_tokens', type=int, default=0,
+                        help='长文档分片生成时每个片段的token预算，各片段并发生成后合并 (默认: 0 - 不分片，超长文档压缩到50000字符以内)')
     
     parser.add_argument('--qa_level', type=str, choices=['basic', 'intermediate', 'advanced', 'all'],
                         default='all', help='问答对级别 (默认: all - 生成所有级别)')
     
+    parser.add_argument('--split_levels', action='store_true',
+                        help='qa_level为all时，按basic/intermediate/advanced分别并发请求后合并 (默认: 一次请求生成全部级别)')
+    
     parser.add_argument('--use_latex_ocr', action='store_true',
                         help='启用LaTeX公式OCR识别 (默认: 不启用)')
     
+    parser.add_argument('--ocr_batch_size', type=int, default=8,
+                        help='LaTeX公式OCR批量推理的批大小 (默认: 8)')
+    
+    parser.add_argument('--ocr_max_wait', type=float, default=0.05,
+                        help='LaTeX公式OCR凑批的最长等待时间(秒) (默认: 0.05)')
+    
+    parser.add_argument('--formula_cache_dir', type=str, default=None,
+                        help='公式OCR结果持久化缓存目录 (默认: 不持久化，仅内存缓存)')
+    
+    parser.add_argument('--no_extract_cache', '--no-extract-cache', dest='no_extract_cache', action='store_true',
+                        help='禁用PDF提取结果缓存，强制重新提取 (默认: 启用缓存)')
+    
+    parser.add_argument('--llm_cache_dir', type=str, default=None,
+                        help='大模型响应缓存目录，重跑时相同提示词不再重复调用API (默认: 不缓存)')
+    
+    parser.add_argument('--llm_cache_ttl', type=float, default=None,
+                        help='大模型响应缓存有效期(小时) (默认: 永不过期)')
+    
+    parser.add_argument('--llm_cache_size_mb', type=int, default=256,
+                        help='大模型响应缓存的最大总大小(MB) (默认: 256)')
+    
+    parser.add_argument('--cache_only', '--cache-only', dest='cache_only', action='store_true',
+                        help='只从大模型响应缓存回放结果，不访问网络 (需配合--llm_cache_dir)')
+    
+    parser.add_argument('--batch_id', type=str, default=None,
+                        help='本次批处理的ID，用作批处理日志文件名 (默认: 按启动时间生成)')
+    
+    parser.add_argument('--resume', type=str, default=None, metavar='BATCH_ID',
+                        help='从指定批次的批处理日志恢复，跳过已成功完成的文件')
+    
+    parser.add_argument('--journal_dir', type=str, default='.cache/batches',
+                        help='批处理日志目录，每个文件完成后立即记录结果 (默认: .cache/batches)')
+    
     parser.add_argument('--model', type=str, default=None,
                         help='指定DeepSeek模型 (默认: 使用.env中的MODEL_NAME或deepseek-chat)')
     
@@ -68,6 +158,11 @@ def main():
     # 解析命令行参数
     args = parse_arguments()
     
+    # 处理模块在解析参数之后再导入，使 --help 等无需加载PDF和API依赖
+    from src.qa_generator import QAGenerator
+    from src.excel_writer import ExcelWriter
+    from src.batch_journal import BatchJournal
+    
     # 如果指定了模型，设置环境变量
     if args.model:
         os.environ["MODEL_NAME"] = args.model
@@ -92,14 +187,47 @@ def main():
             api_max_retries=args.api_retries,
             api_retry_delay=args.retry_delay,
             qa_level=qa_level,
-            use_latex_ocr=args.use_latex_ocr
+            use_latex_ocr=args.use_latex_ocr,
+            use_extract_cache=not args.no_extract_cache,
+            page_workers=args.page_workers,
+            ocr_batch_size=args.ocr_batch_size,
+            ocr_max_wait=args.ocr_max_wait,
+            formula_cache_dir=args.formula_cache_dir,
+            api_concurrency=args.api_concurrency,
+            api_rpm=args.api_rpm,
+            api_tpm=args.api_tpm,
+            llm_cache_dir=args.llm_cache_dir,
+            llm_cache_ttl=args.llm_cache_ttl * 3600 if args.llm_cache_ttl else None,
+            llm_cache_size_mb=args.llm_cache_size_mb,
+            cache_only=args.cache_only,
+            chunk_tokens=args.chunk_tokens or None,
+            stream=not args.no_stream,
+            min_recovery_ratio=args.min_recovery_ratio,
+            top_up_rounds=args.top_up_rounds,
+            split_levels=args.split_levels,
+            api_timeout=args.api_timeout,
+            hedge_requests=args.hedge_requests,
+            breaker_error_rate=args.breaker_error_rate,
+            breaker_cooldown=args.breaker_cooldown,
+            extract_workers=args.extract_workers,
+            pipeline_queue_size=args.pipeline_queue_size,
+            schedule=args.schedule,
+            pack_tokens=args.pack_tokens or None,
+            pack_max_docs=args.pack_max_docs,
+            context_tokens=args.context_tokens or None,
+            context_compression=not args.no_context_compression
         )
         
         # 初始化Excel写入器
         excel_writer = ExcelWriter(output_dir=args.output_dir)
         
+        # 批处理日志：每个文件完成后立即落盘，中断后可用 --resume 继续
+        batch_id = args.resume or args.batch_id or time.strftime("%Y%m%d_%H%M%S")
+        journal = BatchJournal(batch_id, args.journal_dir, resume=bool(args.resume))
+        print(f"批次ID: {batch_id}（中断后可使用 --resume {batch_id} 继续）")
+        
         # 从PDF生成问答对
-        qa_results, failed_files = qa_generator.generate_qa_from_pdfs()
+        qa_results, failed_files = qa_generator.generate_qa_from_pdfs(journal=journal)
         
         if not qa_results:
             logger.warning("没有生成任何问答对")
@@ -137,6 +265,23 @@ def main():
             print(f"- 成功处理文件数: {len(qa_results)}")
             print(f"- 生成问答对总数: {total_qa_pairs}")
             print(f"- 失败文件数: {len(failed_files)}")
+            run_stats = qa_generator.get_run_stats()
+            print(f"- API调用次数: {run_stats['api_calls']}, 超时: {run_stats['deadline_timeouts']}, "
+                  f"对冲请求: {run_stats['hedges_sent']} (胜出 {run_stats['hedges_won']}), "
+                  f"熔断: {run_stats['breaker_opens']} 次 (快速失败 {run_stats['breaker_rejections']} 次)")
+            print(f"- 上下文缓存命中token: {run_stats['prompt_cache_hit_tokens']}, "
+                  f"未命中token: {run_stats['prompt_cache_miss_tokens']}, 命中率: {run_stats['prompt_cache_hit_rate']:.1%}")
+            compression = run_stats.get('context_compression')
+            if compression:
+                print(f"- 上下文压缩: {compression['files']} 个文件, "
+                      f"{compression['original_tokens']} -> {compression['compressed_tokens']} token, "
+                      f"压缩率: {compression['ratio']:.1%}")
+            pipeline = run_stats.get('pipeline')
+            if pipeline:
+                print(f"- 流水线耗时: {pipeline['elapsed_seconds']:.1f} 秒, "
+                      f"提取阶段利用率: {pipeline['extract']['utilization']:.1%}, "
+                      f"生成阶段利用率: {pipeline['generate']['utilization']:.1%}, "
+                      f"队列深度: 平均 {pipeline['queue_avg_depth']:.2f} / 最大 {pipeline['queue_max_depth']}")
             print("\n结果已保存为Excel和JSON格式，可在输出目录查看详细统计信息。")
         else:
             logger.error("保存结果到Excel文件失败")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class BatchJournal:
+    """
+    批量任务的追加写日志(JSONL)：每个文件生成完成后立即写入一行并fsync，
+    进程中断后可据此跳过已完成的文件
+
+    日志只追加不改写；同一文件有多条记录时以最后一条为准。只有PDF文件哈希和生成设置都与
+    记录一致的成功记录才视为已完成，文件被替换或参数变化后会重新处理。
+    """
+
+    def __init__(self, batch_id, journal_dir=".cache/batches", resume=False):
+        """
+        初始化批处理日志
+
+        Args:
+            batch_id (str): 批次ID，日志保存为 journal_dir/batch_id.jsonl
+            journal_dir (str): 日志目录
+            resume (bool): 是否读取已有记录，用于跳过已完成的文件
+        """
+        self.batch_id = batch_id
+        self.path = os.path.join(journal_dir, f"{batch_id}.jsonl")
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(journal_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            self._repair_tail()
+            if resume:
+                self._load()
+        elif resume:
+            logger.warning(f"批处理日志不存在，将处理全部文件: {self.path}")
+
+        logger.info(f"批处理日志: {self.path}，已完成 {self.completed_count()} 个文件")
+
+    @staticmethod
+    def exists(batch_id, journal_dir=".cache/batches"):
+        """
+        判断批次日志是否存在
+
+        Args:
+            batch_id (str): 批次ID
+            journal_dir (str): 日志目录
+
+        Returns:
+            bool: 是否存在
+        """
+        return os.path.exists(os.path.join(journal_dir, f"{batch_id}.jsonl"))
+
+    @staticmethod
+    def file_hash(pdf_path):
+        """
+        计算PDF文件内容的哈希
+
+        Args:
+            pdf_path (str): PDF文件路径
+
+        Returns:
+            str: 十六进制哈希
+        """
+        hasher = hashlib.sha256()
+        with open(pdf_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _repair_tail(self):
+        """写入中断导致最后一行不完整时补一个换行，避免新记录与残行拼接"""
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+    def _load(self):
+        """读取已有记录，跳过损坏的行"""
+        corrupted = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    self._entries[entry["file"]] = entry
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    corrupted += 1
+        if corrupted:
+            logger.warning(f"批处理日志中有 {corrupted} 行损坏（可能是写入时中断），已忽略")
+
+    def completed_count(self):
+        """已成功完成的文件数"""
+        return sum(1 for entry in self._entries.values() if entry.get("success"))
+
+    def get_completed(self, pdf_path, settings):
+        """
+        查询文件是否已在本批次中以相同设置成功完成
+
+        Args:
+            pdf_path (str): PDF文件路径
+            settings (dict): 影响生成结果的设置
+
+        Returns:
+            dict: 日志记录（包含qa_pairs、metadata等），未完成时返回None
+        """
+        entry = self._entries.get(os.path.basename(pdf_path))
+        if not entry or not entry.get("success") or entry.get("settings") != settings:
+            return None
+        try:
+            if entry.get("file_hash") != self.file_hash(pdf_path):
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def record(self, pdf_path, qa_pairs, metadata, content, success, settings):
+        """
+        追加一个文件的处理结果并立即落盘
+
+        Args:
+            pdf_path (str): PDF文件路径
+            qa_pairs (list): 生成的问答对
+            metadata (dict): 文档元数据
+            content (str): 提取出的文本，只记录其哈希
+            success (bool): 是否成功
+            settings (dict): 影响生成结果的设置
+        """
+        try:
+            file_hash = self.file_hash(pdf_path)
+        except OSError:
+            file_hash = None
+        entry = {
+            "file": os.path.basename(pdf_path),
+            "file_hash": file_hash,
+            "content_hash": hashlib.sha256(content.encode('utf-8')).hexdigest() if content else None,
+            "settings": settings,
+            "success": success,
+            "qa_pairs": qa_pairs,
+            "metadata": metadata,
+            "finished_at": time.time()
+        }
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                logger.error(f"写入批处理日志失败: {str(e)}")
+                return
+            self._entries[entry["file"]] = entry
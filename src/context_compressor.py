@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import math
+import heapq
+import logging
+from collections import Counter
+from .text_chunker import TextChunker
+from .rate_limiter import estimate_tokens
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 英文单词（至少3个字母）或连续的中文字符（切分为二元组）
+_TERM_PATTERN = re.compile(r'[A-Za-z][A-Za-z\-]{2,}|[\u4e00-\u9fff]+')
+
+# 参考文献部分的标题
+_REFERENCES_PATTERN = re.compile(r'(?:References|REFERENCES|Bibliography|参考文献)')
+
+_STOPWORDS = frozenset("""
+the and for with that this are was were from which these those have has had not but can
+its our their they them then than there been being also such into over under more most
+other some only when where while each both between through using used use based may
+will would should could however thus therefore here what who how all any one two
+""".split())
+
+def tokenize(text):
+    """
+    将文本切分为检索用的词项：英文小写单词（去停用词），中文按字二元组
+
+    Args:
+        text (str): 文本
+
+    Returns:
+        list: 词项列表
+    """
+    terms = []
+    for match in _TERM_PATTERN.finditer(text):
+        word = match.group(0)
+        if word[0] < '\u4e00':
+            word = word.lower()
+            if word not in _STOPWORDS:
+                terms.append(word)
+        elif len(word) == 1:
+            terms.append(word)
+        else:
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+class ContextCompressor:
+    """
+    本地（纯CPU）段落排序的上下文压缩：把文档切成段落，用BM25按文档关键词和标题词为段落打分，
+    贪心选出信息量高且覆盖面广的段落装入token预算，按原文顺序拼接
+    """
+
+    def __init__(self, passage_tokens=300, key_terms=60, k1=1.5, b=0.75, coverage_decay=0.5):
+        """
+        初始化压缩器
+
+        Args:
+            passage_tokens (int): 段落的token预算（按句子边界切分）
+            key_terms (int): 按TF-IDF选出的文档关键词数量
+            k1 (float): BM25词频饱和参数
+            b (float): BM25长度归一化参数
+            coverage_decay (float): 段落被选中后其包含的关键词权重乘以该系数，使后续段落倾向覆盖新的关键词
+        """
+        self.passage_tokens = passage_tokens
+        self.key_terms = key_terms
+        self.k1 = k1
+        self.b = b
+        self.coverage_decay = coverage_decay
+
+    def _query_weights(self, passage_terms, title):
+        """
+        选出文档关键词（全文词频 × IDF）并合入标题词，返回 词项 -> 权重 以及各词项的IDF
+
+        Args:
+            passage_terms (list): 每个段落的词频Counter
+            title (str): 文档标题
+
+        Returns:
+            tuple: (权重dict, IDF dict)
+        """
+        count = len(passage_terms)
+        document_freq = Counter()
+        term_freq = Counter()
+        for terms in passage_terms:
+            document_freq.update(terms.keys())
+            term_freq.update(terms)
+
+        idf = {term: math.log((count - df + 0.5) / (df + 0.5) + 1) for term, df in document_freq.items()}
+        # 只出现一次的词多为噪声（OCR错误、编号等），不作为关键词
+        candidates = {term: freq * idf[term] for term, freq in term_freq.items() if freq > 1}
+        top = heapq.nlargest(self.key_terms, candidates.items(), key=lambda x: x[1])
+        if not top:
+            return {}, idf
+
+        max_score = top[0][1]
+        weights = {term: score / max_score for term, score in top}
+        for term in set(tokenize(title or "")):
+            if term in idf:
+                weights[term] = max(weights.get(term, 0.0), 2.0)
+        return weights, idf
+
+    def _informativeness(self, passage, terms, in_references):
+        """段落的信息量系数：参考文献部分和以数字、符号为主的段落（表格、编号列表）降权"""
+        if not passage:
+            return 0.0
+        digits = sum(ch.isdigit() for ch in passage)
+        factor = max(0.1, 1.0 - digits / len(passage) * 2)
+        if not terms:
+            factor *= 0.1
+        if in_references:
+            factor *= 0.2
+        return factor
+
+    def compress(self, text, max_tokens, title=None):
+        """
+        将文档压缩到token预算内
+
+        Args:
+            text (str): 文档文本
+            max_tokens (int): token预算
+            title (str): 文档标题，标题词在打分时加权
+
+        Returns:
+            tuple: (压缩后的文本, 统计信息dict: passages段落总数, selected选中段落数)
+        """
+        if estimate_tokens(text) <= max_tokens:
+            return text, {"passages": 1, "selected": 1}
+
+        passages = TextChunker(self.passage_tokens).split(text)
+        passage_terms = [Counter(tokenize(passage)) for passage in passages]
+        passage_tokens = [estimate_tokens(passage) for passage in passages]
+        weights, idf = self._query_weights(passage_terms, title)
+
+        # 文档后半部分最后一个参考文献标题之后的段落视为参考文献
+        references_start = len(passages)
+        for i in range(len(passages) - 1, len(passages) // 2 - 1, -1):
+            if _REFERENCES_PATTERN.search(passages[i]):
+                references_start = i
+                break
+
+        # 预先计算每个段落对各关键词的BM25贡献
+        lengths = [sum(terms.values()) for terms in passage_terms]
+        avg_length = sum(lengths) / max(1, len(lengths)) or 1.0
+        contributions = []
+        factors = []
+        for i, terms in enumerate(passage_terms):
+            norm = self.k1 * (1 - self.b + self.b * lengths[i] / avg_length)
+            contributions.append({term: idf[term] * tf * (self.k1 + 1) / (tf + norm)
+                                  for term, tf in terms.items() if term in weights})
+            factor = self._informativeness(passages[i], terms, i >= references_start)
+            if i == 0:
+                factor *= 1.5  # 开头通常是标题、摘要和引言
+            factors.append(factor)
+
+        def score(i):
+            return factors[i] * sum(weights[term] * value for term, value in contributions[i].items())
+
+        # 惰性贪心：关键词权重只降不升，段落分数只会变小，堆顶重新计算后仍不低于次大值即可选中
+        heap = [(-score(i), i) for i in range(len(passages))]
+        heapq.heapify(heap)
+        selected = []
+        used_tokens = 0
+        while heap and used_tokens < max_tokens:
+            _, i = heapq.heappop(heap)
+            current = score(i)
+            if heap and current < -heap[0][0]:
+                heapq.heappush(heap, (-current, i))
+                continue
+            if used_tokens + passage_tokens[i] > max_tokens:
+                continue
+            selected.append(i)
+            used_tokens += passage_tokens[i]
+            for term in contributions[i]:
+                weights[term] *= self.coverage_decay
+
+        # 按原文顺序拼接，不相邻的段落之间用省略号标出
+        selected.sort()
+        pieces = []
+        for position, i in enumerate(selected):
+            if position > 0 and i != selected[position - 1] + 1:
+                pieces.append("……")
+            pieces.append(passages[i])
+        return " ".join(pieces), {"passages": len(passages), "selected": len(selected)}
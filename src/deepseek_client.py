@@ -1,8 +1,15 @@
 import os
-import logging
+import json
 import time
-from openai import OpenAI
+import asyncio
+import logging
+import threading
 from dotenv import load_dotenv
+from collections import deque
+from .rate_limiter import (RateLimiter, AIMDConcurrencyLimiter, CircuitBreaker, CircuitOpenError,
+                           estimate_tokens, backoff_delay, parse_retry_after)
+from .response_cache import ResponseCache
+from .json_stream import IncrementalJSONArrayParser, salvage_json_objects
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -10,116 +17,665 @@ logger = logging.getLogger(__name__)
 # 加载环境变量
 load_dotenv()
 
+# 进程内共享的事件循环线程，所有客户端的异步请求都在这里执行
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+# 按配置共享的并发控制器和限流器（只在共享事件循环中访问）
+_concurrency_limiters = {}
+_rate_limiters = {}
+_circuit_breakers = {}
+
+# 单次请求的最大生成token数和采样温度
+MAX_COMPLETION_TOKENS = 8000
+TEMPERATURE = 0.7
+
+# 对冲请求：至少积累这么多次成功请求的耗时后才按p95计算对冲延迟
+HEDGE_MIN_SAMPLES = 10
+
+def _get_shared_loop():
+    """
+    获取进程内共享的后台事件循环，首次调用时启动
+    
+    Returns:
+        asyncio.AbstractEventLoop: 事件循环
+    """
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="deepseek-client-loop", daemon=True)
+            thread.start()
+            _shared_loop = loop
+        return _shared_loop
+
+def _get_concurrency_limiter(limit):
+    """
+    获取指定并发上限的全局AIMD并发控制器（必须在共享事件循环中调用）
+    
+    Args:
+        limit (int): 同时在途的请求数上限
+        
+    Returns:
+        AIMDConcurrencyLimiter: 并发控制器
+    """
+    if limit not in _concurrency_limiters:
+        _concurrency_limiters[limit] = AIMDConcurrencyLimiter(limit)
+    return _concurrency_limiters[limit]
+
+def _get_rate_limiter(requests_per_minute, tokens_per_minute):
+    """
+    获取指定RPM/TPM配置的全局限流器（必须在共享事件循环中调用）
+    
+    Args:
+        requests_per_minute (int): 每分钟请求数上限，None表示不限制
+        tokens_per_minute (int): 每分钟token数上限，None表示不限制
+        
+    Returns:
+        RateLimiter: 限流器
+    """
+    key = (requests_per_minute, tokens_per_minute)
+    if key not in _rate_limiters:
+        _rate_limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+    return _rate_limiters[key]
+
+def _get_circuit_breaker(endpoint, error_rate, cooldown):
+    """
+    获取指定API地址的全局熔断器（必须在共享事件循环中调用）
+    
+    Args:
+        endpoint (str): API地址
+        error_rate (float): 打开熔断器的错误率
+        cooldown (float): 打开后的冷却时间(秒)
+        
+    Returns:
+        CircuitBreaker: 熔断器
+    """
+    key = (endpoint, error_rate, cooldown)
+    if key not in _circuit_breakers:
+        _circuit_breakers[key] = CircuitBreaker(error_rate=error_rate, cooldown=cooldown)
+    return _circuit_breakers[key]
+
+def _is_congestion_error(error):
+    """判断异常是否表示服务端拥塞（429限流、超时、5xx过载）"""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    status = getattr(error, "status_code", None)
+    if status == 429 or (status is not None and status >= 500):
+        return True
+    return type(error).__name__ in ("RateLimitError", "APITimeoutError", "InternalServerError")
+
 class DeepSeekClient:
     """DeepSeek API客户端类（使用OpenAI SDK）"""
     
-    def __init__(self, max_retries=3, retry_delay=2):
+    def __init__(self, max_retries=3, retry_delay=2, max_concurrent_requests=8,
+                 requests_per_minute=None, tokens_per_minute=None, response_cache_dir=None,
+                 response_cache_ttl=None, response_cache_size_mb=256, cache_only=False, stream=True,
+                 min_recovery_ratio=0.6, request_timeout=300, hedge=False, hedge_min_delay=5.0,
+                 breaker_error_rate=0.5, breaker_cooldown=30.0):
         """
         初始化DeepSeek API客户端
         
         Args:
             max_retries (int): 最大重试次数
-            retry_delay (int): 重试间隔时间(秒)
+            retry_delay (int): 重试退避的基础时间(秒)，实际等待为带抖动的指数退避
+            max_concurrent_requests (int): 进程内同时在途的API请求数上限，与PDF提取的并行度无关；
+                                           实际并发在此上限内按AIMD根据429和延迟自适应调整
+            requests_per_minute (int): 每分钟请求数上限，None表示不限制
+            tokens_per_minute (int): 每分钟token数上限（提示词+生成），None表示不限制
+            response_cache_dir (str): 响应缓存目录，为None时不缓存
+            response_cache_ttl (float): 响应缓存有效期(秒)，None表示永不过期
+            response_cache_size_mb (int): 响应缓存的最大总大小(MB)
+            cache_only (bool): 只从响应缓存回放，未命中时不访问网络
+            stream (bool): 是否使用流式输出；流式时每个问答对闭合后立即回调，收到足够数量后提前结束
+            min_recovery_ratio (float): 响应JSON格式有误时，修复后取回的问答对达到期望数量的该比例即接受，
+                                        不足时才重新请求
+            request_timeout (float): 单次API调用（含流式接收）的截止时间(秒)，超时按失败重试，None表示不限制
+            hedge (bool): 是否启用对冲请求：请求耗时超过历史p95后再发送一个相同请求，取先完成的结果
+            hedge_min_delay (float): 对冲延迟的下限(秒)
+            breaker_error_rate (float): 最近请求的错误率达到该值时熔断，冷却期内快速失败，0表示不熔断
+            breaker_cooldown (float): 熔断后的冷却时间(秒)
         """
         self.api_key = os.getenv("DEEPSEEK_API_KEY")
         self.api_base = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1")
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self.max_concurrent_requests = max(1, max_concurrent_requests)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.cache_only = cache_only
+        self.stream = stream
+        self.min_recovery_ratio = min_recovery_ratio
+        self.request_timeout = request_timeout
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker_error_rate = breaker_error_rate
+        self.breaker_cooldown = breaker_cooldown
+        
+        # 最近成功请求的单个问答对平均耗时，用于计算对冲延迟（只在共享事件循环中访问）
+        self._pair_latencies = deque(maxlen=200)
+        
+        # 运行统计：API调用次数、token用量和服务端上下文缓存命中情况
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "api_calls": 0,
+            "api_calls_without_usage": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "prompt_cache_hit_tokens": 0,
+            "prompt_cache_miss_tokens": 0,
+            "response_cache_hits": 0,
+            "deadline_timeouts": 0,
+            "hedges_sent": 0,
+            "hedges_won": 0,
+            "breaker_opens": 0,
+            "breaker_rejections": 0,
+        }
+        
+        self.response_cache = None
+        if response_cache_dir:
+            self.response_cache = ResponseCache(response_cache_dir, ttl_seconds=response_cache_ttl,
+                                                max_size_mb=response_cache_size_mb)
+        elif cache_only:
+            raise ValueError("cache_only模式需要设置响应缓存目录")
+        
+        if cache_only:
+            # 回放模式不访问网络，也不需要API密钥
+            self.client = None
+            logger.info("DeepSeek API客户端以仅缓存回放模式初始化")
+            return
         
         if not self.api_key:
             logger.error("未设置DEEPSEEK_API_KEY环境变量")
             raise ValueError("请设置DEEPSEEK_API_KEY环境变量")
         
-        # 初始化OpenAI客户端，指向DeepSeek API
-        self.client = OpenAI(
+        # openai SDK导入较慢，只在创建客户端时加载
+        from openai import AsyncOpenAI
+        
+        # 初始化异步OpenAI客户端，指向DeepSeek API；只在共享事件循环中使用
+        # 关闭SDK内置重试，由本类统一处理退避和拥塞控制
+        self.client = AsyncOpenAI(
             api_key=self.api_key,
-            base_url=self.api_base
+            base_url=self.api_base,
+            max_retries=0
         )
         
-        logger.info("DeepSeek API客户端初始化完成")
+        logger.info(f"DeepSeek API客户端初始化完成，最大并发请求数: {self.max_concurrent_requests}")
+    
+    def generate_qa_pairs(self, prompt, num_pairs=10, on_pair=None, max_tokens=None):
+        """
+        使用OpenAI SDK生成问答对，带有重试机制（同步接口）
+        
+        请求在共享事件循环中执行，受全局并发上限约束；调用线程只是等待结果。
+        
+        Args:
+            prompt (str): 完整的提示词
+            num_pairs (int): 期望生成的问答对数量
+            on_pair (callable): 每收到一个问答对时的回调on_pair(qa)，在共享事件循环线程中调用，应尽快返回
+            max_tokens (int): 本次请求的最大生成token数，None表示使用默认值
+            
+        Returns:
+            list: 问答对列表
+        """
+        return self.submit_qa_pairs(prompt, num_pairs, on_pair, max_tokens).result()
+    
+    def submit_qa_pairs(self, prompt, num_pairs=10, on_pair=None, max_tokens=None):
+        """
+        提交问答对生成请求，不阻塞调用线程
+        
+        Args:
+            prompt (str): 完整的提示词
+            num_pairs (int): 期望生成的问答对数量
+            on_pair (callable): 每收到一个问答对时的回调
+            max_tokens (int): 本次请求的最大生成token数，None表示使用默认值
+            
+        Returns:
+            concurrent.futures.Future: 结果为问答对列表
+        """
+        return asyncio.run_coroutine_threadsafe(self._agenerate_qa_pairs(prompt, num_pairs, on_pair, max_tokens),
+                                                _get_shared_loop())
     
-    def generate_qa_pairs(self, prompt, num_pairs=10):
+    async def agenerate_qa_pairs(self, prompt, num_pairs=10, on_pair=None, max_tokens=None):
         """
-        使用OpenAI SDK生成问答对，带有重试机制
+        使用OpenAI SDK生成问答对，带有重试机制（异步接口）
+        
+        可在任意事件循环中await；实际请求总是在共享事件循环中执行。
         
         Args:
             prompt (str): 完整的提示词
             num_pairs (int): 期望生成的问答对数量
+            on_pair (callable): 每收到一个问答对时的回调
+            max_tokens (int): 本次请求的最大生成token数，None表示使用默认值
             
         Returns:
             list: 问答对列表
         """
+        if asyncio.get_running_loop() is _get_shared_loop():
+            return await self._agenerate_qa_pairs(prompt, num_pairs, on_pair, max_tokens)
+        return await asyncio.wrap_future(self.submit_qa_pairs(prompt, num_pairs, on_pair, max_tokens))
+    
+    def _record_call(self, usage):
+        """
+        记录一次API调用的token用量和服务端上下文缓存命中情况
+        
+        Args:
+            usage: 响应中的usage对象，流式提前结束时为None
+        """
+        if usage is None:
+            with self._stats_lock:
+                self.stats["api_calls"] += 1
+                self.stats["api_calls_without_usage"] += 1
+            return
+        
+        hit_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+        miss_tokens = getattr(usage, "prompt_cache_miss_tokens", None)
+        if hit_tokens is None:
+            # 兼容OpenAI格式：prompt_tokens_details.cached_tokens
+            details = getattr(usage, "prompt_tokens_details", None)
+            hit_tokens = getattr(details, "cached_tokens", None) or 0
+            miss_tokens = (getattr(usage, "prompt_tokens", 0) or 0) - hit_tokens
+        logger.info(f"API调用完成，提示词token: {getattr(usage, 'prompt_tokens', 0)}，"
+                    f"上下文缓存命中: {hit_tokens}，未命中: {miss_tokens}")
+        
+        with self._stats_lock:
+            self.stats["api_calls"] += 1
+            self.stats["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            self.stats["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+            self.stats["prompt_cache_hit_tokens"] += hit_tokens or 0
+            self.stats["prompt_cache_miss_tokens"] += miss_tokens or 0
+    
+    def get_stats(self):
+        """
+        获取运行统计
+        
+        Returns:
+            dict: 统计信息副本，包含上下文缓存命中率prompt_cache_hit_rate
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        cached = stats["prompt_cache_hit_tokens"] + stats["prompt_cache_miss_tokens"]
+        stats["prompt_cache_hit_rate"] = stats["prompt_cache_hit_tokens"] / cached if cached else 0.0
+        return stats
+    
+    def _count(self, key):
+        """运行统计计数加一"""
+        with self._stats_lock:
+            self.stats[key] += 1
+    
+    def _hedge_delay(self, num_pairs):
+        """
+        按最近请求耗时的p95计算对冲延迟（按问答对数量缩放）
+        
+        Args:
+            num_pairs (int): 本次请求的问答对数量
+            
+        Returns:
+            float: 对冲延迟(秒)，样本不足时返回None
+        """
+        if len(self._pair_latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self._pair_latencies)
+        p95 = samples[int(0.95 * (len(samples) - 1))]
+        return max(self.hedge_min_delay, p95 * max(1, num_pairs))
+    
+    async def _acomplete(self, model, prompt, num_pairs, on_pair, max_tokens, started=None):
+        """
+        执行一次API调用：受RPM/TPM限流和AIMD并发控制约束，调用本身受截止时间限制
+        
+        Args:
+            started (asyncio.Event): 取得并发名额、开始调用时设置，用于对冲计时不包含排队时间
+            
+        Returns:
+            tuple: (响应文本, token用量或None, 流式解析出的问答对列表或None)
+        """
+        concurrency = _get_concurrency_limiter(self.max_concurrent_requests)
+        rate_limiter = _get_rate_limiter(self.requests_per_minute, self.tokens_per_minute)
+        estimated_tokens = estimate_tokens(prompt) + max_tokens
+        
+        await rate_limiter.acquire(estimated_tokens)
+        # 流式请求已收到的文本，请求中途失败或被取消时用于估算实际用量
+        received = []
+        try:
+            await concurrency.acquire()
+            try:
+                start_time = time.monotonic()
+                if started is not None:
+                    started.set()
+                if self.stream:
+                    call = self._astream_completion(model, prompt, num_pairs, on_pair, max_tokens, received)
+                else:
+                    call = self.client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "user", "content": prompt}
+                        ],
+                        temperature=TEMPERATURE,
+                        max_tokens=max_tokens  # 默认8000，以支持更复杂的回答
+                    )
+                try:
+                    result = await asyncio.wait_for(call, self.request_timeout)
+                except asyncio.TimeoutError:
+                    self._count("deadline_timeouts")
+                    logger.warning(f"API调用超过截止时间 {self.request_timeout} 秒，放弃本次调用")
+                    raise
+            
+                if self.stream:
+                    response_text, usage, streamed_pairs, decode_seconds = result
+                else:
+                    # 获取响应文本
+                    response_text = result.choices[0].message.content
+                    usage = getattr(result, "usage", None)
+                    streamed_pairs = None
+                    decode_seconds = None
+                latency = time.monotonic() - start_time
+            finally:
+                await concurrency.release()
+        except BaseException:
+            # 请求失败或被取消（如对冲请求中落败的一方）时按已收到的文本修正预留量，避免预留的token一直被占用
+            rate_limiter.record_usage(estimated_tokens, estimate_tokens(prompt) + estimate_tokens("".join(received)))
+            raise
+        
+        self._record_call(usage)
+        self._pair_latencies.append(latency / max(1, num_pairs))
+        actual_tokens = getattr(usage, "total_tokens", None)
+        if actual_tokens is None:
+            # 没有用量信息（流式提前结束或服务端未返回）时按提示词和已收到的文本估算，退还多预留的token
+            actual_tokens = estimate_tokens(prompt) + estimate_tokens(response_text)
+        rate_limiter.record_usage(estimated_tokens, actual_tokens)
+        # 拥塞判断按解码速度：流式请求不计首个token之前的排队和预填充时间
+        await concurrency.on_success(decode_seconds if decode_seconds is not None else latency,
+                                     getattr(usage, "completion_tokens", None) or estimate_tokens(response_text))
+        return response_text, usage, streamed_pairs
+    
+    async def _acomplete_hedged(self, model, prompt, num_pairs, on_pair, max_tokens):
+        """
+        执行一次API调用；启用对冲时，超过p95延迟仍未完成则再发送一个相同请求，取先成功完成的结果
+        
+        Returns:
+            tuple: (响应文本, token用量或None, 流式解析出的问答对列表或None)
+        """
+        delay = self._hedge_delay(num_pairs) if self.hedge else None
+        if delay is None:
+            return await self._acomplete(model, prompt, num_pairs, on_pair, max_tokens)
+        
+        # 记录主请求已经回调的问答对数量，对冲请求胜出时只补发其余部分
+        notified = [0]
+        def primary_on_pair(qa):
+            notified[0] += 1
+            on_pair(qa)
+        
+        # 对冲计时从主请求真正开始调用时算起，排队等待限流和并发名额的时间不计入
+        started = asyncio.Event()
+        primary = asyncio.ensure_future(self._acomplete(model, prompt, num_pairs,
+                                                        primary_on_pair if on_pair else None, max_tokens, started))
+        started_waiter = asyncio.ensure_future(started.wait())
+        try:
+            await asyncio.wait({primary, started_waiter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            started_waiter.cancel()
+        if not primary.done():
+            await asyncio.wait({primary}, timeout=delay)
+        if primary.done():
+            return primary.result()
+        
+        logger.info(f"请求超过对冲延迟 {delay:.1f} 秒仍未完成，发送对冲请求")
+        self._count("hedges_sent")
+        hedge = asyncio.ensure_future(self._acomplete(model, prompt, num_pairs, None, max_tokens))
+        
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is hedge:
+                        self._count("hedges_won")
+                        streamed_pairs = task.result()[2]
+                        if streamed_pairs:
+                            self._notify(on_pair, streamed_pairs[notified[0]:])
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    @staticmethod
+    def _once_per_question(on_pair, limit):
+        """
+        包装问答对回调：同一问题文本只回调一次，总回调次数不超过limit
+        
+        Args:
+            on_pair (callable): 原回调
+            limit (int): 最多回调的问答对数量
+            
+        Returns:
+            callable: 包装后的回调
+        """
+        reported = set()
+        
+        def on_new_pair(qa):
+            question = str(qa.get('question', '')).strip()
+            if question in reported or len(reported) >= limit:
+                return
+            reported.add(question)
+            on_pair(qa)
+        
+        return on_new_pair
+    
+    @staticmethod
+    def _notify(on_pair, qa_pairs):
+        """依次回调问答对，回调出错只记录日志"""
+        if on_pair is None:
+            return
+        for qa in qa_pairs:
+            try:
+                on_pair(qa)
+            except Exception as e:
+                logger.warning(f"问答对回调出错: {str(e)}")
+    
+    async def _astream_completion(self, model, prompt, num_pairs, on_pair, max_tokens, parts=None):
+        """
+        流式调用API，每个问答对闭合时立即解析并回调，收到num_pairs个有效问答对后提前结束；
+        提前结束时收不到token用量，由调用方按已收到的文本估算
+        
+        Args:
+            model (str): 模型名称
+            prompt (str): 完整的提示词
+            num_pairs (int): 期望生成的问答对数量
+            on_pair (callable): 每收到一个问答对时的回调
+            max_tokens (int): 最大生成token数
+            parts (list): 收集已收到文本片段的列表，请求中途结束时调用方据此估算用量
+            
+        Returns:
+            tuple: (已收到的响应文本, token用量或None, 流式解析出的问答对列表, 首个token到结束的解码耗时或None)
+        """
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            temperature=TEMPERATURE,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        
+        parser = IncrementalJSONArrayParser()
+        parts = [] if parts is None else parts
+        qa_pairs = []
+        usage = None
+        first_token_at = None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                parts.append(delta)
+                
+                new_pairs = self._validate_qa_pairs(parser.feed(delta))[:num_pairs - len(qa_pairs)]
+                qa_pairs.extend(new_pairs)
+                self._notify(on_pair, new_pairs)
+                
+                if len(qa_pairs) >= num_pairs:
+                    logger.info(f"已收到 {len(qa_pairs)} 个问答对，提前结束流式生成")
+                    break
+        finally:
+            await stream.close()
+        
+        decode_seconds = time.monotonic() - first_token_at if first_token_at is not None else None
+        return "".join(parts), usage, qa_pairs, decode_seconds
+    
+    async def _agenerate_qa_pairs(self, prompt, num_pairs, on_pair=None, max_tokens=None):
+        """在共享事件循环中执行带重试的问答对生成"""
+        model = os.getenv("MODEL_NAME", "deepseek-chat")
+        max_tokens = max_tokens or MAX_COMPLETION_TOKENS
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(prompt, model, TEMPERATURE, max_tokens)
+            # SQLite读写放到线程池执行，避免阻塞共享事件循环中的其他请求
+            cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if cached is not None:
+                logger.info(f"命中响应缓存，返回 {len(cached['qa_pairs'])} 个问答对")
+                with self._stats_lock:
+                    self.stats["response_cache_hits"] += 1
+                self._notify(on_pair, cached["qa_pairs"])
+                return cached["qa_pairs"]
+        
+        if self.cache_only:
+            logger.warning("仅缓存回放模式下未命中响应缓存，跳过API调用")
+            return []
+        
+        # 重试时不再回调之前的尝试已经报告过的问答对，且本次调用最多回调num_pairs个，避免进度超过100%
+        if on_pair is not None:
+            on_pair = self._once_per_question(on_pair, num_pairs)
+        
+        concurrency = _get_concurrency_limiter(self.max_concurrent_requests)
+        breaker = None
+        if self.breaker_error_rate:
+            breaker = _get_circuit_breaker(self.api_base, self.breaker_error_rate, self.breaker_cooldown)
+        
+        # 格式有误且取回数量不足时保留最好的部分结果，重试全部失败后返回
+        best_partial = []
+        
         # 实现重试机制
         attempts = 0
         while attempts < self.max_retries:
             attempts += 1
+            ticket = None
             try:
                 if attempts == 1:
                     logger.info("开始调用DeepSeek API生成问答对")
                 else:
                     logger.info(f"重试调用DeepSeek API (第 {attempts-1}/{self.max_retries-1} 次重试)")
                 
-                # 使用OpenAI SDK调用API
-                response = self.client.chat.completions.create(
-                    model = os.getenv("MODEL_NAME", "deepseek-chat"),
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=8000  # 增加token数量以支持更复杂的回答
-                )
+                # 服务端错误率过高时快速失败，不再消耗重试次数
+                if breaker is not None:
+                    ticket = breaker.allow()
+                    if ticket is None:
+                        raise CircuitOpenError("DeepSeek API错误率过高，熔断器打开中")
                 
-                # 获取响应文本
-                response_text = response.choices[0].message.content
+                # 使用OpenAI SDK调用API，受RPM/TPM限流、AIMD并发控制和截止时间约束
+                response_text, usage, streamed_pairs = await self._acomplete_hedged(
+                    model, prompt, num_pairs, on_pair, max_tokens)
+                if breaker is not None:
+                    breaker.record_success(ticket)
                 
-                # 尝试解析JSON
-                import json
-                import re
+                if streamed_pairs is not None and len(streamed_pairs) >= num_pairs:
+                    # 提前结束时响应文本不完整，直接使用流式解析结果
+                    qa_pairs, complete = streamed_pairs[:num_pairs], True
+                else:
+                    qa_pairs, complete = self._parse_response(response_text)
                 
-                try:
-                    # 尝试直接解析JSON
-                    qa_pairs = json.loads(response_text)
-                    logger.info(f"成功生成 {len(qa_pairs)} 个问答对")
-                    
-                    # 验证问答对格式
-                    self._validate_qa_pairs(qa_pairs)
-                    
+                if qa_pairs and (complete or len(qa_pairs) >= self.min_recovery_ratio * num_pairs):
+                    if streamed_pairs is None:
+                        self._notify(on_pair, qa_pairs)
+                    if self.response_cache is not None:
+                        await asyncio.to_thread(self.response_cache.put, cache_key, model, response_text, qa_pairs)
                     return qa_pairs
-                except json.JSONDecodeError:
-                    # 如果直接解析失败，尝试从文本中提取JSON部分
-                    json_match = re.search(r'\[\s*{.*}\s*\]', response_text, re.DOTALL)
-                    if json_match:
-                        try:
-                            qa_pairs = json.loads(json_match.group(0))
-                            logger.info(f"成功从部分响应中提取并生成 {len(qa_pairs)} 个问答对")
-                            
-                            # 验证问答对格式
-                            self._validate_qa_pairs(qa_pairs)
-                            
-                            return qa_pairs
-                        except json.JSONDecodeError:
-                            logger.error("无法解析API返回的JSON格式")
-                            # 继续重试
-                    else:
-                        logger.error("无法从API响应中提取JSON")
-                        logger.debug(f"API响应内容: {response_text[:200]}...")
-                        # 继续重试
                 
+                # 解析失败或修复后取回的数量不足，继续重试
+                if len(qa_pairs) > len(best_partial):
+                    best_partial = qa_pairs
+                logger.warning(f"响应格式有误，仅取回 {len(qa_pairs)}/{num_pairs} 个问答对，重新请求")
+                
+            except CircuitOpenError as e:
+                self._count("breaker_rejections")
+                logger.warning(f"{str(e)}，跳过本次请求")
+                break
             except Exception as e:
-                logger.error(f"调用DeepSeek API生成问答对时出错: {str(e)}")
+                logger.error(f"调用DeepSeek API生成问答对时出错: {str(e) or type(e).__name__}")
+                if breaker is not None and breaker.record_failure(ticket):
+                    self._count("breaker_opens")
+                retry_after = parse_retry_after(e)
+                if _is_congestion_error(e):
+                    await concurrency.on_congestion(type(e).__name__)
+                
                 # 如果已经达到最大重试次数，则退出循环
                 if attempts >= self.max_retries:
                     break
                 
-                # 否则等待后继续重试
-                wait_time = self.retry_delay * (attempts-1)  # 指数退避策略
-                logger.info(f"将在 {wait_time} 秒后进行重试")
-                time.sleep(wait_time)
+                # 否则按带抖动的指数退避等待后重试，服务端给出Retry-After时遵从
+                wait_time = backoff_delay(attempts, self.retry_delay, retry_after=retry_after)
+                logger.info(f"将在 {wait_time:.1f} 秒后进行重试")
+                await asyncio.sleep(wait_time)
+            finally:
+                # 请求被取消或未记录结果时也交回凭证，避免探测请求一直占用半开状态
+                if breaker is not None:
+                    breaker.release(ticket)
+        
+        if best_partial:
+            logger.warning(f"经过 {self.max_retries} 次尝试后仍未得到完整响应，返回修复取回的 {len(best_partial)} 个问答对")
+            if not self.stream:
+                self._notify(on_pair, best_partial)
+            return best_partial
         
         # 如果所有重试都失败了
         logger.error(f"经过 {self.max_retries} 次尝试后，仍然无法成功调用DeepSeek API")
         return []
     
+    def _parse_response(self, response_text):
+        """
+        从API响应文本中解析问答对，格式有误时在线性时间内修复并取回所有完整的对象
+        
+        Args:
+            response_text (str): API返回的文本
+            
+        Returns:
+            tuple: (问答对列表, 是否为格式完整的JSON)
+        """
+        try:
+            # 尝试直接解析JSON
+            qa_pairs = json.loads(response_text)
+            if isinstance(qa_pairs, list):
+                qa_pairs = self._validate_qa_pairs(qa_pairs)
+                logger.info(f"成功生成 {len(qa_pairs)} 个问答对")
+                return qa_pairs, True
+        except (json.JSONDecodeError, TypeError):
+            pass
+        
+        # 直接解析失败（代码块包裹、结尾逗号、未转义引号、输出被截断等），逐个取回完整的对象
+        objects, salvage = salvage_json_objects(response_text)
+        qa_pairs = self._validate_qa_pairs(objects)
+        if qa_pairs:
+            logger.info(f"从格式有误的响应中取回 {len(qa_pairs)} 个问答对"
+                        f"（修复 {salvage['repaired']} 个，跳过 {salvage['skipped']} 个，截断: {salvage['truncated']}）")
+        else:
+            logger.error("无法从API响应中提取JSON")
+            logger.debug(f"API响应内容: {(response_text or '')[:200]}...")
+        
+        # 只有代码块等包裹、没有修复、跳过或截断时，视为格式完整
+        complete = bool(qa_pairs) and not (salvage['repaired'] or salvage['skipped'] or salvage['truncated'])
+        return qa_pairs, complete
+    
     def _validate_qa_pairs(self, qa_pairs):
         """
         验证问答对格式并进行必要的修复
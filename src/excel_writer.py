@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import os
-import pandas as pd
 import logging
 from datetime import datetime
 import json
@@ -39,6 +38,9 @@ class ExcelWriter:
         Returns:
             str: 保存的Excel文件路径
         """
+        # pandas和openpyxl只在真正写Excel时加载，缩短CLI和Web应用的启动时间
+        import pandas as pd
+        
         try:
             # 准备数据
             data = []
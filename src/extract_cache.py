@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class ExtractCache:
+    """基于内容哈希的PDF提取结果磁盘缓存，按最近使用时间(LRU)限制总大小"""
+
+    def __init__(self, cache_dir=".cache/extract", max_size_mb=512):
+        """
+        初始化提取缓存
+
+        Args:
+            cache_dir (str): 缓存目录
+            max_size_mb (int): 缓存目录的最大总大小(MB)，超出时淘汰最久未使用的条目
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        logger.info(f"提取缓存初始化，目录: {cache_dir}, 上限: {max_size_mb}MB")
+
+    def make_key(self, pdf_path, settings):
+        """
+        根据文件字节和提取设置计算缓存键
+
+        Args:
+            pdf_path (str): PDF文件路径
+            settings (dict): 影响提取结果的设置（如use_latex_ocr、后端版本）
+
+        Returns:
+            str: 十六进制缓存键
+        """
+        hasher = hashlib.sha256()
+        with open(pdf_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        hasher.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        读取缓存条目
+
+        Args:
+            key (str): 缓存键
+
+        Returns:
+            dict: 缓存内容（text、formulas、metadata），未命中时返回None
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            # 更新访问时间，用于LRU淘汰
+            os.utime(path, None)
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"读取提取缓存失败，忽略该条目: {str(e)}")
+            return None
+
+    def put(self, key, entry):
+        """
+        写入缓存条目，并在超出大小上限时淘汰旧条目
+
+        Args:
+            key (str): 缓存键
+            entry (dict): 缓存内容（text、formulas、metadata）
+        """
+        path = self._entry_path(key)
+        tmp_path = None
+        try:
+            # 临时文件名唯一，多个进程（提取进程池、多个Web任务）同时写入同一条目时互不覆盖
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{key}.", suffix=".tmp", dir=self.cache_dir)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"写入提取缓存失败: {str(e)}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._evict()
+
+    def _evict(self):
+        """按最近使用时间淘汰条目，直到总大小不超过上限"""
+        with self._lock:
+            entries = []
+            total_size = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+            if total_size <= self.max_size_bytes:
+                return
+
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_size_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total_size -= size
+                    logger.debug(f"淘汰提取缓存条目: {path}")
+                except FileNotFoundError:
+                    continue
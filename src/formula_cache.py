@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class FormulaCache:
+    """按公式图像感知哈希缓存LatexOCR识别结果，内存LRU + 可选的SQLite持久化存储"""
+
+    def __init__(self, max_entries=10000, cache_dir=None):
+        """
+        初始化公式缓存
+
+        Args:
+            max_entries (int): 内存中最多保留的条目数
+            cache_dir (str): 持久化存储目录，为None时只使用内存缓存
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                self._db = sqlite3.connect(os.path.join(cache_dir, "formulas.sqlite3"), check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS formulas (key TEXT PRIMARY KEY, latex TEXT NOT NULL)")
+                self._db.commit()
+            except Exception as e:
+                logger.error(f"打开公式持久化缓存失败，仅使用内存缓存: {str(e)}")
+                self._db = None
+
+        logger.info(f"公式缓存初始化，内存上限: {max_entries} 条, 持久化: {self._db is not None}")
+
+    @staticmethod
+    def image_hash(img, hash_width=64, hash_height=16):
+        """
+        计算公式图像的感知哈希（差值哈希 + 宽高比分桶）
+
+        对渲染噪声不敏感，但保留足够分辨率区分上下标等细节。
+
+        Args:
+            img (PIL.Image): 公式图像
+            hash_width (int): 差值哈希的列数
+            hash_height (int): 差值哈希的行数
+
+        Returns:
+            str: 哈希键
+        """
+        import numpy as np
+        from PIL import Image
+
+        gray = img.convert('L')
+        width, height = gray.size
+        aspect_bucket = round(width / max(1, height) * 4)
+        small = np.asarray(gray.resize((hash_width + 1, hash_height), Image.Resampling.BILINEAR), dtype=np.int16)
+        bits = (small[:, 1:] > small[:, :-1]).flatten()
+        return f"{aspect_bucket}:{np.packbits(bits).tobytes().hex()}"
+
+    def get(self, key):
+        """
+        查询缓存
+
+        Args:
+            key (str): 感知哈希键
+
+        Returns:
+            str: LaTeX字符串，未命中时返回None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT latex FROM formulas WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._store_in_memory(key, row[0])
+            return row[0]
+
+    def put(self, key, latex):
+        """
+        写入缓存
+
+        Args:
+            key (str): 感知哈希键
+            latex (str): 识别出的LaTeX字符串
+        """
+        with self._lock:
+            self._store_in_memory(key, latex)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO formulas (key, latex) VALUES (?, ?)", (key, latex))
+                    self._db.commit()
+                except Exception as e:
+                    logger.warning(f"写入公式持久化缓存失败: {str(e)}")
+
+    def _store_in_memory(self, key, latex):
+        """写入内存LRU并淘汰最久未使用的条目（调用方需持有锁）"""
+        self._entries[key] = latex
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
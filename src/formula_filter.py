@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import logging
+import unicodedata
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 常见数学字体名称片段（TeX Computer Modern数学字体、AMS符号字体、Symbol等）
+MATH_FONT_MARKERS = (
+    "CMMI", "CMSY", "CMEX", "CMBSY", "MSAM", "MSBM", "EUFM", "EUSM", "RSFS",
+    "SYMBOL", "MATH", "STIX", "ESINT", "WASY"
+)
+
+# 数学相关的Unicode区段：希腊字母、箭头、数学运算符、杂项技术符号、补充运算符、数学字母数字符号
+MATH_UNICODE_RANGES = (
+    (0x0370, 0x03FF),
+    (0x2190, 0x21FF),
+    (0x2200, 0x22FF),
+    (0x2300, 0x23FF),
+    (0x27C0, 0x27EF),
+    (0x2980, 0x29FF),
+    (0x2A00, 0x2AFF),
+    (0x1D400, 0x1D7FF),
+)
+
+# 在正文中也常见、但在公式中密集出现的ASCII符号
+ASCII_MATH_CHARS = set("=+-*/^_<>{}")
+
+# 括号和竖线也大量用于引用和编号，只有与运算符或数学字体同时出现时才计为数学符号
+BRACKET_CHARS = set("()[]|")
+
+# 引用和列表编号，如 (a)、[12]、(1)、iv.
+LABEL_PATTERN = re.compile(r'^[\(\[]?\w{1,3}[\)\]\.]$')
+
+
+class FormulaFilter:
+    """基于PyMuPDF文本块span信息的廉价公式区域分类器，用于在OCR前过滤非公式块"""
+
+    def __init__(self, max_lines=3, min_math_font_ratio=0.3, min_symbol_ratio=0.15,
+                 max_letter_ratio=0.85, max_glyph_density=1.2):
+        """
+        初始化公式过滤器
+
+        Args:
+            max_lines (int): 候选块的最大行数
+            min_math_font_ratio (float): 数学字体字符占比达到该值即判定为公式
+            min_symbol_ratio (float): 数学符号占比达到该值即判定为公式
+            max_letter_ratio (float): 普通字母占比超过该值的长文本判定为正文
+            max_glyph_density (float): 每个字号宽度内的平均字符数低于该值视为稀疏排版（公式特征）
+        """
+        self.max_lines = max_lines
+        self.min_math_font_ratio = min_math_font_ratio
+        self.min_symbol_ratio = min_symbol_ratio
+        self.max_letter_ratio = max_letter_ratio
+        self.max_glyph_density = max_glyph_density
+
+    @staticmethod
+    def _is_math_char(ch):
+        """判断字符是否属于数学符号"""
+        if ch in ASCII_MATH_CHARS:
+            return True
+        code = ord(ch)
+        for start, end in MATH_UNICODE_RANGES:
+            if start <= code <= end:
+                return True
+        return unicodedata.category(ch) == "Sm"
+
+    @staticmethod
+    def _is_math_font(font_name):
+        """判断字体名称是否为数学字体"""
+        name = (font_name or "").upper()
+        return any(marker in name for marker in MATH_FONT_MARKERS)
+
+    def is_formula(self, block):
+        """
+        判断PyMuPDF "dict" 格式的文本块是否可能是公式
+
+        Args:
+            block (dict): page.get_text("dict") 返回的文本块
+
+        Returns:
+            bool: 是否值得送入LatexOCR
+        """
+        lines = block.get("lines")
+        if not lines or len(lines) > self.max_lines:
+            return False
+
+        total_chars = 0
+        math_font_chars = 0
+        symbol_chars = 0
+        letter_chars = 0
+        digit_chars = 0
+        bracket_chars = 0
+        size_sum = 0.0
+        text_parts = []
+
+        for line in lines:
+            for span in line.get("spans", []):
+                text = span.get("text", "")
+                text_parts.append(text)
+                math_font = self._is_math_font(span.get("font"))
+                for ch in text:
+                    if ch.isspace():
+                        continue
+                    total_chars += 1
+                    size_sum += span.get("size", 0)
+                    if math_font:
+                        math_font_chars += 1
+                    if ch in BRACKET_CHARS:
+                        bracket_chars += 1
+                    elif self._is_math_char(ch):
+                        symbol_chars += 1
+                    elif ch.isdigit():
+                        digit_chars += 1
+                    elif ch.isalpha():
+                        letter_chars += 1
+
+        if total_chars == 0:
+            return False
+
+        # 纯数字的短块通常是页码或编号
+        if digit_chars == total_chars:
+            return False
+
+        # 引用或列表编号
+        if LABEL_PATTERN.match("".join("".join(text_parts).split())):
+            return False
+
+        if symbol_chars or math_font_chars:
+            symbol_chars += bracket_chars
+
+        # 数学字体是最可靠的信号
+        if math_font_chars / total_chars >= self.min_math_font_ratio:
+            return True
+
+        # 数学符号密集
+        if symbol_chars / total_chars >= self.min_symbol_ratio:
+            return True
+
+        # 字母占比很高的较长文本是正文、标题或图注
+        if total_chars > 20 and letter_chars / total_chars > self.max_letter_ratio:
+            return False
+
+        # 稀疏排版且含有符号或数字（如分式、上下标）
+        x0, _, x1, _ = block["bbox"]
+        avg_size = size_sum / total_chars
+        if avg_size > 0 and (symbol_chars or digit_chars):
+            glyph_density = total_chars / max(1.0, (x1 - x0) / avg_size)
+            if glyph_density < self.max_glyph_density:
+                return True
+
+        return False
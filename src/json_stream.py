@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 对象或数组结尾处多余的逗号
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+# 字符串结束引号之后允许出现的字符；其他字符前的引号视为未转义的字面引号
+_STRING_TERMINATORS = ',:}]'
+
+class IncrementalJSONArrayParser:
+    """
+    增量解析流式输出中的JSON数组：每个顶层对象的右花括号到达时立即解析并返回该对象
+
+    对常见的格式错误做线性时间修复：忽略markdown代码块等前后缀，转义字符串中未转义的引号，
+    去掉多余的结尾逗号；无法修复的对象和被截断的最后一个对象会被跳过，不影响其他对象。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0              # 缓冲区中下一个待扫描字符的位置
+        self._in_array = False     # 是否已进入顶层数组（忽略 ```json 等前缀）
+        self._depth = 0            # 数组内部的括号深度
+        self._in_string = False
+        self._escape = False
+        self._object_start = None  # 当前顶层对象在缓冲区中的起始位置
+        self._literal_quotes = []  # 当前对象中需要转义的字面引号位置
+        self.repaired = 0          # 经修复后才能解析的对象数
+        self.skipped = 0           # 无法解析而跳过的对象数
+        self.truncated = False     # 输出是否在数组闭合前结束
+
+    def feed(self, text):
+        """
+        输入一段新文本
+
+        Args:
+            text (str): 流式响应的增量文本
+
+        Returns:
+            list: 本次输入后完整闭合的顶层对象(dict)列表
+        """
+        self._buffer += text
+        return self._scan(final=False)
+
+    def finish(self):
+        """
+        输入结束，处理缓冲区中剩余的文本
+
+        Returns:
+            list: 剩余的完整闭合的顶层对象(dict)列表
+        """
+        objects = self._scan(final=True)
+        if self._object_start is not None:
+            logger.debug("响应在对象中间被截断，丢弃最后一个不完整的对象")
+            self.skipped += 1
+        self.truncated = self._in_array
+        return objects
+
+    def _scan(self, final):
+        """从上次停止的位置继续扫描缓冲区"""
+        buf = self._buffer
+        objects = []
+
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    # 向后查看下一个非空白字符，判断这是结束引号还是字面引号
+                    j = i + 1
+                    while j < len(buf) and buf[j].isspace():
+                        j += 1
+                    if j == len(buf) and not final:
+                        break  # 等待更多输入再判断
+                    if j == len(buf) or buf[j] in _STRING_TERMINATORS:
+                        self._in_string = False
+                    elif self._object_start is not None:
+                        self._literal_quotes.append(i)
+            elif not self._in_array:
+                if ch == '[':
+                    self._in_array = True
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if self._depth == 0 and ch == '{':
+                    self._object_start = i
+                    self._literal_quotes = []
+                self._depth += 1
+            elif ch in '}]':
+                if self._depth == 0:
+                    # 顶层数组结束
+                    self._in_array = False
+                else:
+                    self._depth -= 1
+                    if self._depth == 0 and self._object_start is not None:
+                        obj = self._load_object(buf, self._object_start, i + 1)
+                        if obj is not None:
+                            objects.append(obj)
+                        self._object_start = None
+                        self._literal_quotes = []
+            i += 1
+
+        # 只保留尚未闭合的对象，避免缓冲区随响应长度增长
+        keep = self._object_start if self._object_start is not None else i
+        self._buffer = buf[keep:]
+        self._pos = i - keep
+        if self._object_start is not None:
+            self._object_start = 0
+            self._literal_quotes = [pos - keep for pos in self._literal_quotes]
+        return objects
+
+    def _load_object(self, buf, start, end):
+        """解析一个顶层对象，必要时转义字面引号、去掉结尾逗号后重试"""
+        raw = buf[start:end]
+        try:
+            obj = json.loads(raw, strict=False)
+            return obj if isinstance(obj, dict) else None
+        except json.JSONDecodeError:
+            pass
+
+        if self._literal_quotes:
+            pieces = []
+            last = start
+            for pos in self._literal_quotes:
+                pieces.append(buf[last:pos])
+                pieces.append('\\"')
+                last = pos + 1
+            pieces.append(buf[last:end])
+            raw = "".join(pieces)
+        raw = _TRAILING_COMMA.sub(r'\1', raw)
+
+        try:
+            obj = json.loads(raw, strict=False)
+        except json.JSONDecodeError as e:
+            logger.debug(f"跳过无法解析的JSON对象: {str(e)}")
+            self.skipped += 1
+            return None
+        if not isinstance(obj, dict):
+            return None
+        self.repaired += 1
+        return obj
+
+def salvage_json_objects(text):
+    """
+    从可能不完整或格式错误的模型输出中尽量取出所有完整的顶层数组对象
+
+    Args:
+        text (str): 模型输出文本
+
+    Returns:
+        tuple: (对象列表, 统计信息dict: repaired修复的对象数, skipped跳过的对象数, truncated是否被截断)
+    """
+    parser = IncrementalJSONArrayParser()
+    objects = parser.feed(text or "")
+    objects.extend(parser.finish())
+    return objects, {"repaired": parser.repaired, "skipped": parser.skipped, "truncated": parser.truncated}
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 进程内共享的LatexOCR模型及按批量设置共享的推理队列
+_shared_model = None
+_shared_batchers = {}
+_shared_lock = threading.Lock()
+
+# 所有推理队列共用同一份模型权重，推理需串行化
+_inference_lock = threading.Lock()
+
+def get_shared_latex_ocr():
+    """
+    获取进程内共享的LatexOCR模型，首次调用时加载
+    
+    Returns:
+        LatexOCR: 模型实例
+    """
+    global _shared_model
+    with _shared_lock:
+        if _shared_model is None:
+            from pix2tex.cli import LatexOCR
+            
+            logger.info("正在加载LatexOCR模型...")
+            start_time = time.monotonic()
+            _shared_model = LatexOCR()
+            logger.info(f"LatexOCR模型加载完成，用时 {time.monotonic() - start_time:.1f}秒")
+        return _shared_model
+
+def get_shared_batcher(batch_size=8, max_wait=0.05):
+    """
+    获取使用共享模型、指定批量设置的推理队列，相同设置的调用方共用一个队列以便跨任务凑批
+    
+    Args:
+        batch_size (int): 每批最多的图像数
+        max_wait (float): 凑批时等待后续图像的最长时间(秒)
+        
+    Returns:
+        LatexOCRBatcher: 推理队列
+    """
+    model = get_shared_latex_ocr()
+    key = (max(1, batch_size), max_wait)
+    with _shared_lock:
+        if key not in _shared_batchers:
+            _shared_batchers[key] = LatexOCRBatcher(model, *key)
+        return _shared_batchers[key]
+
+def preload_latex_ocr():
+    """
+    预加载共享LatexOCR模型（如在服务启动时调用），失败时只记录日志
+    
+    Returns:
+        bool: 是否加载成功
+    """
+    try:
+        get_shared_latex_ocr()
+        return True
+    except Exception as e:
+        logger.error(f"预加载LatexOCR模型失败: {str(e)}")
+        return False
+
+class LatexOCRBatcher:
+    """LatexOCR批量推理队列：跨页面、跨文档收集公式图像，按固定大小的填充批次送入pix2tex编码器/解码器"""
+
+    def __init__(self, latex_ocr, batch_size=8, max_wait=0.05):
+        """
+        初始化批量推理队列
+
+        Args:
+            latex_ocr: pix2tex的LatexOCR模型实例
+            batch_size (int): 每批最多的图像数
+            max_wait (float): 凑批时等待后续图像的最长时间(秒)
+        """
+        self.latex_ocr = latex_ocr
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._batched_inference = True
+        self._stats_lock = threading.Lock()
+        self.total_formulas = 0
+        self.total_seconds = 0.0
+        self.total_batches = 0
+
+        self._worker = threading.Thread(target=self._run, name="latex-ocr-batcher", daemon=True)
+        self._worker.start()
+        logger.info(f"LatexOCR批量推理队列已启动，批大小: {self.batch_size}, 最长等待: {self.max_wait}秒")
+
+    def submit(self, img):
+        """
+        提交一张公式图像
+
+        Args:
+            img (PIL.Image): 公式区域图像
+
+        Returns:
+            Future: 结果为识别出的LaTeX字符串
+        """
+        future = Future()
+        self._queue.put((img, future))
+        return future
+
+    def recognize(self, images):
+        """
+        提交一组图像并等待全部结果
+
+        Args:
+            images (list): PIL图像列表
+
+        Returns:
+            list: 与输入顺序一致的LaTeX字符串列表，识别失败的位置为None
+        """
+        futures = [self.submit(img) for img in images]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.debug(f"公式识别失败: {str(e)}")
+                results.append(None)
+        return results
+
+    def formulas_per_second(self):
+        """返回累计的公式识别吞吐量(公式/秒)"""
+        with self._stats_lock:
+            if self.total_seconds <= 0:
+                return 0.0
+            return self.total_formulas / self.total_seconds
+
+    def _run(self):
+        """后台线程：按批大小或最长等待时间凑批并执行推理"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            images = [img for img, _ in batch]
+            futures = [future for _, future in batch]
+            start_time = time.monotonic()
+            try:
+                with _inference_lock:
+                    results = self._infer(images)
+                for future, latex in zip(futures, results):
+                    if isinstance(latex, Exception):
+                        future.set_exception(latex)
+                    else:
+                        future.set_result(latex)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            elapsed = time.monotonic() - start_time
+
+            with self._stats_lock:
+                self.total_formulas += len(batch)
+                self.total_seconds += elapsed
+                self.total_batches += 1
+            logger.debug(f"LatexOCR批次完成: {len(batch)} 个公式, 用时 {elapsed:.2f}秒")
+
+    def _infer(self, images):
+        """
+        对一批图像执行推理，批量推理失败时退化为逐张调用
+
+        Args:
+            images (list): PIL图像列表
+
+        Returns:
+            list: LaTeX字符串或异常对象
+        """
+        if self._batched_inference and len(images) > 1:
+            try:
+                return self._infer_batched(images)
+            except Exception as e:
+                # pix2tex内部接口不可用时不再尝试批量推理
+                logger.warning(f"LatexOCR批量推理不可用，改为逐张推理: {str(e)}")
+                self._batched_inference = False
+
+        results = []
+        for img in images:
+            try:
+                results.append(self.latex_ocr(img))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _preprocess(self, img):
+        """
+        复现LatexOCR.__call__中的预处理（尺寸约束与分辨率自适应），返回预处理后的图像
+
+        Args:
+            img (PIL.Image): 原始公式图像
+
+        Returns:
+            PIL.Image: 预处理后的灰度图像
+        """
+        import numpy as np
+        import torch
+        from PIL import Image
+        from pix2tex.cli import pad, minmax_size, test_transform
+
+        ocr = self.latex_ocr
+        args = ocr.args
+        img = minmax_size(pad(img), args.max_dimensions, args.min_dimensions)
+        if ocr.image_resizer is None or args.no_resize:
+            return pad(img)
+
+        with torch.no_grad():
+            input_image = img.convert('RGB').copy()
+            r, w, h = 1, input_image.size[0], input_image.size[1]
+            for _ in range(10):
+                h = int(h * r)
+                resample = Image.Resampling.BILINEAR if r > 1 else Image.Resampling.LANCZOS
+                img = pad(minmax_size(input_image.resize((w, h), resample), args.max_dimensions, args.min_dimensions))
+                t = test_transform(image=np.array(img.convert('RGB')))['image'][:1].unsqueeze(0)
+                w = (ocr.image_resizer(t.to(args.device)).argmax(-1).item() + 1) * 32
+                if w == img.size[0]:
+                    break
+                r = w / img.size[0]
+        return img
+
+    def _infer_batched(self, images):
+        """
+        将一批图像填充到相同尺寸后一次送入编码器/解码器
+
+        Args:
+            images (list): PIL图像列表
+
+        Returns:
+            list: LaTeX字符串列表
+        """
+        import numpy as np
+        import torch
+        from PIL import Image
+        from pix2tex.cli import test_transform, token2str, post_process
+
+        ocr = self.latex_ocr
+        processed = [self._preprocess(img).convert('L') for img in images]
+
+        # 以白色背景左上对齐填充到批内最大尺寸（与pix2tex的pad方式一致）
+        max_w = max(img.size[0] for img in processed)
+        max_h = max(img.size[1] for img in processed)
+        tensors = []
+        for img in processed:
+            canvas = Image.new('L', (max_w, max_h), 255)
+            canvas.paste(img, (0, 0))
+            tensors.append(test_transform(image=np.array(canvas.convert('RGB')))['image'][:1].unsqueeze(0))
+
+        with torch.no_grad():
+            batch = torch.cat(tensors).to(ocr.args.device)
+            dec = ocr.model.generate(batch, temperature=ocr.args.get('temperature', .25))
+        return [post_process(pred) for pred in token2str(dec, ocr.tokenizer)]
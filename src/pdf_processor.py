@@ -5,42 +5,184 @@ import os
 import logging
 import re
 import io
-import numpy as np
-from PIL import Image
-import PyPDF2
-import pdfplumber
+import math
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # PyMuPDF
-from pix2tex.cli import LatexOCR
+from .extract_cache import ExtractCache
+from .formula_filter import FormulaFilter
+from .ocr_batcher import get_shared_batcher
+from .formula_cache import FormulaCache
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 提取逻辑版本号，提取结果的格式或算法变化时递增，使旧缓存失效
+EXTRACTOR_VERSION = 3
+
+# 公式OCR渲染倍率（相对于72dpi）
+OCR_ZOOM = 2
+
+# 共享页面光栅模式下，累计这么多页的候选后提交识别，限制同时保留的页面光栅数量
+OCR_FLUSH_PAGES = 16
+
+# 页范围分片工作进程中复用的处理器（每个进程一个）
+_shard_processor = None
+_shard_options = None
+
+def _extract_page_range_worker(pdf_path, start, end, options):
+    """
+    在工作进程中独立打开PDF并处理 [start, end) 页范围
+    
+    Args:
+        pdf_path (str): PDF文件路径
+        start (int): 起始页（包含）
+        end (int): 结束页（不包含）
+        options (dict): 创建工作进程内PDFProcessor的参数（use_latex_ocr、OCR批量设置等）
+        
+    Returns:
+        tuple: (页面文本列表, 公式列表, 统计信息)
+    """
+    global _shard_processor, _shard_options
+    if _shard_processor is None or _shard_options != options:
+        _shard_processor = PDFProcessor(os.path.dirname(pdf_path), use_extract_cache=False, **options)
+        _shard_options = options
+    
+    stats = {}
+    with fitz.open(pdf_path) as doc:
+        page_texts, formulas = _shard_processor._process_page_range(doc, start, end, stats)
+    return page_texts, formulas, stats
+
+# 流水线提取阶段工作进程中复用的处理器（每个进程一个）
+_document_processor = None
+_document_options = None
+
+def extract_document_worker(pdf_path, options):
+    """
+    在工作进程中提取整篇PDF（经过提取缓存），供批量处理流水线的提取阶段使用
+    
+    Args:
+        pdf_path (str): PDF文件路径
+        options (dict): 创建工作进程内PDFProcessor的参数，由PDFProcessor.document_worker_options()生成
+        
+    Returns:
+        tuple: (增强文本内容, 文件名, 元数据, 提取耗时(秒))
+    """
+    global _document_processor, _document_options
+    if _document_processor is None or _document_options != options:
+        _document_processor = PDFProcessor(os.path.dirname(pdf_path), **options)
+        _document_options = options
+    
+    started = time.monotonic()
+    content, filename, metadata = _document_processor.extract_text_from_pdf(pdf_path)
+    return content, filename, metadata, time.monotonic() - started
+
+def _merge_stats(target, source):
+    """将source中的计数累加到target"""
+    for key, value in source.items():
+        target[key] = target.get(key, 0) + value
+
+class StreamingNormalizer:
+    """流式空白规范化：将连续空白折叠为单个空格，跨片段边界保持状态"""
+    
+    _WHITESPACE = re.compile(r'\s+')
+    
+    def __init__(self):
+        self.offset = 0  # 已输出的字符数
+        self._last_was_space = False
+    
+    def feed(self, text):
+        """
+        规范化一段文本
+        
+        Args:
+            text (str): 原始文本片段
+            
+        Returns:
+            str: 规范化后的片段
+        """
+        if not text:
+            return ""
+        normalized = self._WHITESPACE.sub(' ', text)
+        # 上一片段以空白结尾时，去掉本片段开头的空白
+        if self._last_was_space and normalized.startswith(' '):
+            normalized = normalized[1:]
+        if normalized:
+            self._last_was_space = normalized.endswith(' ')
+        self.offset += len(normalized)
+        return normalized
+
 class PDFProcessor:
     """增强型PDF处理类，支持文本、结构和公式提取"""
     
-    def __init__(self, pdf_dir, use_latex_ocr=True):
+    def __init__(self, pdf_dir, use_latex_ocr=True, use_extract_cache=True,
+                 extract_cache_dir=".cache/extract", extract_cache_size_mb=512,
+                 page_workers=1, shard_min_pages=100, ocr_batch_size=8, ocr_max_wait=0.05,
+                 formula_cache_size=10000, formula_cache_dir=None, ocr_page_raster=True):
         """
         初始化PDF处理器
         
         Args:
             pdf_dir (str): PDF文件所在的目录路径
             use_latex_ocr (bool): 是否使用LatexOCR处理公式
+            use_extract_cache (bool): 是否使用提取结果磁盘缓存
+            extract_cache_dir (str): 提取缓存目录
+            extract_cache_size_mb (int): 提取缓存的最大总大小(MB)
+            page_workers (int): 单个大文档按页范围分片处理时使用的进程数，1表示不分片
+            shard_min_pages (int): 启用页范围分片的最小页数
+            ocr_batch_size (int): LatexOCR批量推理的批大小
+            ocr_max_wait (float): LatexOCR凑批的最长等待时间(秒)
+            formula_cache_size (int): 公式识别结果内存缓存的最大条目数
+            formula_cache_dir (str): 公式识别结果持久化缓存目录，为None时只使用内存缓存
+            ocr_page_raster (bool): 每页只渲染一次灰度光栅，从中零拷贝切出公式区域；
+                                    为False时对每个区域单独渲染并经PNG编解码
         """
         self.pdf_dir = pdf_dir
         self.use_latex_ocr = use_latex_ocr
-        self.latex_ocr = None
+        self.extract_cache_dir = extract_cache_dir
+        self.extract_cache_size_mb = extract_cache_size_mb
+        self.page_workers = max(1, page_workers)
+        self.shard_min_pages = shard_min_pages
+        self.ocr_batcher = None
+        self._ocr_lock = threading.Lock()
+        self.ocr_batch_size = ocr_batch_size
+        self.ocr_max_wait = ocr_max_wait
+        self.formula_cache_size = formula_cache_size
+        self.formula_cache_dir = formula_cache_dir
+        self.formula_cache = None
+        self.ocr_page_raster = ocr_page_raster
+        self.extract_cache = None
+        self.formula_filter = FormulaFilter()
         
-        # 如果启用了LaTeX OCR，就初始化模型
-        if self.use_latex_ocr:
+        if use_extract_cache:
             try:
-                logger.info("正在加载LatexOCR模型...")
-                self.latex_ocr = LatexOCR()
-                logger.info("LatexOCR模型加载完成")
+                self.extract_cache = ExtractCache(extract_cache_dir, extract_cache_size_mb)
             except Exception as e:
-                logger.error(f"加载LatexOCR模型失败: {str(e)}")
-                self.use_latex_ocr = False
+                logger.error(f"初始化提取缓存失败，将不使用缓存: {str(e)}")
         
-        logger.info(f"增强型PDF处理器初始化，目录: {pdf_dir}, 公式OCR: {self.use_latex_ocr}")
+        logger.info(f"增强型PDF处理器初始化，目录: {pdf_dir}, 公式OCR: {self.use_latex_ocr}, 提取缓存: {self.extract_cache is not None}")
+    
+    def _ensure_ocr(self):
+        """
+        按需获取进程内共享的LatexOCR推理队列，模型在第一次真正需要识别公式时才加载
+        
+        Returns:
+            bool: OCR是否可用
+        """
+        if not self.use_latex_ocr:
+            return False
+        with self._ocr_lock:
+            if self.ocr_batcher is None:
+                try:
+                    self.ocr_batcher = get_shared_batcher(self.ocr_batch_size, self.ocr_max_wait)
+                    self.formula_cache = FormulaCache(self.formula_cache_size, self.formula_cache_dir)
+                except Exception as e:
+                    logger.error(f"加载LatexOCR模型失败: {str(e)}")
+                    self.use_latex_ocr = False
+                    return False
+        return True
     
     def get_pdf_files(self):
         """
@@ -59,23 +201,114 @@ class PDFProcessor:
         except Exception as e:
             logger.error(f"获取PDF文件列表时出错: {str(e)}")
             return []
+
+    def probe_document(self, pdf_path, sample_pages=3):
+        """
+        快速探测文档规模，用于在提取前估算处理成本：只读取页数，并从均匀分布的少量页面取文本层
+
+        Args:
+            pdf_path (str): PDF文件路径
+            sample_pages (int): 抽样读取文本层的页数
+
+        Returns:
+            dict: pages(页数)、bytes(文件大小)、chars(按抽样估算的全文字符数)、
+                  sample_text(抽样文本，用于估算token密度)、text_layer(抽样页是否有文本层)
+        """
+        probe = {"pages": 0, "bytes": 0, "chars": 0, "sample_text": "", "text_layer": False}
+        try:
+            probe["bytes"] = os.path.getsize(pdf_path)
+            with fitz.open(pdf_path) as doc:
+                page_count = len(doc)
+                probe["pages"] = page_count
+                if page_count == 0:
+                    return probe
+                count = min(sample_pages, page_count)
+                indices = sorted({int(i * page_count / count) for i in range(count)})
+                samples = [doc[i].get_text("text") for i in indices]
+            sample_text = "".join(samples)
+            probe["sample_text"] = sample_text
+            probe["chars"] = int(len(sample_text) / len(samples) * page_count)
+            probe["text_layer"] = bool(sample_text.strip())
+        except Exception as e:
+            logger.warning(f"探测PDF文件 {os.path.basename(pdf_path)} 失败: {str(e)}")
+        return probe
+
+    def _render_page_raster(self, page):
+        """
+        以OCR分辨率将整页渲染为灰度光栅
+        
+        Args:
+            page: PyMuPDF页面对象
+            
+        Returns:
+            tuple: (像素缓冲区, 宽, 高, 行跨度)
+        """
+        pix = page.get_pixmap(matrix=fitz.Matrix(OCR_ZOOM, OCR_ZOOM), colorspace=fitz.csGRAY, alpha=False)
+        # 复制到Python持有的缓冲区，使裁剪出的图像不依赖Pixmap的生命周期；
+        # 末尾多留一行，满足PIL按完整行跨度检查缓冲区长度的要求
+        samples = pix.samples_mv
+        buffer = bytearray(len(samples) + pix.stride)
+        buffer[:len(samples)] = samples
+        return buffer, pix.width, pix.height, pix.stride
+    
+    def _crop_from_raster(self, raster, page_rect, clip):
+        """
+        从共享页面光栅中切出区域，返回与光栅共享内存的PIL图像（无PNG编解码）
+        
+        Args:
+            raster (tuple): _render_page_raster的返回值
+            page_rect: 页面矩形
+            clip (tuple): 区域坐标(x0, y0, x1, y1)，单位为点
+            
+        Returns:
+            PIL.Image: 灰度图像，区域为空时返回None
+        """
+        import numpy as np
+        from PIL import Image
+        
+        buffer, width, height, stride = raster
+        x0, y0, x1, y1 = clip
+        px0 = min(width, max(0, math.floor((x0 - page_rect.x0) * OCR_ZOOM)))
+        py0 = min(height, max(0, math.floor((y0 - page_rect.y0) * OCR_ZOOM)))
+        px1 = min(width, max(0, math.ceil((x1 - page_rect.x0) * OCR_ZOOM)))
+        py1 = min(height, max(0, math.ceil((y1 - page_rect.y0) * OCR_ZOOM)))
+        if px1 <= px0 or py1 <= py0:
+            return None
+        
+        # 区域的NumPy视图，与页面光栅共享内存
+        pixels = np.frombuffer(buffer, dtype=np.uint8, count=height * stride).reshape(height, stride)
+        region = pixels[py0:py1, px0:px1]
+        
+        # 从视图起始位置按原行跨度映射为PIL图像（"L"模式的raw映射不复制数据）
+        offset = region.__array_interface__['data'][0] - pixels.__array_interface__['data'][0]
+        return Image.frombuffer('L', (px1 - px0, py1 - py0), memoryview(buffer)[offset:],
+                                'raw', 'L', stride, 1)
     
-    def _detect_and_extract_formulas(self, doc, page_num):
+    def _detect_formula_candidates(self, doc, page_num, stats=None):
         """
-        检测并提取页面中的公式
+        检测页面中可能是公式的区域并渲染为图像
+        
+        候选块先经过FormulaFilter预过滤（数学字体、数学符号、字形密度、字母/符号比例），
+        只有通过的块才会被渲染。
         
         Args:
             doc: PyMuPDF文档对象
             page_num: 页码
+            stats (dict): 统计信息，累加候选块数和被预过滤拒绝的块数
             
         Returns:
-            list: 公式列表，每个元素是(bbox, latex)元组
+            list: 候选列表，每个元素是(bbox, image)元组
         """
-        if not self.use_latex_ocr or self.latex_ocr is None:
+        if not self.use_latex_ocr or self.ocr_batcher is None:
             return []
+        
+        from PIL import Image
             
-        formulas = []
+        candidates = []
         page = doc[page_num]
+        raster = None
+        if stats is None:
+            stats = {}
         
         # 使用PyMuPDF检测可能是公式的区域
         # 这里使用启发式方法：寻找被空白环绕且没有明确文本结构的区域
@@ -87,6 +320,13 @@ class PDFProcessor:
                 
             # 检查是否可能是公式区域
             if len(block["lines"]) <= 3:  # 通常公式不会有很多行
+                stats["formula_candidates"] = stats.get("formula_candidates", 0) + 1
+                
+                # 廉价预过滤，避免对标题、图注、页码等运行OCR
+                if not self.formula_filter.is_formula(block):
+                    stats["formula_rejected"] = stats.get("formula_rejected", 0) + 1
+                    continue
+                
                 # 获取区域坐标
                 bbox = block["bbox"]
                 x0, y0, x1, y1 = bbox
@@ -98,26 +338,79 @@ class PDFProcessor:
                 x1 = min(page.rect.width, x1 + margin)
                 y1 = min(page.rect.height, y1 + margin)
                 
-                # 渲染区域为图像
-                pix = page.get_pixmap(clip=(x0, y0, x1, y1), matrix=fitz.Matrix(2, 2))
-                img_bytes = pix.tobytes("png")
-                img = Image.open(io.BytesIO(img_bytes))
-                
-                # 使用LatexOCR识别公式
-                try:
-                    latex = self.latex_ocr(img)
-                    if latex and len(latex) > 5:  # 确保有意义的输出
-                        formulas.append((bbox, latex))
-                        logger.debug(f"识别到公式: {latex}")
-                except Exception as e:
-                    logger.debug(f"公式识别失败: {str(e)}")
-                    continue
+                if self.ocr_page_raster:
+                    # 整页只渲染一次，首个通过预过滤的区域出现时才渲染
+                    if raster is None:
+                        raster = self._render_page_raster(page)
+                    img = self._crop_from_raster(raster, page.rect, (x0, y0, x1, y1))
+                    if img is None:
+                        continue
+                else:
+                    # 渲染区域为图像
+                    pix = page.get_pixmap(clip=(x0, y0, x1, y1), matrix=fitz.Matrix(OCR_ZOOM, OCR_ZOOM))
+                    img_bytes = pix.tobytes("png")
+                    img = Image.open(io.BytesIO(img_bytes))
+                candidates.append((bbox, img))
         
+        return candidates
+    
+    def _recognize_formulas(self, candidates, stats=None):
+        """
+        将候选公式图像提交到批量推理队列，并把结果映射回(页码, bbox)
+        
+        先按感知哈希查询公式缓存，重复出现的公式（含本批内的重复）只识别一次。
+        
+        Args:
+            candidates (list): 候选列表，每个元素是(page_num, bbox, image)元组
+            stats (dict): 统计信息，累加缓存命中/未命中数、识别的公式数和OCR耗时
+            
+        Returns:
+            list: 公式列表，每个元素是(page_num, bbox, latex)元组
+        """
+        if not candidates or self.ocr_batcher is None:
+            return []
+        if stats is None:
+            stats = {}
+        
+        # 查询缓存，未命中的图像按哈希去重后送入OCR
+        keys = [self.formula_cache.image_hash(img) for _, _, img in candidates]
+        resolved = {}
+        pending = {}
+        for key, (_, _, img) in zip(keys, candidates):
+            if key in resolved or key in pending:
+                continue
+            latex = self.formula_cache.get(key)
+            if latex is not None:
+                resolved[key] = latex
+            else:
+                pending[key] = img
+        
+        # 本批内重复出现的公式也只识别一次，计为命中
+        misses = len(pending)
+        stats["formula_cache_hits"] = stats.get("formula_cache_hits", 0) + len(keys) - misses
+        stats["formula_cache_misses"] = stats.get("formula_cache_misses", 0) + misses
+        
+        if pending:
+            start_time = time.monotonic()
+            results = self.ocr_batcher.recognize(list(pending.values()))
+            stats["ocr_formulas"] = stats.get("ocr_formulas", 0) + len(pending)
+            stats["ocr_seconds"] = stats.get("ocr_seconds", 0) + (time.monotonic() - start_time)
+            for key, latex in zip(pending.keys(), results):
+                if latex is not None:
+                    self.formula_cache.put(key, latex)
+                resolved[key] = latex
+        
+        formulas = []
+        for (page_num, bbox, _), key in zip(candidates, keys):
+            latex = resolved.get(key)
+            if latex and len(latex) > 5:  # 确保有意义的输出
+                formulas.append((page_num, bbox, latex))
+                logger.debug(f"识别到公式: {latex}")
         return formulas
     
     def _process_with_pdfplumber(self, pdf_path):
         """
-        使用pdfplumber提取文本
+        使用pdfplumber提取文本（备用后端，仅在PyMuPDF失败或无文本时调用）
         
         Args:
             pdf_path: PDF文件路径
@@ -125,113 +418,369 @@ class PDFProcessor:
         Returns:
             str: 提取的文本
         """
-        text = ""
+        import pdfplumber
+        
+        page_texts = []
         try:
             with pdfplumber.open(pdf_path) as pdf:
                 for page in pdf.pages:
                     page_text = page.extract_text(x_tolerance=1, y_tolerance=3)
                     if page_text:
-                        text += page_text + "\n"
-            return text
+                        page_texts.append(page_text)
+            return "\n".join(page_texts)
         except Exception as e:
             logger.error(f"使用pdfplumber提取文本失败: {str(e)}")
             return ""
     
-    def _process_with_pymupdf(self, pdf_path):
+    def _process_with_pypdf2(self, pdf_path):
         """
-        使用PyMuPDF提取结构化内容
+        使用PyPDF2提取文本（最后的备用后端）
         
         Args:
             pdf_path: PDF文件路径
             
         Returns:
-            tuple: (结构化文本, 公式列表)
+            str: 提取的文本
         """
-        structured_text = ""
-        all_formulas = []
+        import PyPDF2
         
+        page_texts = []
         try:
-            # 打开PDF文档
-            doc = fitz.open(pdf_path)
+            reader = PyPDF2.PdfReader(pdf_path)
+            for page in reader.pages:
+                page_text = page.extract_text()
+                if page_text:
+                    page_texts.append(page_text)
+            return "\n".join(page_texts)
+        except Exception as e:
+            logger.error(f"使用PyPDF2提取文本失败: {str(e)}")
+            return ""
+    
+    def _extract_metadata(self, doc):
+        """
+        从已打开的PyMuPDF文档中读取元数据
+        
+        Args:
+            doc: PyMuPDF文档对象
             
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                
-                # 提取普通文本
-                page_text = page.get_text("text")
-                
-                # 检测并提取公式
-                formulas = self._detect_and_extract_formulas(doc, page_num)
-                all_formulas.extend([(page_num, *formula) for formula in formulas])
-                
-                # 添加页面文本
-                structured_text += page_text + "\n"
+        Returns:
+            dict: 元数据（标题、作者等）
+        """
+        raw = doc.metadata or {}
+        return {
+            "title": raw.get("title", "") or "",
+            "author": raw.get("author", "") or "",
+            "subject": raw.get("subject", "") or "",
+            "creator": raw.get("creator", "") or "",
+            "producer": raw.get("producer", "") or ""
+        }
+    
+    def _iter_page_range(self, doc, start, end, stats=None):
+        """
+        使用PyMuPDF逐页处理 [start, end) 页范围
+        
+        公式候选跨页收集后批量识别；候选图像引用整页光栅，因此每累计OCR_FLUSH_PAGES个
+        含候选的页面就提交一次识别，并输出已完成的页面，内存只与这个窗口成正比。
+        
+        Args:
+            doc: 已打开的PyMuPDF文档对象
+            start (int): 起始页（包含）
+            end (int): 结束页（不包含）
+            stats (dict): 统计信息
             
-            return structured_text, all_formulas
-        except Exception as e:
-            logger.error(f"使用PyMuPDF提取结构化内容失败: {str(e)}")
-            return "", []
+        Yields:
+            tuple: (页码, 页面文本, 该页公式列表[(bbox, latex)])
+        """
+        buffered_pages = []
+        candidates = []
+        pending_pages = 0
+        self._ensure_ocr()
+        
+        for page_num in range(start, end):
+            page = doc[page_num]
+            
+            # 提取普通文本
+            buffered_pages.append((page_num, page.get_text("text")))
+            
+            # 检测公式候选区域，跨页收集后统一批量识别
+            page_candidates = self._detect_formula_candidates(doc, page_num, stats)
+            candidates.extend([(page_num, bbox, img) for bbox, img in page_candidates])
+            if page_candidates:
+                pending_pages += 1
+            
+            if not candidates or pending_pages >= OCR_FLUSH_PAGES:
+                yield from self._flush_pages(buffered_pages, candidates, stats)
+                buffered_pages = []
+                candidates = []
+                pending_pages = 0
+        
+        yield from self._flush_pages(buffered_pages, candidates, stats)
+    
+    def _flush_pages(self, buffered_pages, candidates, stats):
+        """
+        识别缓冲页面中的公式候选，并按页输出结果
+        
+        Args:
+            buffered_pages (list): [(页码, 页面文本)]
+            candidates (list): [(页码, bbox, image)]
+            stats (dict): 统计信息
+            
+        Yields:
+            tuple: (页码, 页面文本, 该页公式列表[(bbox, latex)])
+        """
+        page_formulas = {}
+        for page_num, bbox, latex in self._recognize_formulas(candidates, stats):
+            page_formulas.setdefault(page_num, []).append((bbox, latex))
+        for page_num, page_text in buffered_pages:
+            yield page_num, page_text, page_formulas.get(page_num, [])
     
-    def _integrate_content(self, basic_text, structured_text, formulas):
+    def _process_page_range(self, doc, start, end, stats=None):
         """
-        整合不同来源的内容，确保文本连贯，公式位于正确位置
+        使用PyMuPDF处理 [start, end) 页范围（供分片工作进程使用）
         
         Args:
-            basic_text: 基本文本
-            structured_text: 结构化文本
-            formulas: 公式列表
+            doc: 已打开的PyMuPDF文档对象
+            start (int): 起始页（包含）
+            end (int): 结束页（不包含）
+            stats (dict): 统计信息
             
         Returns:
-            str: 整合后的最终文本
+            tuple: (页面文本列表, 公式列表[(页码, bbox, latex)])
         """
-        # 如果没有检测到公式，直接返回更好的文本版本
-        if not formulas:
-            return structured_text if structured_text else basic_text
+        page_texts = []
+        all_formulas = []
+        for page_num, page_text, formulas in self._iter_page_range(doc, start, end, stats):
+            page_texts.append(page_text)
+            all_formulas.extend([(page_num, bbox, latex) for bbox, latex in formulas])
+        return page_texts, all_formulas
+    
+    def _worker_options(self):
+        """
+        获取在工作进程中重建处理器所需的公式识别相关参数
         
-        # 将公式按照页码和位置排序
-        formulas.sort(key=lambda x: (x[0], x[1][1]))  # 按页码和y坐标排序
+        Returns:
+            dict: PDFProcessor构造参数
+        """
+        return {
+            "use_latex_ocr": self.use_latex_ocr,
+            "ocr_batch_size": self.ocr_batch_size,
+            "ocr_max_wait": self.ocr_max_wait,
+            "formula_cache_size": self.formula_cache_size,
+            "formula_cache_dir": self.formula_cache_dir,
+            "ocr_page_raster": self.ocr_page_raster
+        }
+    
+    def document_worker_options(self):
+        """
+        获取extract_document_worker在工作进程中重建处理器的参数（与当前处理器的提取设置一致）
         
-        # 将公式插入到文本中适当位置
-        lines = structured_text.split('\n')
+        Returns:
+            dict: PDFProcessor构造参数
+        """
+        options = self._worker_options()
+        options.update({
+            "use_extract_cache": self.extract_cache is not None,
+            "extract_cache_dir": self.extract_cache_dir,
+            "extract_cache_size_mb": self.extract_cache_size_mb,
+            "page_workers": self.page_workers,
+            "shard_min_pages": self.shard_min_pages
+        })
+        return options
+    
+    def _iter_sharded(self, doc, pdf_path, stats):
+        """
+        将大文档按页范围分片，在进程池中并行处理，并按页序逐页输出
+        
+        某个分片失败时，在当前进程中串行重新处理该分片。
+        
+        Args:
+            doc: 已打开的PyMuPDF文档对象
+            pdf_path (str): PDF文件路径，由工作进程独立打开
+            stats (dict): 统计信息，合并各分片的计数
+            
+        Yields:
+            tuple: (页码, 页面文本, 该页公式列表[(bbox, latex)])
+        """
+        page_count = len(doc)
+        # 分片数取进程数的两倍，减少个别慢分片造成的长尾
+        shard_size = max(1, math.ceil(page_count / (self.page_workers * 2)))
+        ranges = [(start, min(start + shard_size, page_count))
+                  for start in range(0, page_count, shard_size)]
+        logger.info(f"按页范围分片处理 {os.path.basename(pdf_path)}: {page_count} 页, {len(ranges)} 个分片, {self.page_workers} 个进程")
+        
+        # 使用spawn上下文，避免在多线程环境中fork
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.page_workers, mp_context=context) as executor:
+            options = self._worker_options()
+            futures = [executor.submit(_extract_page_range_worker, pdf_path, start, end, options)
+                       for start, end in ranges]
+            
+            # 按提交顺序收集，保证页序
+            for (start, end), future in zip(ranges, futures):
+                try:
+                    texts, formulas, range_stats = future.result()
+                except Exception as e:
+                    logger.error(f"页范围 {start}-{end} 分片处理失败，回退到串行处理: {str(e)}")
+                    yield from self._iter_page_range(doc, start, end, stats)
+                    continue
+                
+                _merge_stats(stats, range_stats)
+                page_formulas = {}
+                for page_num, bbox, latex in formulas:
+                    page_formulas.setdefault(page_num, []).append((bbox, latex))
+                for page_num, page_text in zip(range(start, end), texts):
+                    yield page_num, page_text, page_formulas.get(page_num, [])
+    
+    def _integrate_page_formulas(self, page_text, formulas):
+        """
+        将公式插入到页面文本中：按y坐标顺序放在段落结束处，剩余的追加到页尾
+        
+        Args:
+            page_text (str): 页面文本
+            formulas (list): 该页公式列表[(bbox, latex)]
+            
+        Returns:
+            str: 整合后的页面文本
+        """
+        if not formulas:
+            return page_text
+        
+        pending = sorted(formulas, key=lambda x: x[0][1])  # 按y坐标排序
+        lines = page_text.split('\n')
         result = []
         formula_idx = 0
         
-        # 假设每个公式应该插入在最近的文本段落后面
-        current_page = 0
-        
         for i, line in enumerate(lines):
-            # 检查是否需要插入公式
             result.append(line)
+            # 如果下一行是空行，可能是段落结束，在此插入一个公式
+            if formula_idx < len(pending) and i < len(lines) - 1 and not lines[i + 1].strip():
+                result.append(f"[FORMULA: {pending[formula_idx][1]}]")
+                formula_idx += 1
+        
+        # 将剩余的公式添加到页尾
+        for _, latex in pending[formula_idx:]:
+            result.append(f"[FORMULA: {latex}]")
+        
+        return '\n'.join(result)
+    
+    def _iter_pages(self, doc, pdf_path=None, stats=None):
+        """
+        在已打开的文档上逐页输出规范化后的页面记录
+        
+        页数达到shard_min_pages且page_workers大于1时，按页范围分片到多个进程处理。
+        
+        Args:
+            doc: 已打开的PyMuPDF文档对象
+            pdf_path (str): PDF文件路径，分片模式下由工作进程独立打开
+            stats (dict): 统计信息
             
-            if formula_idx < len(formulas):
-                formula_page, formula_bbox, formula_latex = formulas[formula_idx]
-                
-                if i < len(lines) - 1:
-                    next_line = lines[i + 1]
-                    if not next_line.strip():  # 如果下一行是空行，可能是段落结束
-                        if formula_page == current_page:
-                            # 在段落结束处插入公式
-                            result.append(f"[FORMULA: {formula_latex}]")
-                            formula_idx += 1
+        Yields:
+            dict: 页面记录，包含page、text、formulas、char_start、char_end
+        """
+        if stats is None:
+            stats = {}
+        
+        if pdf_path and self.page_workers > 1 and len(doc) >= self.shard_min_pages:
+            pages = self._iter_sharded(doc, pdf_path, stats)
+        else:
+            pages = self._iter_page_range(doc, 0, len(doc), stats)
+        
+        normalizer = StreamingNormalizer()
+        for page_num, page_text, formulas in pages:
+            # 页与页之间以换行分隔，由规范化器折叠为单个空格
+            separator = "\n" if page_num > 0 else ""
+            char_start = normalizer.offset
+            text = normalizer.feed(separator + self._integrate_page_formulas(page_text, formulas))
+            yield {
+                "page": page_num,
+                "text": text,
+                "formulas": formulas,
+                "char_start": char_start,
+                "char_end": normalizer.offset
+            }
+    
+    def iter_pages(self, pdf_path, stats=None):
+        """
+        流式逐页提取PDF内容，内存只与单页（及OCR批量窗口）成正比
+        
+        每条记录的text是该页整合公式并规范化空白后的文本片段，
+        按顺序拼接所有片段即得到extract_text_from_pdf返回的完整文本；
+        char_start/char_end是片段在完整文本中的字符偏移。
+        
+        Args:
+            pdf_path (str): PDF文件路径
+            stats (dict): 统计信息，累加公式候选、缓存命中、OCR耗时等计数
             
-            # 估计当前页码
-            if not line.strip() and i > 0 and i < len(lines) - 1:
-                # 检测可能的页面变化
-                if lines[i - 1].strip() and lines[i + 1].strip():
-                    current_page += 1
-        
-        # 将剩余的公式添加到文档末尾
-        while formula_idx < len(formulas):
-            _, _, formula_latex = formulas[formula_idx]
-            result.append(f"[FORMULA: {formula_latex}]")
-            formula_idx += 1
+        Yields:
+            dict: 页面记录，包含page、text、formulas[(bbox, latex)]、char_start、char_end
+        """
+        with fitz.open(pdf_path) as doc:
+            yield from self._iter_pages(doc, pdf_path, stats)
+    
+    def _extract_settings(self):
+        """
+        获取影响提取结果的设置，作为缓存键的一部分
         
-        return '\n'.join(result)
+        Returns:
+            dict: 提取设置
+        """
+        return {
+            "use_latex_ocr": self.use_latex_ocr,
+            "formula_filter": vars(self.formula_filter),
+            "extractor_version": EXTRACTOR_VERSION,
+            "pymupdf_version": fitz.VersionBind
+        }
+    
+    def _extract(self, pdf_path):
+        """
+        执行实际的PDF提取（不经过缓存），作为iter_pages的消费者拼接完整文本
+        
+        文档只用PyMuPDF打开一次，元数据、文本和公式都来自同一个句柄；
+        只有当PyMuPDF失败或提取不到文本时，才依次回退到pdfplumber和PyPDF2。
+        
+        Args:
+            pdf_path (str): PDF文件路径
+            
+        Returns:
+            tuple: (最终文本, 公式列表, 元数据, 统计信息)
+        """
+        pdf_filename = os.path.basename(pdf_path)
+        metadata = {}
+        chunks = []
+        formulas = []
+        stats = {}
+        
+        # 主后端：PyMuPDF，只打开一次
+        try:
+            with fitz.open(pdf_path) as doc:
+                metadata = self._extract_metadata(doc)
+                for record in self._iter_pages(doc, pdf_path, stats):
+                    chunks.append(record["text"])
+                    formulas.extend([(record["page"], bbox, latex) for bbox, latex in record["formulas"]])
+        except Exception as e:
+            logger.error(f"使用PyMuPDF提取结构化内容失败: {str(e)}")
+            chunks = []
+            formulas = []
+        
+        final_text = "".join(chunks)
+        
+        # 备用后端：仅在主后端没有文本时按需调用
+        if not final_text.strip():
+            logger.info(f"PyMuPDF未提取到文本，回退到pdfplumber: {pdf_filename}")
+            basic_text = self._process_with_pdfplumber(pdf_path)
+            if not basic_text.strip():
+                logger.info(f"pdfplumber未提取到文本，回退到PyPDF2: {pdf_filename}")
+                basic_text = self._process_with_pypdf2(pdf_path)
+            final_text = StreamingNormalizer().feed(basic_text)
+        
+        return final_text, formulas, metadata, stats
     
     def extract_text_from_pdf(self, pdf_path):
         """
         从PDF文件中提取增强的文本内容
         
+        启用提取缓存时，以文件内容哈希和提取设置为键，命中则直接返回缓存结果。
+        
         Args:
             pdf_path (str): PDF文件路径
             
@@ -242,48 +791,43 @@ class PDFProcessor:
             pdf_filename = os.path.basename(pdf_path)
             logger.info(f"开始增强处理PDF文件: {pdf_filename}")
             
-            # 使用PyPDF2提取基本文本
-            basic_text = ""
-            metadata = {}
-            
-            try:
-                reader = PyPDF2.PdfReader(pdf_path)
-                # 提取元数据
-                if reader.metadata:
-                    metadata = {
-                        "title": reader.metadata.get('/Title', ''),
-                        "author": reader.metadata.get('/Author', ''),
-                        "subject": reader.metadata.get('/Subject', ''),
-                        "creator": reader.metadata.get('/Creator', ''),
-                        "producer": reader.metadata.get('/Producer', '')
-                    }
-                
-                # 提取文本
-                for page in reader.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        basic_text += page_text + "\n"
-            except Exception as e:
-                logger.error(f"使用PyPDF2提取文本失败: {str(e)}")
-            
-            # 使用pdfplumber提取更精确的文本
-            plumber_text = self._process_with_pdfplumber(pdf_path)
-            
-            # 使用PyMuPDF提取结构化文本和公式
-            structured_text, formulas = self._process_with_pymupdf(pdf_path)
-            
-            # 整合内容
-            final_text = self._integrate_content(basic_text, structured_text, formulas)
+            cache_key = None
+            settings = self._extract_settings()
+            if self.extract_cache is not None:
+                try:
+                    cache_key = self.extract_cache.make_key(pdf_path, settings)
+                    cached = self.extract_cache.get(cache_key)
+                    if cached is not None:
+                        logger.info(f"命中提取缓存: {pdf_filename}，共 {len(cached['text'])} 个字符，{len(cached['formulas'])} 个公式")
+                        return cached["text"], pdf_filename, cached["metadata"]
+                except Exception as e:
+                    logger.warning(f"查询提取缓存失败: {str(e)}")
+                    cache_key = None
             
-            # 后处理：清理文本中的特殊字符和多余空白
-            final_text = re.sub(r'\s+', ' ', final_text)  # 替换多个空白为单个空格
-            final_text = re.sub(r'(\n\s*){3,}', '\n\n', final_text)  # 最多保留两个连续换行
+            final_text, formulas, metadata, stats = self._extract(pdf_path)
             
             content_length = len(final_text)
             formula_count = len(formulas)
-            logger.info(f"成功从 {pdf_filename} 提取文本，共 {content_length} 个字符，检测到 {formula_count} 个公式")
+            formula_info = ""
+            if self.use_latex_ocr:
+                ocr_seconds = stats.get('ocr_seconds', 0)
+                ocr_rate = stats.get('ocr_formulas', 0) / ocr_seconds if ocr_seconds > 0 else 0.0
+                formula_info = (f"（候选块 {stats.get('formula_candidates', 0)} 个，"
+                                f"预过滤拒绝 {stats.get('formula_rejected', 0)} 个，"
+                                f"公式缓存命中 {stats.get('formula_cache_hits', 0)} 次，"
+                                f"未命中 {stats.get('formula_cache_misses', 0)} 次，"
+                                f"OCR {ocr_rate:.1f} 公式/秒）")
+            logger.info(f"成功从 {pdf_filename} 提取文本，共 {content_length} 个字符，检测到 {formula_count} 个公式{formula_info}")
+            
+            # OCR模型加载失败等导致实际设置变化时，不写入原设置对应的缓存
+            if cache_key is not None and final_text and self._extract_settings() == settings:
+                self.extract_cache.put(cache_key, {
+                    "text": final_text,
+                    "formulas": [[page, list(bbox), latex] for page, bbox, latex in formulas],
+                    "metadata": metadata
+                })
             
             return final_text, pdf_filename, metadata
         except Exception as e:
             logger.error(f"从PDF文件 {pdf_path} 提取文本时出错: {str(e)}")
-            return "", os.path.basename(pdf_path), {}
\ No newline at end of file
+            return "", os.path.basename(pdf_path), {}
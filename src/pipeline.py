@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class MonitoredQueue(queue.Queue):
+    """记录深度随时间变化的有界队列，用于统计流水线阶段之间的平均和最大积压"""
+
+    def __init__(self, maxsize):
+        """
+        初始化队列
+
+        Args:
+            maxsize (int): 队列容量，队列满时生产者阻塞
+        """
+        super().__init__(maxsize)
+        self.max_depth = 0
+        self._depth_seconds = 0.0
+        self._started = time.monotonic()
+        self._last_change = self._started
+
+    def _account(self):
+        """累计上次变化以来的 深度×时间（调用方需持有self.mutex）"""
+        now = time.monotonic()
+        self._depth_seconds += len(self.queue) * (now - self._last_change)
+        self._last_change = now
+
+    def _put(self, item):
+        self._account()
+        super()._put(item)
+        self.max_depth = max(self.max_depth, len(self.queue))
+
+    def _get(self):
+        self._account()
+        return super()._get()
+
+    def average_depth(self):
+        """
+        按时间加权的平均深度
+
+        Returns:
+            float: 平均深度
+        """
+        with self.mutex:
+            self._account()
+            elapsed = self._last_change - self._started
+        return self._depth_seconds / elapsed if elapsed > 0 else 0.0
+
+class StageMonitor:
+    """统计流水线单个阶段的处理数量、忙碌时间和等待时间（线程安全）"""
+
+    def __init__(self, name, workers):
+        """
+        初始化阶段统计
+
+        Args:
+            name (str): 阶段名称
+            workers (int): 阶段的并行度（进程数或线程数）
+        """
+        self.name = name
+        self.workers = max(1, workers)
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_busy(self, seconds):
+        """
+        记录一次处理的耗时
+
+        Args:
+            seconds (float): 耗时(秒)
+        """
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += seconds
+
+    @contextmanager
+    def waiting(self):
+        """统计代码块的等待耗时（消费者等待输入或生产者等待队列空位）"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.wait_seconds += time.monotonic() - started
+
+    def summary(self, elapsed):
+        """
+        汇总阶段统计
+
+        Args:
+            elapsed (float): 流水线总耗时(秒)
+
+        Returns:
+            dict: workers、items、busy_seconds、wait_seconds和utilization（忙碌时间占 总耗时×并行度 的比例）
+        """
+        with self._lock:
+            capacity = max(1e-9, elapsed * self.workers)
+            return {
+                "workers": self.workers,
+                "items": self.items,
+                "busy_seconds": round(self.busy_seconds, 2),
+                "wait_seconds": round(self.wait_seconds, 2),
+                "utilization": min(1.0, self.busy_seconds / capacity)
+            }
+
+class DocumentPacker:
+    """将小文档攒成不超过token预算的组，供一次请求同时生成多篇文档的问答对（线程安全）"""
+
+    def __init__(self, max_tokens, max_documents):
+        """
+        初始化打包器
+
+        Args:
+            max_tokens (int): 每组文档内容的token预算
+            max_documents (int): 每组最多的文档数
+        """
+        self.max_tokens = max_tokens
+        self.max_documents = max(1, max_documents)
+        self.packs = 0        # 发出的多文档组数
+        self.documents = 0    # 以多文档组发送的文档数
+        self._pending = []
+        self._pending_tokens = 0
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """取出当前待发送的组（调用方需持有锁）"""
+        pack = self._pending
+        self._pending = []
+        self._pending_tokens = 0
+        if len(pack) > 1:
+            self.packs += 1
+            self.documents += len(pack)
+        return pack
+
+    def add(self, item, tokens):
+        """
+        加入一篇文档
+
+        Args:
+            item: 文档（由调用方定义）
+            tokens (int): 文档内容的估算token数
+
+        Returns:
+            list: 已满、应当立即发送的一组文档；没有满的组时返回空列表
+        """
+        with self._lock:
+            ready = []
+            if self._pending and self._pending_tokens + tokens > self.max_tokens:
+                ready = self._take()
+            self._pending.append(item)
+            self._pending_tokens += tokens
+            if not ready and len(self._pending) >= self.max_documents:
+                ready = self._take()
+            return ready
+
+    def drain(self):
+        """
+        取出剩余未满的组（输入结束时调用）
+
+        Returns:
+            list: 剩余文档，可能为空
+        """
+        with self._lock:
+            return self._take()
@@ -2,15 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import logging
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from .pdf_processor import PDFProcessor
-from .deepseek_client import DeepSeekClient
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .pdf_processor import PDFProcessor, extract_document_worker
+from .deepseek_client import DeepSeekClient, MAX_COMPLETION_TOKENS
+from .text_chunker import TextChunker
+from .rate_limiter import estimate_tokens
+from .pipeline import MonitoredQueue, StageMonitor, DocumentPacker
+from .context_compressor import ContextCompressor
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 提取阶段结束的标记
+_PIPELINE_DONE = object()
+
 class QAGenerator:
     """问答生成器类"""
     
@@ -19,9 +30,37 @@ class QAGenerator:
     LEVEL_INTERMEDIATE = "intermediate"  # 中级水平，适合有一定基础的学习者
     LEVEL_ADVANCED = "advanced"     # 高级水平，适合深入研究的学者
     
+    # 按级别拆分的请求按问答对数量估算max_tokens：每个问答对的token预算和固定开销
+    TOKENS_PER_PAIR = 600
+    COMPLETION_OVERHEAD_TOKENS = 200
+    
+    # 批量处理的成本模型系数（秒），用于最长作业优先调度：每页提取、启用公式OCR时每页额外耗时、
+    # 无文本层时每页额外耗时（回退到备用后端）、每MB文件读取和渲染、每次生成的固定延迟、
+    # 每个问答对的解码耗时、每千个提示词token的预填充耗时
+    COST_EXTRACT_PER_PAGE = 0.02
+    COST_OCR_PER_PAGE = 0.4
+    COST_NO_TEXT_PER_PAGE = 0.05
+    COST_PER_MB = 0.05
+    COST_GENERATE_BASE = 10.0
+    COST_PER_PAIR = 2.0
+    COST_PER_1K_PROMPT_TOKENS = 0.3
+    
+    # 未截断时提示词中文档内容的最大字符数
+    MAX_CONTENT_CHARS = 50000
+    
+    # 多文档打包请求中每个问答对的token预算（打包提示词要求回答控制在200字以内）
+    PACK_TOKENS_PER_PAIR = 350
+    
     def __init__(self, pdf_dir="pdf_files", num_qa_pairs=20, max_workers=3, 
                  api_max_retries=3, api_retry_delay=2, qa_level=None, 
-                 use_latex_ocr=True):
+                 use_latex_ocr=True, use_extract_cache=True, page_workers=1,
+                 ocr_batch_size=8, ocr_max_wait=0.05, formula_cache_dir=None,
+                 api_concurrency=8, api_rpm=None, api_tpm=None, llm_cache_dir=None,
+                 llm_cache_ttl=None, llm_cache_size_mb=256, cache_only=False, chunk_tokens=None,
+                 stream=True, on_qa_pair=None, min_recovery_ratio=0.6, top_up_rounds=2, split_levels=False,
+                 api_timeout=300, hedge_requests=False, breaker_error_rate=0.5, breaker_cooldown=30.0,
+                 extract_workers=1, pipeline_queue_size=4, schedule="lpt", pack_tokens=None, pack_max_docs=8,
+                 context_tokens=None, context_compression=True):
         """
         初始化问答生成器
         
@@ -33,11 +72,72 @@ class QAGenerator:
             api_retry_delay (int): API调用重试间隔(秒)
             qa_level (str): 问答对级别 (basic/intermediate/advanced)
             use_latex_ocr (bool): 是否使用LaTeX OCR
+            use_extract_cache (bool): 是否使用PDF提取结果磁盘缓存
+            page_workers (int): 大文档按页范围分片提取时使用的进程数
+            ocr_batch_size (int): LatexOCR批量推理的批大小
+            ocr_max_wait (float): LatexOCR凑批的最长等待时间(秒)
+            formula_cache_dir (str): 公式识别结果持久化缓存目录，为None时只使用内存缓存
+            api_concurrency (int): 同时在途的API请求数上限，与max_workers无关
+            api_rpm (int): 每分钟API请求数上限，None表示不限制
+            api_tpm (int): 每分钟API token数上限，None表示不限制
+            llm_cache_dir (str): 大模型响应缓存目录，为None时不缓存
+            llm_cache_ttl (float): 大模型响应缓存有效期(秒)，None表示永不过期
+            llm_cache_size_mb (int): 大模型响应缓存的最大总大小(MB)
+            cache_only (bool): 只从响应缓存回放，不访问网络
+            chunk_tokens (int): 分片生成时每个片段的token预算；文档超过该预算时按章节/段落切分，
+                                各片段并发生成后合并，为None或0时整篇一次生成（超长时压缩或截断）
+            stream (bool): 是否使用流式输出，收到足够数量的问答对后提前结束
+            on_qa_pair (callable): 每收到一个问答对时的回调on_qa_pair(qa)，用于实时更新进度；
+                                   在API客户端的事件循环线程中调用，应尽快返回
+            min_recovery_ratio (float): 响应JSON格式有误时，修复取回的问答对达到期望数量的该比例即接受，不足时才重试
+            top_up_rounds (int): 问答对数量不足时，按各级别缺少的数量发送补充请求的最多轮数，0表示不补充
+            split_levels (bool): 生成混合级别时，为basic/intermediate/advanced分别并发请求后合并，
+                                 而不是一次请求全部级别
+            api_timeout (float): 单次API调用的截止时间(秒)，超时按失败重试
+            hedge_requests (bool): 是否启用对冲请求（耗时超过历史p95后再发送一个相同请求，取先完成的结果）
+            breaker_error_rate (float): API错误率达到该值时熔断并在冷却期内快速失败，0表示不熔断
+            breaker_cooldown (float): 熔断后的冷却时间(秒)
+            extract_workers (int): 批量处理时提取阶段的进程数，0表示在当前进程的单个线程中提取；
+                                   生成阶段的并行文件数仍由max_workers决定
+            pipeline_queue_size (int): 提取阶段与生成阶段之间的队列容量，队列满时暂停提取，
+                                       限制同时驻留内存的已提取文档数量
+            schedule (str): 批量处理的文件顺序，lpt表示按估算成本从高到低（最长作业优先），
+                            fifo表示按目录列出的顺序
+            pack_tokens (int): 批量处理时把内容不超过该预算一半的小文档打包，每组内容不超过该token预算，
+                               一次请求为组内每篇文档分别生成问答对，None或0表示不打包
+            pack_max_docs (int): 每组最多打包的文档数（同时受单次请求最大输出token数限制）
+            context_tokens (int): 上下文压缩的token预算，文档超过该预算时按段落重要性（BM25）选取段落压缩到预算内；
+                                  为None时只压缩超过50000字符截断长度的文档（分片生成的文档不压缩）；
+                                  整篇生成时预算不超过截断长度对应的token数
+            context_compression (bool): 是否启用上下文压缩，为False时沿用截断到前50000字符的方式
         """
-        self.pdf_processor = PDFProcessor(pdf_dir, use_latex_ocr)
-        self.deepseek_client = DeepSeekClient(max_retries=api_max_retries, retry_delay=api_retry_delay)
+        self.pdf_processor = PDFProcessor(pdf_dir, use_latex_ocr, use_extract_cache=use_extract_cache,
+                                          page_workers=page_workers, ocr_batch_size=ocr_batch_size,
+                                          ocr_max_wait=ocr_max_wait, formula_cache_dir=formula_cache_dir)
+        self.deepseek_client = DeepSeekClient(max_retries=api_max_retries, retry_delay=api_retry_delay,
+                                              max_concurrent_requests=api_concurrency,
+                                              requests_per_minute=api_rpm, tokens_per_minute=api_tpm,
+                                              response_cache_dir=llm_cache_dir, response_cache_ttl=llm_cache_ttl,
+                                              response_cache_size_mb=llm_cache_size_mb, cache_only=cache_only,
+                                              stream=stream, min_recovery_ratio=min_recovery_ratio,
+                                              request_timeout=api_timeout, hedge=hedge_requests,
+                                              breaker_error_rate=breaker_error_rate, breaker_cooldown=breaker_cooldown)
         self.num_qa_pairs = num_qa_pairs
         self.max_workers = max_workers
+        self.chunk_tokens = chunk_tokens
+        self.on_qa_pair = on_qa_pair
+        self.top_up_rounds = max(0, top_up_rounds)
+        self.split_levels = split_levels
+        self.extract_workers = max(0, extract_workers)
+        self.pipeline_queue_size = max(1, pipeline_queue_size)
+        self.schedule = schedule
+        self.pack_tokens = pack_tokens
+        self.pack_max_docs = pack_max_docs
+        self.context_tokens = context_tokens
+        self.context_compression = context_compression
+        self.context_compressor = ContextCompressor()
+        self.compression_stats = {}
+        self.pipeline_stats = None
         self.failed_files = []  # 用于记录处理失败的文件
         
         # 设置问答等级，默认生成所有级别
@@ -47,7 +147,7 @@ class QAGenerator:
     
     def _get_prompt_template(self, level, num_pairs, metadata=None):
         """
-        获取指定级别的提示模板
+        获取指定级别的提示模板（只包含级别和数量相关的要求，文档内容由_prepare_qa_prompt放在最前面）
         
         Args:
             level (str): 问答级别
@@ -57,14 +157,9 @@ class QAGenerator:
         Returns:
             str: 提示模板
         """
-        # 提取文档标题，如果有的话
-        title = ""
-        if metadata and metadata.get("title"):
-            title = metadata.get("title")
-        
         # 基础级别：简单的问答，适合初学者
         if level == self.LEVEL_BASIC:
-            return f"""你是一位资深的教育工作者，需要为初学者生成{num_pairs}个基础级别的中文问答对，涵盖以下学术内容的基本概念和简单应用。
+            return f"""你是一位资深的教育工作者，需要为初学者生成{num_pairs}个基础级别的中文问答对，涵盖上述学术内容的基本概念和简单应用。
 
 【要求】：
 1. 问题应该关注基础概念、定义和简单原理，适合初学者理解
@@ -73,9 +168,6 @@ class QAGenerator:
 4. 确保问题和回答清晰明了，不要过于复杂
 5. 每个问题都必须提及论文的标题或主题
 
-【内容】：
-{{content[:50000]}}
-
 请仅返回JSON格式，每个问答对包含'question'和'answer'字段：
 [
   {{"question": "问题1", "answer": "答案1", "level": "basic"}},
@@ -84,7 +176,7 @@ class QAGenerator:
         
         # 中级级别：更深入的问答，需要一定的专业基础
         elif level == self.LEVEL_INTERMEDIATE:
-            return f"""你是一位资深的大学教授，需要为有一定基础的学生生成{num_pairs}个中级难度的中文问答对，帮助他们深入理解以下学术内容。
+            return f"""你是一位资深的大学教授，需要为有一定基础的学生生成{num_pairs}个中级难度的中文问答对，帮助他们深入理解上述学术内容。
 
 【要求】：
 1. 问题应关注概念间的联系、原理应用和中等复杂度的分析
@@ -94,9 +186,6 @@ class QAGenerator:
 5. 引导学生思考"为什么"和"如何"的问题
 6. 每个问题都必须提及论文的标题或主题
 
-【内容】：
-PDF_CONTENT_PLACEHOLDER
-
 请仅返回JSON格式，每个问答对包含'question'和'answer'字段：
 [
   {{"question": "问题1", "answer": "答案1", "level": "intermediate"}},
@@ -105,7 +194,7 @@ PDF_CONTENT_PLACEHOLDER
         
         # 高级级别：深度分析和批判性思考的问答
         elif level == self.LEVEL_ADVANCED:
-            return f"""你是一位资深的研究员和博士导师，需要为高级学者生成{num_pairs}个高级学术水平的中文问答对，基于以下学术内容进行深度探讨和批判性分析。
+            return f"""你是一位资深的研究员和博士导师，需要为高级学者生成{num_pairs}个高级学术水平的中文问答对，基于上述学术内容进行深度探讨和批判性分析。
 
 【要求】：
 1. 问题应该触及理论深处，包含方法论分析、跨领域整合和研究局限性
@@ -116,9 +205,6 @@ PDF_CONTENT_PLACEHOLDER
 6. 应包含对相关理论体系和方法论的深入理解
 7. 每个问题都必须提及论文的标题或主题
 
-【内容】：
-PDF_CONTENT_PLACEHOLDER
-
 请仅返回JSON格式，每个问答对包含'question'和'answer'字段：
 [
   {{"question": "问题1", "answer": "答案1", "level": "advanced"}},
@@ -127,7 +213,7 @@ PDF_CONTENT_PLACEHOLDER
         
         # 默认模板（同时包含不同级别的问答）
         else:
-            return f"""你是一位科研与教育并重的学术专家，需要基于以下学术内容，生成三种不同难度级别的中文问答对，总共{num_pairs}个问答对（尽量平均分配到各级别）。
+            return f"""你是一位科研与教育并重的学术专家，需要基于上述学术内容，生成三种不同难度级别的中文问答对，总共{num_pairs}个问答对（尽量平均分配到各级别）。
 
 【要求】：
 1. 为每个问题标记难度级别：基础(basic)、中级(intermediate)或高级(advanced)
@@ -137,9 +223,6 @@ PDF_CONTENT_PLACEHOLDER
 5. 确保问答深度与标记的难度级别相符
 6. 每个问题都必须提及论文的标题或主题
 
-【内容】：
-PDF_CONTENT_PLACEHOLDER
-
 请仅返回JSON格式，每个问答对包含'question'、'answer'和'level'字段：
 [
   {{"question": "基础问题...", "answer": "基础回答...", "level": "basic"}},
@@ -147,86 +230,318 @@ PDF_CONTENT_PLACEHOLDER
   {{"question": "高级问题...", "answer": "高级回答...", "level": "advanced"}}
 ]"""
     
-    def _prepare_qa_prompt(self, content, level, num_pairs, metadata=None):
-        """准备问答生成的提示词
+    def _content_prefix(self, content, metadata=None):
+        """
+        构造提示词的文档内容前缀
+        
+        前缀只取决于文档本身，同一文档不同级别、不同数量以及补充请求的提示词都以它开头，
+        便于服务端的上下文缓存命中。
+        
+        Args:
+            content (str): 文档内容（已截断或切分）
+            metadata (dict): PDF元数据
+            
+        Returns:
+            str: 内容前缀
+        """
+        title = (metadata or {}).get("title")
+        title_line = f"【标题】：{title}\n\n" if title else ""
+        return f"""请阅读以下学术内容，之后将根据要求基于该内容生成问答对。
+
+{title_line}【内容】：
+{content}
+
+"""
+    
+    def _prepare_qa_prompt(self, content, level, num_pairs, metadata=None, truncate=True):
+        """准备问答生成的提示词：文档内容在前作为稳定前缀，级别和数量相关的要求在后
 
         Args:
             content (str): PDF内容
             level (str): 问答级别
             num_pairs (int): 问答对数量
             metadata (dict): PDF元数据
+            truncate (bool): 是否截断到前MAX_CONTENT_CHARS字符；分片内容已按token预算切分，不再截断
 
         Returns:
             str: 完整提示词
         """
         logger.info(f"准备问答提示词: level={level}, num_pairs={num_pairs}")
-        logger.info(f"原始PDF内容长度: {len(content)} 字符")
-        
-        # 获取模板
-        template = self._get_prompt_template(level, num_pairs, metadata)
-        logger.info(f"模板长度: {len(template)} 字符")
         
         # 确保content不为None
         if content is None:
             logger.warning("PDF内容为None，使用空字符串替代")
             content = ""
+        logger.info(f"原始PDF内容长度: {len(content)} 字符")
+        
+        # 获取模板
+        template = self._get_prompt_template(level, num_pairs, metadata)
+        logger.info(f"模板长度: {len(template)} 字符")
         
         # 截断内容
-        content_to_use = content[:50000]
-        if len(content) > 50000:
-            logger.info(f"PDF内容超过50000字符，已截断，原始长度: {len(content)}")
+        content_to_use = content[:self.MAX_CONTENT_CHARS] if truncate else content
+        if truncate and len(content) > self.MAX_CONTENT_CHARS:
+            logger.info(f"PDF内容超过{self.MAX_CONTENT_CHARS}字符，已截断，原始长度: {len(content)}")
         
         # 确保有内容用于替换
         if not content_to_use:
-            logger.warning("PDF内容为空，替换后提示词可能无效")
-        
-        # 检查模板中的占位符类型
-        if "{content[:50000]}" in template:
-            logger.info("检测到模板使用 {content[:50000]} 占位符")
-            prompt = template.replace("{content[:50000]}", content_to_use)
-        elif "{content}" in template:
-            logger.info("检测到模板使用 {content} 占位符")
-            prompt = template.replace("{content}", content_to_use)
-        else:
-            # 如果都找不到，尝试直接在内容标记后插入
-            content_marker = "【内容】："
-            if content_marker in template:
-                logger.info(f"使用内容标记 {content_marker} 进行拆分替换")
-                parts = template.split(content_marker)
-                if len(parts) >= 2:
-                    before = parts[0] + content_marker + "\n"
-                    after_parts = parts[1].split("\n", 1)
-                    if len(after_parts) > 1:
-                        after = "\n" + after_parts[1]
-                    else:
-                        after = ""
-                    prompt = before + content_to_use + after
-                else:
-                    logger.warning("无法拆分模板，使用原始模板")
-                    prompt = template
-            else:
-                logger.warning("未找到任何占位符，使用原始模板")
-                prompt = template
-        
-        logger.info(f"替换后的提示词长度: {len(prompt)} 字符")
-        
-        # 检查替换是否成功
-        if "{content" in prompt:
-            logger.warning("警告: 可能未成功替换占位符")
-        
-        # 验证内容样本是否在提示词中
-        if content_to_use:
-            content_sample = content_to_use[:30]
-            if content_sample in prompt:
-                logger.info("验证成功: PDF内容已包含在提示词中")
-                start_pos = prompt.find(content_sample)
-                context_sample = prompt[max(0, start_pos-10):min(len(prompt), start_pos+50)]
-                logger.info(f"内容示例: ...{context_sample}...")
-            else:
-                logger.warning("警告: 无法在提示词中找到PDF内容样本")
+            logger.warning("PDF内容为空，提示词可能无效")
+        
+        prompt = self._content_prefix(content_to_use, metadata) + template
+        logger.info(f"提示词长度: {len(prompt)} 字符")
         
         return prompt
     
+    def _truncation_tokens(self, content):
+        """整篇生成时截断长度（前MAX_CONTENT_CHARS字符）对应的token数"""
+        return estimate_tokens(content[:self.MAX_CONTENT_CHARS])
+    
+    def _split_content(self, content, num_pairs):
+        """
+        将文档切分为不超过token预算的片段；片段数多于问答对数时放大预算，
+        但放大后的预算不超过截断长度对应的token数，避免单个片段的提示词过长
+        
+        Args:
+            content (str): 文档文本
+            num_pairs (int): 问答对总数
+            
+        Returns:
+            list: 片段文本列表
+        """
+        chunks = TextChunker(self.chunk_tokens).split(content)
+        if len(chunks) > num_pairs > 0:
+            budget = int(estimate_tokens(content) / num_pairs * 1.2) + 1
+            budget = min(budget, max(self.chunk_tokens, self._truncation_tokens(content)))
+            chunks = TextChunker(max(self.chunk_tokens, budget)).split(content)
+            if len(chunks) > num_pairs:
+                logger.warning(f"文档切分为 {len(chunks)} 个片段，多于问答对数量 {num_pairs}，部分片段不会分到问答对")
+        return chunks
+    
+    def _allocate_pairs(self, chunks, num_pairs):
+        """
+        按片段长度比例分配问答对数量（最大余数法）
+        
+        Args:
+            chunks (list): 片段文本列表
+            num_pairs (int): 问答对总数
+            
+        Returns:
+            list: 每个片段的问答对数量
+        """
+        total = sum(len(chunk) for chunk in chunks) or 1
+        quotas = [num_pairs * len(chunk) / total for chunk in chunks]
+        counts = [int(quota) for quota in quotas]
+        by_remainder = sorted(range(len(chunks)), key=lambda i: quotas[i] - counts[i], reverse=True)
+        for i in by_remainder[:num_pairs - sum(counts)]:
+            counts[i] += 1
+        return counts
+    
+    def _generate_chunked(self, content, level, metadata, filename):
+        """
+        分片生成：各片段按长度分到相应数量的问答对，并发请求后合并
+        
+        Args:
+            content (str): 文档文本
+            level (str): 问答级别，None表示混合级别
+            metadata (dict): PDF元数据
+            filename (str): 文件名（用于日志）
+            
+        Returns:
+            list: 合并后的问答对列表
+        """
+        chunks = self._split_content(content, self.num_qa_pairs)
+        counts = self._allocate_pairs(chunks, self.num_qa_pairs)
+        logger.info(f"文件 {filename} 切分为 {len(chunks)} 个片段，各片段问答对数量: {counts}")
+        
+        # 混合级别时按 basic/intermediate/advanced 循环为各片段分配级别，每个片段按级别分别请求，
+        # 避免片段只分到少量问答对时全部生成为基础级别
+        if level:
+            level_sequence = [level] * self.num_qa_pairs
+        else:
+            cycle = [self.LEVEL_BASIC, self.LEVEL_INTERMEDIATE, self.LEVEL_ADVANCED]
+            level_sequence = [cycle[i % len(cycle)] for i in range(self.num_qa_pairs)]
+        
+        requests = []
+        position = 0
+        for i, (chunk, count) in enumerate(zip(chunks, counts)):
+            chunk_levels = level_sequence[position:position + count]
+            position += count
+            header = f"（以下为文档的第 {i + 1}/{len(chunks)} 部分）\n"
+            for chunk_level in dict.fromkeys(chunk_levels):
+                level_count = chunk_levels.count(chunk_level)
+                prompt = self._prepare_qa_prompt(header + chunk, chunk_level, level_count, metadata, truncate=False)
+                requests.append((prompt, chunk_level, level_count, self._max_tokens_for(level_count)))
+        
+        return self._merge_results(self._run_requests(requests, filename), level, self.num_qa_pairs)
+    
+    def _max_tokens_for(self, num_pairs):
+        """按问答对数量估算单级别请求的max_tokens"""
+        return min(MAX_COMPLETION_TOKENS, self.COMPLETION_OVERHEAD_TOKENS + self.TOKENS_PER_PAIR * num_pairs)
+    
+    @staticmethod
+    def _question_key(qa):
+        """问题去重用的规范化键（去掉空白、忽略大小写）"""
+        return re.sub(r'\s+', '', str(qa.get('question', ''))).lower()
+    
+    def _level_targets(self, num_pairs):
+        """混合级别时各级别的目标数量：尽量平均分配，余数优先分给较低级别"""
+        levels = [self.LEVEL_BASIC, self.LEVEL_INTERMEDIATE, self.LEVEL_ADVANCED]
+        return {lv: num_pairs // len(levels) + (1 if i < num_pairs % len(levels) else 0)
+                for i, lv in enumerate(levels)}
+    
+    def _level_deficits(self, qa_pairs, level, num_pairs):
+        """
+        计算各级别还缺少的问答对数量
+        
+        Args:
+            qa_pairs (list): 已有的问答对
+            level (str): 请求的问答级别，None表示混合级别
+            num_pairs (int): 期望的问答对数量
+            
+        Returns:
+            dict: 级别 -> 缺少的数量（只包含大于0的级别）
+        """
+        if level:
+            deficit = num_pairs - len(qa_pairs)
+            return {level: deficit} if deficit > 0 else {}
+        
+        targets = self._level_targets(num_pairs)
+        for qa in qa_pairs:
+            qa_level = qa.get('level', self.LEVEL_BASIC)
+            if qa_level in targets:
+                targets[qa_level] -= 1
+        return {lv: count for lv, count in targets.items() if count > 0}
+    
+    def _top_up_prompt(self, prompt, qa_pairs, deficits):
+        """
+        构造补充请求的提示词：原提示词保持不变放在最前面，便于服务端复用上下文缓存，
+        再附上已有问题和各级别缺少的数量
+        
+        Args:
+            prompt (str): 原始提示词
+            qa_pairs (list): 已生成的问答对
+            deficits (dict): 级别 -> 缺少的数量
+            
+        Returns:
+            str: 补充请求的提示词
+        """
+        existing = "\n".join(f"{i}. {qa.get('question', '')}" for i, qa in enumerate(qa_pairs, 1))
+        wanted = "，".join(f"{lv}级别{count}个" for lv, count in deficits.items())
+        return f"""{prompt}
+
+【补充要求】：
+以下问题已经生成，请不要重复或改写这些问题：
+{existing or "（无）"}
+
+请基于同样的内容再生成{sum(deficits.values())}个新的问答对（{wanted}），每个问答对的level字段标记对应级别，仅返回JSON格式。"""
+    
+    def _run_requests(self, requests, filename, initial_results=None):
+        """
+        并发发送一组生成请求，数量不足时按各级别缺少的数量发送补充请求
+        
+        Args:
+            requests (list): [(提示词, 问答级别, 问答对数量, max_tokens或None)]
+            filename (str): 文件名（用于日志）
+            initial_results (list): 与requests对应的已有问答对（例如来自多文档打包请求），
+                                    给出时不再发送首轮请求，只按缺少的数量补充
+            
+        Returns:
+            list: 与requests顺序一致的问答对列表（已按问题去重）
+        """
+        results = [list(qa_pairs) for qa_pairs in initial_results] if initial_results else [[] for _ in requests]
+        pending = range(len(requests))
+        
+        for round_num in range(1 if initial_results else 0, self.top_up_rounds + 1):
+            futures = {}
+            for i in pending:
+                prompt, level, num_pairs, max_tokens = requests[i]
+                if round_num == 0:
+                    futures[i] = self.deepseek_client.submit_qa_pairs(prompt, num_pairs, self.on_qa_pair, max_tokens)
+                    continue
+                
+                deficits = self._level_deficits(results[i], level, num_pairs)
+                if not deficits:
+                    continue
+                logger.info(f"文件 {filename} 问答对数量不足({len(results[i])}/{num_pairs})，"
+                            f"第 {round_num} 轮补充请求: {deficits}")
+                top_up_count = sum(deficits.values())
+                futures[i] = self.deepseek_client.submit_qa_pairs(
+                    self._top_up_prompt(prompt, results[i], deficits), top_up_count, self.on_qa_pair,
+                    self._max_tokens_for(top_up_count) if max_tokens else None)
+            
+            if not futures:
+                break
+            
+            for i, future in futures.items():
+                try:
+                    new_pairs = future.result() or []
+                except Exception as e:
+                    logger.error(f"文件 {filename} 生成问答对时出错: {str(e)}")
+                    continue
+                
+                seen = {self._question_key(qa) for qa in results[i]}
+                level = requests[i][1]
+                for qa in new_pairs:
+                    key = self._question_key(qa)
+                    if not key or key in seen:
+                        continue
+                    seen.add(key)
+                    if level and 'level' not in qa:
+                        qa['level'] = level
+                    results[i].append(qa)
+            pending = list(futures)
+        
+        return results
+    
+    def _merge_results(self, request_results, level, num_pairs):
+        """
+        合并各请求的问答对：按问题去重，轮流从各请求取出以覆盖全文，混合级别时按级别均衡
+        
+        Args:
+            request_results (list): 每个请求的问答对列表
+            level (str): 问答级别，None表示混合级别
+            num_pairs (int): 问答对总数
+            
+        Returns:
+            list: 合并后的问答对列表
+        """
+        seen = set()
+        queues = []
+        for qa_pairs in request_results:
+            queue = []
+            for qa in qa_pairs:
+                if not isinstance(qa, dict):
+                    continue
+                key = self._question_key(qa)
+                if not key or key in seen:
+                    continue
+                seen.add(key)
+                queue.append(qa)
+            queues.append(queue)
+        
+        ordered = []
+        while any(queues):
+            for queue in queues:
+                if queue:
+                    ordered.append(queue.pop(0))
+        
+        if level:
+            return ordered[:num_pairs]
+        
+        # 混合级别：每个级别尽量分到相同数量，不足的部分用其他级别补齐
+        targets = self._level_targets(num_pairs)
+        selected = []
+        leftovers = []
+        for qa in ordered:
+            qa_level = qa.get('level', self.LEVEL_BASIC)
+            if targets.get(qa_level, 0) > 0:
+                targets[qa_level] -= 1
+                selected.append(qa)
+            else:
+                leftovers.append(qa)
+        selected.extend(leftovers[:max(0, num_pairs - len(selected))])
+        return selected
+    
     def process_pdf(self, pdf_path):
         """
         处理单个PDF文件
@@ -241,7 +556,66 @@ PDF_CONTENT_PLACEHOLDER
         try:
             # 从PDF提取文本
             content, filename, metadata = self.pdf_processor.extract_text_from_pdf(pdf_path)
+        except Exception as e:
+            logger.error(f"处理PDF文件 {pdf_path} 时出错: {str(e)}")
+            return [], filename, "", {}, False
+        
+        return self.process_content(content, filename, metadata)
+    
+    def _compress_content(self, content, metadata, filename):
+        """
+        按段落重要性将长文档压缩到上下文预算内，并记录该文件的压缩率
+        
+        Args:
+            content (str): 文档文本
+            metadata (dict): 文档元数据（标题词在段落打分时加权）
+            filename (str): 文件名
+            
+        Returns:
+            str: 用于构造提示词的文本，无需压缩时返回原文
+        """
+        if not self.context_compression:
+            return content
+        
+        tokens = estimate_tokens(content)
+        budget = self.context_tokens
+        if not budget:
+            # 未指定预算时只替代截断：分片生成的文档保留全文，不超过截断长度的文档原样使用
+            if (self.chunk_tokens and tokens > self.chunk_tokens) or len(content) <= self.MAX_CONTENT_CHARS:
+                return content
+            budget = self._truncation_tokens(content)
+        elif not (self.chunk_tokens and budget > self.chunk_tokens):
+            # 压缩结果整篇放入提示词时，预算不超过截断长度
+            budget = min(budget, self._truncation_tokens(content))
+        if tokens <= budget:
+            return content
+        
+        compressed, info = self.context_compressor.compress(content, budget, (metadata or {}).get("title"))
+        compressed_tokens = estimate_tokens(compressed)
+        self.compression_stats[filename] = {
+            "original_tokens": tokens,
+            "compressed_tokens": compressed_tokens,
+            "ratio": round(compressed_tokens / tokens, 4),
+            "passages": info["passages"],
+            "selected_passages": info["selected"]
+        }
+        logger.info(f"文件 {filename} 上下文压缩: 选取 {info['selected']}/{info['passages']} 个段落，"
+                    f"{tokens} -> {compressed_tokens} token，压缩率 {compressed_tokens / tokens:.1%}")
+        return compressed
+    
+    def process_content(self, content, filename, metadata):
+        """
+        为已提取的文档内容生成问答对
+        
+        Args:
+            content (str): 提取出的文档文本
+            filename (str): 源文件名
+            metadata (dict): 文档元数据
             
+        Returns:
+            tuple: (问答对列表, 源文件名, 原始内容, 元数据, 是否成功)
+        """
+        try:
             if not content:
                 logger.warning(f"PDF文件 {filename} 没有提取到内容")
                 return [], filename, "", {}, False
@@ -254,12 +628,32 @@ PDF_CONTENT_PLACEHOLDER
             
             all_qa_pairs = []
             
+            # 长文档按段落重要性压缩到上下文预算内，而不是只取开头；压缩后的内容不再截断
+            prompt_content = self._compress_content(content, metadata, filename)
+            truncate = prompt_content is content
+            
+            # 长文档按片段并发生成，否则整篇（截断后）一次生成
+            use_chunks = bool(self.chunk_tokens) and estimate_tokens(prompt_content) > self.chunk_tokens
+            
             # 生成指定级别的问答对
             for level in levels:
-                prompt = self._prepare_qa_prompt(content, level, self.num_qa_pairs, metadata)
-                
-                # 生成问答对
-                qa_pairs = self.deepseek_client.generate_qa_pairs(prompt, self.num_qa_pairs)
+                if use_chunks:
+                    qa_pairs = self._generate_chunked(prompt_content, level, metadata, filename)
+                else:
+                    if level is None and self.split_levels:
+                        # 各级别分别请求，max_tokens按各自的问答对数量确定，并发解码
+                        requests = []
+                        for split_level, count in self._level_targets(self.num_qa_pairs).items():
+                            if count > 0:
+                                prompt = self._prepare_qa_prompt(prompt_content, split_level, count, metadata, truncate)
+                                requests.append((prompt, split_level, count, self._max_tokens_for(count)))
+                    else:
+                        prompt = self._prepare_qa_prompt(prompt_content, level, self.num_qa_pairs, metadata, truncate)
+                        requests = [(prompt, level, self.num_qa_pairs, None)]
+                    
+                    # 生成问答对，数量不足时发送补充请求
+                    request_results = self._run_requests(requests, filename)
+                    qa_pairs = self._merge_results(request_results, level, self.num_qa_pairs)
                 
                 if not qa_pairs:
                     logger.warning(f"文件 {filename} 生成 {level or '混合'} 级别问答对失败")
@@ -285,13 +679,399 @@ PDF_CONTENT_PLACEHOLDER
             return all_qa_pairs, filename, content, metadata, True
             
         except Exception as e:
-            logger.error(f"处理PDF文件 {pdf_path} 时出错: {str(e)}")
+            logger.error(f"为文件 {filename} 生成问答对时出错: {str(e)}")
             return [], filename, "", {}, False
     
-    def generate_qa_from_pdfs(self):
+    def _pack_prompt(self, documents, level, num_pairs):
+        """
+        构造多文档打包请求的提示词：各文档带编号分隔，要求每个问答对用doc字段标记所属文档
+        
+        Args:
+            documents (list): [(文本, 文件名, 元数据)]
+            level (str): 问答级别，None表示混合级别
+            num_pairs (int): 每篇文档的问答对数量
+            
+        Returns:
+            str: 提示词
+        """
+        count = len(documents)
+        sections = []
+        for i, (content, _, metadata) in enumerate(documents, 1):
+            title = (metadata or {}).get("title")
+            title_line = f"【标题】：{title}\n" if title else ""
+            sections.append(f"===== 文档 {i} 开始 =====\n{title_line}【内容】：\n{content}\n===== 文档 {i} 结束 =====")
+        
+        if level:
+            level_requirement = f'所有问答对均为{level}级别，level字段标记为"{level}"'
+        else:
+            level_requirement = ("每篇文档的问答对尽量平均分配到基础(basic)、中级(intermediate)、高级(advanced)三个级别："
+                                 "基础级关注基本概念和定义，中级关注概念间的联系与原理应用，高级关注方法论、局限性和批判性分析，"
+                                 "level字段标记对应级别")
+        
+        return f"""请阅读以下 {count} 篇相互独立的学术文档，之后将根据要求为每篇文档分别生成问答对。
+
+{chr(10).join(sections)}
+
+你是一位科研与教育并重的学术专家，需要为上述每篇文档各生成{num_pairs}个中文问答对，共{count * num_pairs}个问答对。
+
+【要求】：
+1. 每个问答对只基于一篇文档，用doc字段标记文档编号(1-{count})，不要混合不同文档的内容
+2. {level_requirement}
+3. 每个问题都必须提及对应文档的标题或主题
+4. 回答准确简明，每个回答控制在200字以内
+
+请仅返回JSON格式，每个问答对包含'doc'、'question'、'answer'和'level'字段：
+[
+  {{"doc": 1, "question": "问题1", "answer": "答案1", "level": "basic"}},
+  {{"doc": 2, "question": "问题2", "answer": "答案2", "level": "intermediate"}}
+]"""
+    
+    def _pack_capacity(self):
+        """每组最多打包的文档数：不超过pack_max_docs，且全部问答对能放进单次请求的最大输出token数"""
+        per_document = max(1, self.PACK_TOKENS_PER_PAIR * self.num_qa_pairs)
+        return min(self.pack_max_docs, (MAX_COMPLETION_TOKENS - self.COMPLETION_OVERHEAD_TOKENS) // per_document)
+    
+    def process_pack(self, documents):
+        """
+        用一次请求为多篇小文档生成问答对，按doc字段拆回各文档；
+        某篇文档数量不足时，以单文档提示词按缺少的数量补充
+        
+        Args:
+            documents (list): [(文本, 文件名, 元数据)]
+            
+        Returns:
+            list: 与documents顺序一致的 (问答对列表, 源文件名, 原始内容, 元数据, 是否成功)
+        """
+        level = self.qa_level
+        count = len(documents)
+        total = count * self.num_qa_pairs
+        names = ", ".join(filename for _, filename, _ in documents)
+        logger.info(f"打包 {count} 篇文档为一次请求: {names}")
+        
+        per_document = [[] for _ in documents]
+        try:
+            max_tokens = min(MAX_COMPLETION_TOKENS, self.COMPLETION_OVERHEAD_TOKENS + self.PACK_TOKENS_PER_PAIR * total)
+            qa_pairs = self.deepseek_client.generate_qa_pairs(self._pack_prompt(documents, level, self.num_qa_pairs),
+                                                              total, self.on_qa_pair, max_tokens)
+        except Exception as e:
+            logger.error(f"打包请求生成问答对时出错: {str(e)}")
+            qa_pairs = []
+        
+        for qa in qa_pairs:
+            if not isinstance(qa, dict):
+                continue
+            try:
+                index = int(str(qa.pop('doc', '')).strip()) - 1
+            except ValueError:
+                continue
+            if 0 <= index < count:
+                per_document[index].append(qa)
+        
+        outcomes = []
+        for (content, filename, metadata), doc_pairs in zip(documents, per_document):
+            try:
+                if self._level_deficits(doc_pairs, level, self.num_qa_pairs) and self.top_up_rounds > 0:
+                    logger.info(f"文件 {filename} 在打包请求中得到 {len(doc_pairs)}/{self.num_qa_pairs} 个问答对，单独补充")
+                    prompt = self._prepare_qa_prompt(content, level, self.num_qa_pairs, metadata)
+                    doc_pairs = self._run_requests([(prompt, level, self.num_qa_pairs, None)], filename,
+                                                   initial_results=[doc_pairs])[0]
+                result = self._merge_results([doc_pairs], level, self.num_qa_pairs)
+            except Exception as e:
+                logger.error(f"为文件 {filename} 生成问答对时出错: {str(e)}")
+                result = []
+            
+            for qa in result:
+                if 'level' not in qa:
+                    qa['level'] = level or self.LEVEL_BASIC
+            
+            if result:
+                logger.info(f"文件 {filename} 成功生成 {len(result)} 个 {level or '混合'} 级别问答对（打包请求）")
+                outcomes.append((result, filename, content, metadata, True))
+            else:
+                logger.warning(f"文件 {filename} 生成所有级别问答对均失败")
+                outcomes.append(([], filename, content, metadata, False))
+        return outcomes
+    
+    def _extract_stage(self, pdf_files, output, monitor):
+        """
+        流水线提取阶段：在进程池中提取PDF，结果放入有界队列
+        
+        队列满时不再提交新的提取任务，同时驻留内存的已提取文档不超过
+        队列容量 + 提取进程数 + 生成阶段并行数。进程池不可用或某个文件在工作进程中失败时，
+        回退到在当前进程中提取。
+        
+        Args:
+            pdf_files (list): PDF文件路径列表
+            output (MonitoredQueue): 输出队列，元素为 (PDF路径, 文本, 文件名, 元数据, 提取耗时)
+            monitor (StageMonitor): 提取阶段统计
+        """
+        def emit(pdf, content, filename, metadata, seconds):
+            with monitor.waiting():
+                output.put((pdf, content, filename, metadata, seconds))
+        
+        def extract_locally(pdf):
+            started = time.monotonic()
+            try:
+                content, filename, metadata = self.pdf_processor.extract_text_from_pdf(pdf)
+            except Exception as e:
+                logger.error(f"提取文件 {pdf} 时出错: {str(e)}")
+                content, filename, metadata = "", os.path.basename(pdf), {}
+            seconds = time.monotonic() - started
+            monitor.add_busy(seconds)
+            return content, filename, metadata, seconds
+        
+        executor = None
+        try:
+            if self.extract_workers > 0:
+                try:
+                    # 使用spawn上下文，避免在多线程环境中fork
+                    executor = ProcessPoolExecutor(max_workers=self.extract_workers,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+                except Exception as e:
+                    logger.error(f"创建提取进程池失败，在当前进程中提取: {str(e)}")
+            
+            if executor is None:
+                for pdf in pdf_files:
+                    emit(pdf, *extract_locally(pdf))
+                return
+            
+            options = self.pdf_processor.document_worker_options()
+            remaining = iter(pdf_files)
+            in_flight = {}
+            
+            def submit_next():
+                pdf = next(remaining, None)
+                if pdf is None:
+                    return
+                try:
+                    in_flight[executor.submit(extract_document_worker, pdf, options)] = pdf
+                except Exception as e:
+                    logger.error(f"提交提取任务 {pdf} 失败，在当前进程中提取: {str(e)}")
+                    emit(pdf, *extract_locally(pdf))
+                    submit_next()
+            
+            for _ in range(self.extract_workers):
+                submit_next()
+            
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pdf = in_flight.pop(future)
+                    try:
+                        content, filename, metadata, seconds = future.result()
+                        monitor.add_busy(seconds)
+                    except Exception as e:
+                        logger.error(f"提取进程处理 {pdf} 失败，在当前进程中提取: {str(e)}")
+                        content, filename, metadata, seconds = extract_locally(pdf)
+                    # 队列满时在此阻塞，暂停提交新的提取任务
+                    emit(pdf, content, filename, metadata, seconds)
+                    submit_next()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            output.put(_PIPELINE_DONE)
+    
+    def _estimate_cost(self, pdf_path):
+        """
+        提取前按页数、文件大小和文本层抽样估算文件的处理耗时
+        
+        Args:
+            pdf_path (str): PDF文件路径
+            
+        Returns:
+            dict: pages、bytes、tokens(估算的全文token数)，以及extract、generate、total预测耗时(秒)
+        """
+        probe = self.pdf_processor.probe_document(pdf_path)
+        pages = probe["pages"]
+        
+        extract = pages * self.COST_EXTRACT_PER_PAGE + probe["bytes"] / (1024 * 1024) * self.COST_PER_MB
+        if self.pdf_processor.use_latex_ocr:
+            extract += pages * self.COST_OCR_PER_PAGE
+        if pages and not probe["text_layer"]:
+            extract += pages * self.COST_NO_TEXT_PER_PAGE
+        
+        # 按抽样文本的token密度估算全文token数；整篇生成时只有截断后的内容进入提示词
+        sample = probe["sample_text"]
+        density = estimate_tokens(sample) / len(sample) if sample else 0.5
+        tokens = int(probe["chars"] * density)
+        prompt_tokens = tokens
+        if self.context_compression and self.context_tokens:
+            prompt_tokens = min(prompt_tokens, self.context_tokens)
+        if not (self.chunk_tokens and prompt_tokens > self.chunk_tokens):
+            prompt_tokens = min(prompt_tokens, int(self.MAX_CONTENT_CHARS * density))
+        generate = (self.COST_GENERATE_BASE + self.num_qa_pairs * self.COST_PER_PAIR
+                    + prompt_tokens / 1000 * self.COST_PER_1K_PROMPT_TOKENS)
+        
+        return {"pages": pages, "bytes": probe["bytes"], "tokens": tokens,
+                "extract": extract, "generate": generate, "total": extract + generate}
+    
+    def _schedule_files(self, pdf_files):
+        """
+        确定提交顺序：lpt调度时按估算成本从高到低排列，让大文件尽早开始，避免批次末尾的长尾
+        
+        Args:
+            pdf_files (list): PDF文件路径列表
+            
+        Returns:
+            tuple: (排序后的文件列表, 各文件的成本估算dict，fifo调度时为空)
+        """
+        if self.schedule != "lpt" or len(pdf_files) < 2:
+            return pdf_files, {}
+        
+        estimates = {pdf: self._estimate_cost(pdf) for pdf in pdf_files}
+        ordered = sorted(pdf_files, key=lambda pdf: estimates[pdf]["total"], reverse=True)
+        logger.info(f"按最长作业优先调度 {len(ordered)} 个文件:")
+        for i, pdf in enumerate(ordered, 1):
+            cost = estimates[pdf]
+            logger.info(f"  {i}. {os.path.basename(pdf)}: {cost['pages']} 页, {cost['bytes'] / 1024:.0f}KB, "
+                        f"约 {cost['tokens']} token, 预测 {cost['total']:.1f} 秒 "
+                        f"(提取 {cost['extract']:.1f} / 生成 {cost['generate']:.1f})")
+        return ordered, estimates
+    
+    def _report_cost_model(self, estimates, outcomes):
+        """
+        记录各文件预测耗时与实际耗时的对比，并汇总成本模型的准确度
+        
+        Args:
+            estimates (dict): 各文件的成本估算
+            outcomes (list): 流水线结果，元素为 (PDF路径, 处理结果, (提取耗时, 生成耗时))
+            
+        Returns:
+            dict: files、median_ratio(实际/预测的中位数)、rank_correlation(预测与实际排序的Spearman相关系数)，
+                  没有可比较的文件时返回None
+        """
+        pairs = []
+        for pdf, _, timing in outcomes:
+            if timing is None or pdf not in estimates:
+                continue
+            cost = estimates[pdf]
+            extract_seconds, generate_seconds = timing
+            actual = extract_seconds + generate_seconds
+            logger.info(f"文件 {os.path.basename(pdf)}: 预测 {cost['total']:.1f} 秒 "
+                        f"(提取 {cost['extract']:.1f} / 生成 {cost['generate']:.1f})，实际 {actual:.1f} 秒 "
+                        f"(提取 {extract_seconds:.1f} / 生成 {generate_seconds:.1f})")
+            pairs.append((cost["total"], actual))
+        if not pairs:
+            return None
+        
+        ratios = sorted(actual / predicted for predicted, actual in pairs if predicted > 0)
+        median_ratio = ratios[len(ratios) // 2] if ratios else None
+        
+        def ranks(values):
+            order = sorted(range(len(values)), key=lambda i: values[i])
+            result = [0] * len(values)
+            for rank, i in enumerate(order):
+                result[i] = rank
+            return result
+        
+        rank_correlation = None
+        n = len(pairs)
+        if n >= 2:
+            predicted_ranks = ranks([p for p, _ in pairs])
+            actual_ranks = ranks([a for _, a in pairs])
+            d2 = sum((p - a) ** 2 for p, a in zip(predicted_ranks, actual_ranks))
+            rank_correlation = 1 - 6 * d2 / (n * (n * n - 1))
+        
+        logger.info(f"成本模型: {n} 个文件，实际/预测耗时中位数 "
+                    f"{median_ratio if median_ratio is not None else float('nan'):.2f}，"
+                    f"排序相关系数 {rank_correlation if rank_correlation is not None else float('nan'):.2f}")
+        return {"files": n,
+                "median_ratio": round(median_ratio, 3) if median_ratio is not None else None,
+                "rank_correlation": round(rank_correlation, 3) if rank_correlation is not None else None}
+    
+    def _generation_settings(self):
+        """
+        获取影响生成结果的设置，批处理日志只复用设置一致的记录
+        
+        Returns:
+            dict: 生成设置
+        """
+        return {
+            "model": os.getenv("MODEL_NAME", "deepseek-chat"),
+            "num_qa_pairs": self.num_qa_pairs,
+            "qa_level": self.qa_level,
+            "chunk_tokens": self.chunk_tokens,
+            "split_levels": self.split_levels,
+            "context_tokens": self.context_tokens,
+            "context_compression": self.context_compression
+        }
+    
+    def _generate_documents(self, items, monitor, outcomes, lock, journal=None):
+        """
+        为一篇文档或一组打包的小文档生成问答对，并记录结果
+        
+        Args:
+            items (list): 队列元素列表 (PDF路径, 文本, 文件名, 元数据, 提取耗时)
+            monitor (StageMonitor): 生成阶段统计
+            outcomes (list): 结果列表
+            lock (threading.Lock): 保护outcomes的锁
+            journal (BatchJournal): 批处理日志
+        """
+        started = time.monotonic()
+        try:
+            if len(items) == 1:
+                _, content, filename, metadata, _ = items[0]
+                results = [self.process_content(content, filename, metadata)]
+            else:
+                results = self.process_pack([(content, filename, metadata) for _, content, filename, metadata, _ in items])
+        except Exception as e:
+            logger.error(f"获取文件 {', '.join(item[0] for item in items)} 的处理结果时出错: {str(e)}")
+            results = [([], os.path.basename(item[0]), "", {}, False) for item in items]
+        generate_seconds = time.monotonic() - started
+        monitor.add_busy(generate_seconds)
+        
+        for (pdf, content, _, _, extract_seconds), outcome in zip(items, results):
+            if journal is not None:
+                qa_pairs, _, _, metadata, success = outcome
+                journal.record(pdf, qa_pairs, metadata, content, success, self._generation_settings())
+            with lock:
+                outcomes.append((pdf, outcome, (extract_seconds, generate_seconds)))
+    
+    def _generate_stage(self, source, monitor, outcomes, lock, journal=None, packer=None):
+        """
+        流水线生成阶段的工作线程：从队列取出已提取的文档并生成问答对
+        
+        Args:
+            source (MonitoredQueue): 输入队列
+            monitor (StageMonitor): 生成阶段统计
+            outcomes (list): 结果列表，元素为 (PDF路径, process_content的返回值, (提取耗时, 生成耗时))
+            lock (threading.Lock): 保护outcomes的锁
+            journal (BatchJournal): 批处理日志，每个文件完成后立即写入
+            packer (DocumentPacker): 小文档打包器，为None时逐篇生成
+        """
+        while True:
+            with monitor.waiting():
+                item = source.get()
+            if item is _PIPELINE_DONE:
+                # 放回结束标记，让其他工作线程也能退出
+                source.put(item)
+                if packer is not None:
+                    remaining = packer.drain()
+                    if remaining:
+                        self._generate_documents(remaining, monitor, outcomes, lock, journal)
+                return
+            
+            items = [item]
+            content = item[1]
+            if packer is not None and content:
+                tokens = estimate_tokens(content)
+                if tokens <= packer.max_tokens // 2:
+                    items = packer.add(item, tokens)
+                    if not items:
+                        continue
+            self._generate_documents(items, monitor, outcomes, lock, journal)
+    
+    def generate_qa_from_pdfs(self, journal=None):
         """
         从所有PDF文件生成问答对
         
+        以两阶段流水线运行：提取阶段在进程池中提取PDF（CPU密集），通过有界队列
+        交给生成阶段的max_workers个线程调用API（I/O密集），两个阶段同时进行。
+        
+        Args:
+            journal (BatchJournal): 批处理日志；每个文件完成后立即记录结果，
+                                    已在日志中以相同设置成功完成的文件直接复用记录，不再处理
+        
         Returns:
             tuple: (问答对列表, 失败文件列表)
                   问答对列表: 每个元素是一个四元组 (问答对列表, 源文件名, 原始内容, 元数据)
@@ -306,27 +1086,88 @@ PDF_CONTENT_PLACEHOLDER
         results = []
         self.failed_files = []  # 重置失败文件列表
         
-        # 使用线程池并行处理PDF文件
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 提交所有任务
-            future_to_pdf = {executor.submit(self.process_pdf, pdf): pdf for pdf in pdf_files}
-            
-            # 收集结果
-            for future in as_completed(future_to_pdf):
-                pdf = future_to_pdf[future]
-                pdf_name = os.path.basename(pdf)
-                try:
-                    qa_pairs, filename, content, metadata, success = future.result()
-                    if success:
-                        results.append((qa_pairs, filename, content, metadata))
-                    else:
-                        self.failed_files.append(filename)
-                except Exception as e:
-                    logger.error(f"获取文件 {pdf} 的处理结果时出错: {str(e)}")
-                    self.failed_files.append(pdf_name)
+        extracted = MonitoredQueue(self.pipeline_queue_size)
+        extract_monitor = StageMonitor("提取", self.extract_workers)
+        generate_monitor = StageMonitor("生成", self.max_workers)
+        outcomes = []
+        lock = threading.Lock()
+        started = time.monotonic()
+        
+        # 跳过批处理日志中已完成的文件
+        pending_files = pdf_files
+        if journal is not None:
+            settings = self._generation_settings()
+            pending_files = []
+            for pdf in pdf_files:
+                entry = journal.get_completed(pdf, settings)
+                if entry is None:
+                    pending_files.append(pdf)
+                else:
+                    outcomes.append((pdf, (entry["qa_pairs"], entry["file"], "", entry.get("metadata") or {}, True), None))
+            if outcomes:
+                logger.info(f"批处理日志中已完成 {len(outcomes)} 个文件，跳过；剩余 {len(pending_files)} 个")
+        
+        pending_files, estimates = self._schedule_files(pending_files)
+        
+        packer = None
+        if self.pack_tokens:
+            capacity = self._pack_capacity()
+            if capacity >= 2:
+                packer = DocumentPacker(self.pack_tokens, capacity)
+                logger.info(f"启用小文档打包: 每组内容不超过 {self.pack_tokens} token，最多 {capacity} 篇")
+            else:
+                logger.warning(f"每篇文档 {self.num_qa_pairs} 个问答对时单次请求的输出只够一篇文档，不进行打包")
+        
+        logger.info(f"启动处理流水线: 提取进程 {self.extract_workers or '当前进程'}，"
+                    f"生成线程 {self.max_workers}，队列容量 {self.pipeline_queue_size}")
+        threads = [threading.Thread(target=self._extract_stage, args=(pending_files, extracted, extract_monitor),
+                                    name="qa-extract", daemon=True)]
+        threads.extend(threading.Thread(target=self._generate_stage,
+                                        args=(extracted, generate_monitor, outcomes, lock, journal, packer),
+                                        name=f"qa-generate-{i}", daemon=True)
+                       for i in range(max(1, self.max_workers)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        elapsed = time.monotonic() - started
+        self.pipeline_stats = {
+            "elapsed_seconds": round(elapsed, 2),
+            "extract": extract_monitor.summary(elapsed),
+            "generate": generate_monitor.summary(elapsed),
+            "queue_capacity": self.pipeline_queue_size,
+            "queue_max_depth": extracted.max_depth,
+            "queue_avg_depth": round(extracted.average_depth(), 2),
+            "schedule": self.schedule,
+            "packed_documents": packer.documents if packer is not None else 0,
+            "pack_requests": packer.packs if packer is not None else 0,
+            "cost_model": self._report_cost_model(estimates, outcomes)
+        }
+        
+        # 按文件列表顺序收集结果
+        order = {pdf: i for i, pdf in enumerate(pdf_files)}
+        for pdf, (qa_pairs, filename, content, metadata, success), _ in sorted(outcomes, key=lambda x: order[x[0]]):
+            if success:
+                results.append((qa_pairs, filename, content, metadata))
+            else:
+                self.failed_files.append(filename)
         
         logger.info(f"共处理了 {len(pdf_files)} 个PDF文件，成功: {len(results)}，失败: {len(self.failed_files)}")
         
+        for key in ("extract", "generate"):
+            stage = self.pipeline_stats[key]
+            name = extract_monitor.name if key == "extract" else generate_monitor.name
+            logger.info(f"{name}阶段: 并行度 {stage['workers']}，处理 {stage['items']} 个文件，"
+                        f"忙碌 {stage['busy_seconds']:.1f} 秒，等待 {stage['wait_seconds']:.1f} 秒，"
+                        f"利用率 {stage['utilization']:.1%}")
+        logger.info(f"流水线耗时 {elapsed:.1f} 秒，队列深度 平均 {self.pipeline_stats['queue_avg_depth']:.2f}，"
+                    f"最大 {extracted.max_depth}/{self.pipeline_queue_size}")
+        
+        run_stats = self.get_run_stats()
+        logger.info(f"API调用 {run_stats['api_calls']} 次，上下文缓存命中 {run_stats['prompt_cache_hit_tokens']} token，"
+                    f"未命中 {run_stats['prompt_cache_miss_tokens']} token，命中率 {run_stats['prompt_cache_hit_rate']:.1%}")
+        
         # 打印处理失败的文件列表
         if self.failed_files:
             logger.warning("以下文件处理失败:")
@@ -335,6 +1176,24 @@ PDF_CONTENT_PLACEHOLDER
         
         return results, self.failed_files
     
+    def get_run_stats(self):
+        """获取运行统计（API调用次数、token用量、上下文缓存命中情况，批量处理流水线各阶段的利用率，以及各文件的上下文压缩率等）"""
+        stats = self.deepseek_client.get_stats()
+        if self.pipeline_stats is not None:
+            stats["pipeline"] = self.pipeline_stats
+        if self.compression_stats:
+            per_file = dict(self.compression_stats)
+            original = sum(item["original_tokens"] for item in per_file.values())
+            compressed = sum(item["compressed_tokens"] for item in per_file.values())
+            stats["context_compression"] = {
+                "files": len(per_file),
+                "original_tokens": original,
+                "compressed_tokens": compressed,
+                "ratio": round(compressed / original, 4) if original else None,
+                "per_file": per_file
+            }
+        return stats
+    
     def get_failed_files(self):
         """获取处理失败的文件列表"""
         return self.failed_files
\ No newline at end of file
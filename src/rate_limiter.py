@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import random
+import asyncio
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+def estimate_tokens(text):
+    """
+    粗略估算文本的token数（中文约0.6 token/字，其他字符约0.3 token/字符）
+
+    Args:
+        text (str): 文本
+
+    Returns:
+        int: 估算的token数
+    """
+    if not text:
+        return 0
+    cjk_chars = len(_CJK_PATTERN.findall(text))
+    return int(cjk_chars * 0.6 + (len(text) - cjk_chars) * 0.3) + 1
+
+def backoff_delay(attempt, base_delay, max_delay=60.0, retry_after=None):
+    """
+    计算带抖动的指数退避时间；服务端给出Retry-After时以其为下限
+
+    Args:
+        attempt (int): 第几次重试（从1开始）
+        base_delay (float): 基础等待时间(秒)
+        max_delay (float): 最长等待时间(秒)
+        retry_after (float): 服务端要求的等待时间(秒)
+
+    Returns:
+        float: 等待时间(秒)
+    """
+    # Full jitter: 在 [0, base * 2^(n-1)] 内均匀取值，避免所有请求同步重试
+    ceiling = min(max_delay, base_delay * (2 ** (attempt - 1)))
+    delay = random.uniform(0, ceiling)
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, base_delay))
+    return delay
+
+def parse_retry_after(error):
+    """
+    从API异常中读取Retry-After响应头
+
+    Args:
+        error (Exception): openai SDK抛出的异常
+
+    Returns:
+        float: 等待秒数，不存在时返回None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+class TokenBucket:
+    """按分钟补充容量的异步令牌桶（只在单个事件循环中使用）"""
+
+    def __init__(self, per_minute):
+        """
+        初始化令牌桶
+
+        Args:
+            per_minute (float): 每分钟补充的容量，同时也是桶的上限
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.available = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount):
+        """
+        取走指定容量，不足时等待补充
+
+        Args:
+            amount (float): 需要的容量（超过桶上限时按上限计）
+        """
+        amount = min(float(amount), self.capacity)
+        while True:
+            self._refill()
+            if self.available >= amount:
+                self.available -= amount
+                return
+            await asyncio.sleep((amount - self.available) / self.rate)
+
+    def adjust(self, delta):
+        """
+        根据实际用量修正（delta为正表示多用，为负表示退还），允许暂时为负
+
+        Args:
+            delta (float): 修正量
+        """
+        self._refill()
+        self.available = min(self.capacity, self.available - delta)
+
+class RateLimiter:
+    """同时限制每分钟请求数(RPM)和每分钟token数(TPM)的限流器"""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        """
+        初始化限流器
+
+        Args:
+            requests_per_minute (int): 每分钟请求数上限，None表示不限制
+            tokens_per_minute (int): 每分钟token数上限，None表示不限制
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    async def acquire(self, estimated_tokens):
+        """
+        为一次请求预留容量
+
+        Args:
+            estimated_tokens (int): 预估的token用量
+        """
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None:
+            await self.tokens.acquire(estimated_tokens)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """
+        用实际token用量修正预留量
+
+        Args:
+            estimated_tokens (int): 预留时的估算值
+            actual_tokens (int): 实际用量
+        """
+        if self.tokens is not None and actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+class AIMDConcurrencyLimiter:
+    """加性增/乘性减(AIMD)的并发控制：无拥塞时逐步放宽并发，遇到429、超时或解码变慢时减半"""
+
+    def __init__(self, max_limit, min_limit=1, initial_limit=None, decrease_factor=0.5,
+                 latency_factor=2.0, min_sample_tokens=200):
+        """
+        初始化并发控制器
+
+        Args:
+            max_limit (int): 并发上限
+            min_limit (int): 并发下限
+            initial_limit (int): 初始并发数，默认为上限的一半
+            decrease_factor (float): 拥塞时的乘性减系数
+            latency_factor (float): 每token延迟超过滑动平均的该倍数时视为拥塞
+            min_sample_tokens (int): 生成token数不少于该值的请求才用于统计每token延迟；
+                                     生成很少的请求（补充请求、单级别请求）延迟主要是提示词预填充，不反映解码速度
+        """
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(initial_limit or max(self.min_limit, self.max_limit // 2))
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.min_sample_tokens = min_sample_tokens
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        self._latency_ewma = None
+        self._samples = 0
+        self._last_decrease = 0.0
+
+    async def acquire(self):
+        """等待直到在途请求数低于当前并发上限"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        """释放一个在途名额"""
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def on_success(self, latency, completion_tokens=None):
+        """
+        记录一次成功请求；解码速度明显变慢时视为拥塞，否则加性增
+
+        Args:
+            latency (float): 解码耗时(秒)，流式请求为首个token到结束的时间，非流式请求为整个请求的耗时
+            completion_tokens (int): 生成的token数
+        """
+        congested = False
+        if completion_tokens and completion_tokens >= self.min_sample_tokens:
+            per_token = latency / completion_tokens
+            if self._latency_ewma is not None and self._samples >= 5:
+                congested = per_token > self._latency_ewma * self.latency_factor
+            self._latency_ewma = per_token if self._latency_ewma is None else 0.8 * self._latency_ewma + 0.2 * per_token
+            self._samples += 1
+
+        if congested:
+            await self.on_congestion("延迟升高")
+            return
+        async with self._condition:
+            # 每个“窗口”（约等于当前并发数个成功请求）增加1
+            self.limit = min(self.max_limit, self.limit + 1.0 / max(1.0, self.limit))
+            self._condition.notify_all()
+
+    async def on_congestion(self, reason):
+        """
+        记录一次拥塞信号（429、超时、延迟升高），乘性减；同一时刻的多次信号只减一次
+
+        Args:
+            reason (str): 拥塞原因
+        """
+        now = time.monotonic()
+        async with self._condition:
+            if now - self._last_decrease < 1.0:
+                return
+            self._last_decrease = now
+            old_limit = self.limit
+            self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        logger.info(f"检测到拥塞({reason})，并发上限 {int(old_limit)} -> {int(self.limit)}")
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被快速拒绝"""
+
+class CircuitBreaker:
+    """
+    按滑动窗口错误率熔断：错误率过高时在冷却期内直接拒绝请求，冷却后放行一个探测请求，
+    探测成功则恢复，失败则重新打开（只在单个事件循环中使用）
+
+    allow()返回的凭证需要在请求结束后交回record_success/record_failure，并在finally中调用release：
+    只有探测请求的凭证能关闭熔断器，打开前发出的请求在半开状态下成功不会使熔断器恢复
+    """
+
+    # 熔断器关闭时放行请求的凭证
+    _PASS = object()
+
+    def __init__(self, error_rate=0.5, window=20, min_calls=10, cooldown=30.0):
+        """
+        初始化熔断器
+
+        Args:
+            error_rate (float): 窗口内错误率达到该值时打开熔断器
+            window (int): 统计错误率的最近请求数
+            min_calls (int): 窗口内至少有这么多请求才判断错误率
+            cooldown (float): 打开后的冷却时间(秒)
+        """
+        self.error_rate = error_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self._outcomes = []
+        self._opened_at = None
+        self._probe = None  # 正在进行的探测请求的凭证
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        """
+        判断是否放行一个请求
+
+        Returns:
+            object: 放行时返回凭证（冷却结束后的第一个请求得到探测凭证），拒绝时返回None
+        """
+        if self._opened_at is None:
+            return self._PASS
+        if self._probe is not None or time.monotonic() - self._opened_at < self.cooldown:
+            return None
+        # 冷却结束，放行一个探测请求（半开状态）
+        self._probe = object()
+        return self._probe
+
+    def release(self, ticket):
+        """
+        请求结束（包括被取消）时交回凭证；探测请求没有记录结果就结束时，允许发出新的探测请求
+
+        Args:
+            ticket (object): allow()返回的凭证
+        """
+        if ticket is not None and ticket is self._probe:
+            self._probe = None
+
+    def record_success(self, ticket):
+        """
+        记录一次成功的请求
+
+        Args:
+            ticket (object): allow()返回的凭证
+        """
+        if self._opened_at is not None:
+            if ticket is None or ticket is not self._probe:
+                # 熔断器打开前发出的请求，不代表服务已恢复
+                return
+            logger.info("探测请求成功，熔断器恢复")
+            self._opened_at = None
+            self._outcomes = []
+            self._probe = None
+        self._record(True)
+
+    def record_failure(self, ticket):
+        """
+        记录一次失败的请求
+
+        Args:
+            ticket (object): allow()返回的凭证
+
+        Returns:
+            bool: 本次失败是否使熔断器打开
+        """
+        if self._opened_at is not None:
+            if ticket is not None and ticket is self._probe:
+                # 探测失败，重新开始冷却
+                self._probe = None
+                self._opened_at = time.monotonic()
+            return False
+
+        self._record(False)
+        failures = self._outcomes.count(False)
+        if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+            self._opened_at = time.monotonic()
+            logger.warning(f"最近 {len(self._outcomes)} 次请求中 {failures} 次失败，熔断器打开 {self.cooldown:.0f} 秒")
+            return True
+        return False
+
+    def _record(self, success):
+        self._outcomes.append(success)
+        if len(self._outcomes) > self.window:
+            del self._outcomes[0]
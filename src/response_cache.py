@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    """基于SQLite的大模型响应缓存，按提示词、模型和采样参数的哈希索引，支持过期时间和总大小上限"""
+
+    def __init__(self, cache_dir=".cache/llm", ttl_seconds=None, max_size_mb=256):
+        """
+        初始化响应缓存
+
+        Args:
+            cache_dir (str): 缓存目录
+            ttl_seconds (float): 条目有效期(秒)，None表示永不过期
+            max_size_mb (int): 缓存内容的最大总大小(MB)，超出时淘汰最久未使用的条目
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(cache_dir, "responses.sqlite3"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, qa_pairs TEXT NOT NULL, "
+            "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._db.commit()
+
+        logger.info(f"响应缓存初始化，目录: {cache_dir}, 有效期: {ttl_seconds or '永久'}秒, 上限: {max_size_mb}MB")
+
+    @staticmethod
+    def make_key(prompt, model, temperature, max_tokens):
+        """
+        根据完整提示词和请求参数计算缓存键
+
+        Args:
+            prompt (str): 完整的提示词
+            model (str): 模型名称
+            temperature (float): 采样温度
+            max_tokens (int): 最大生成token数
+
+        Returns:
+            str: 十六进制缓存键
+        """
+        payload = json.dumps({"prompt": prompt, "model": model, "temperature": temperature,
+                              "max_tokens": max_tokens}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        读取缓存条目，过期条目视为未命中并删除
+
+        Args:
+            key (str): 缓存键
+
+        Returns:
+            dict: 包含response(原始响应文本)和qa_pairs(解析后的问答对)，未命中时返回None
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response, qa_pairs, created_at FROM responses WHERE key = ?",
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+
+            response, qa_pairs, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+
+        try:
+            return {"response": response, "qa_pairs": json.loads(qa_pairs)}
+        except json.JSONDecodeError as e:
+            logger.warning(f"响应缓存条目损坏，忽略该条目: {str(e)}")
+            return None
+
+    def put(self, key, model, response, qa_pairs):
+        """
+        写入缓存条目，并在超出大小上限时淘汰旧条目
+
+        Args:
+            key (str): 缓存键
+            model (str): 模型名称
+            response (str): 原始响应文本
+            qa_pairs (list): 解析后的问答对
+        """
+        qa_json = json.dumps(qa_pairs, ensure_ascii=False)
+        size = len(response.encode('utf-8')) + len(qa_json.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, response, qa_pairs, size, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", (key, model, response, qa_json, size, now, now)
+                )
+                self._evict(now)
+                self._db.commit()
+            except Exception as e:
+                logger.warning(f"写入响应缓存失败: {str(e)}")
+
+    def _evict(self, now):
+        """删除过期条目，并按最近使用时间淘汰条目直到总大小不超过上限（调用方需持有锁）"""
+        if self.ttl_seconds is not None:
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+
+        total_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+        for key, size in rows:
+            if total_size <= self.max_size_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_size -= size
+            logger.debug(f"淘汰响应缓存条目: {key}")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import logging
+from .rate_limiter import estimate_tokens
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+class TextChunker:
+    """按章节和段落/句子边界将文档切分为不超过token预算的片段"""
+
+    # 候选切分点：空行（段落）或句末标点之后的空白
+    _BOUNDARY = re.compile(r'\n\s*\n|(?<=[。！？!?；])\s*|(?<=[.;:])\s+')
+
+    # 章节标题：编号标题、中文章节或常见的论文段落名
+    _SECTION_START = re.compile(
+        r'^(?:\d+(?:\.\d+){0,3}\.?\s+[A-Z\u4e00-\u9fff]'
+        r'|第[一二三四五六七八九十百\d]+[章节部分]'
+        r'|[一二三四五六七八九十]+、'
+        r'|(?:Abstract|Introduction|Related Work|Background|Method(?:s|ology)?|Experiments?|Results'
+        r'|Discussion|Conclusions?|References|Appendix|Acknowledg(?:e)?ments?)\b'
+        r'|(?:摘要|引言|前言|相关工作|方法|实验|结果|讨论|结论|参考文献|附录|致谢))'
+    )
+
+    def __init__(self, max_tokens=6000, min_fill=0.5):
+        """
+        初始化切分器
+
+        Args:
+            max_tokens (int): 每个片段的token预算
+            min_fill (float): 片段达到预算的该比例后，遇到章节标题即另起新片段
+        """
+        self.max_tokens = max(1, max_tokens)
+        self.min_fill = min_fill
+
+    def _split_units(self, text):
+        """将文本切分为段落/句子单元，返回 [(单元文本, 是否为章节开头)]"""
+        units = []
+        start = 0
+        for match in self._BOUNDARY.finditer(text):
+            if match.end() <= start:
+                continue
+            unit = text[start:match.end()]
+            if unit.strip():
+                units.append(unit)
+            start = match.end()
+        if start < len(text) and text[start:].strip():
+            units.append(text[start:])
+        return [(unit, bool(self._SECTION_START.match(unit.lstrip()))) for unit in units]
+
+    def _hard_split(self, unit, tokens):
+        """将超过预算的单元按字符数等分"""
+        pieces = -(-tokens // self.max_tokens)
+        size = -(-len(unit) // pieces)
+        return [unit[i:i + size] for i in range(0, len(unit), size)]
+
+    def split(self, text):
+        """
+        切分文本
+
+        Args:
+            text (str): 文档文本
+
+        Returns:
+            list: 片段文本列表
+        """
+        if not text:
+            return []
+
+        chunks = []
+        current = []
+        current_tokens = 0
+
+        def flush():
+            nonlocal current, current_tokens
+            if current:
+                chunks.append("".join(current).strip())
+            current = []
+            current_tokens = 0
+
+        for unit, is_section in self._split_units(text):
+            tokens = estimate_tokens(unit)
+            # 已有足够内容时在章节边界处断开，尽量让每个片段保持主题完整
+            if is_section and current_tokens >= self.max_tokens * self.min_fill:
+                flush()
+            if current_tokens + tokens > self.max_tokens:
+                flush()
+            if tokens > self.max_tokens:
+                for piece in self._hard_split(unit, tokens):
+                    chunks.append(piece.strip())
+                continue
+            current.append(unit)
+            current_tokens += tokens
+        flush()
+
+        return [chunk for chunk in chunks if chunk]